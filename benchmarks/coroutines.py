@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Concurrent operations: coroutines vs. a thread per operation
+
+Runs `operations` child processes that each take `seconds`, all at once,
+from coroutines on one event loop and from a thread pool with a thread per
+operation (how the deploy tasks fan out). Each mode runs in a fresh
+interpreter so peak memory (max RSS) is comparable.
+
+    python benchmarks/coroutines.py [operations] [seconds]
+"""
+import os
+import sys
+import time
+import resource
+import threading
+import subprocess
+import concurrent.futures as futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storm"))
+
+class Sampler(threading.Thread):
+    """
+    Peak number of threads, itself not included
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.peak = 0
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, threading.active_count() - 1)
+            time.sleep(0.05)
+
+def operation_threads(operations, seconds):
+    from tasks import local
+
+    with futures.ThreadPoolExecutor(max_workers=operations) as executor:
+        for i in range(operations):
+            executor.submit(local, "sleep %s" % seconds)
+
+def operation_coroutines(operations, seconds):
+    from tasks import local_async
+    from coroutines import run
+
+    def main():
+        yield [local_async("sleep %s" % seconds) for i in range(operations)]
+    run(main())
+
+def measure(mode, operations, seconds):
+    sampler = Sampler()
+    sampler.start()
+    start = time.time()
+    globals()["operation_%s" % mode](operations, seconds)
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print("%-11s %5d ops  %7.2fs  %5d threads  %7.1fMB max RSS" % (mode, operations, elapsed, sampler.peak, rss))
+
+def main():
+    if len(sys.argv) > 3:
+        measure(sys.argv[3], int(sys.argv[1]), float(sys.argv[2]))
+        return
+
+    operations = sys.argv[1] if len(sys.argv) > 1 else "1000"
+    seconds = sys.argv[2] if len(sys.argv) > 2 else "5"
+    for mode in ("threads", "coroutines"):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), operations, seconds, mode])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Debug log throughput
+
+Writes 100k lines of subprocess-like output to the debug log from a few
+threads, through the previous synchronous RotatingFileHandler and through the
+queue-backed AsyncFileHandler. "caller" is the time deploy threads spend
+logging, "drained" is the time until every line is on disk.
+
+    python benchmarks/debug_log.py [lines] [threads]
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import logging.handlers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storm.tasks import DebugFormatter  # noqa
+from storm.debuglog import AsyncFileHandler  # noqa
+
+LINE = "Step 4 : RUN apt-get install -q -y python git curl build-essential pkg-config"
+
+def emit(logger, lines, index):
+    thread_name = "create storm-aws-0-%d-abcd1234" % index
+    for i in range(lines):
+        logger.debug("[%s] %s %d" % (thread_name, LINE, i))
+
+def run(name, handler, lines, threads):
+    logger = logging.getLogger("bench.%s" % name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler.setFormatter(DebugFormatter())
+    logger.addHandler(handler)
+
+    start = time.time()
+    workers = [threading.Thread(target=emit, args=(logger, lines // threads, i)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    caller = time.time() - start
+    handler.flush()
+    drained = time.time() - start
+    handler.close()
+    logger.removeHandler(handler)
+
+    print("%-8s caller: %6.3fs  drained: %6.3fs  (%d lines/s)" % (name, caller, drained, lines / drained))
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    path = tempfile.mkdtemp()
+    try:
+        run("sync", logging.handlers.RotatingFileHandler(os.path.join(path, "sync.log"), maxBytes=10 * 1024 * 1024, backupCount=5),
+            lines, threads)
+        run("async", AsyncFileHandler(os.path.join(path, "async.log"), backup_count=5), lines, threads)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
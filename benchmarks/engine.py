@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Docker Engine API latency
+
+Runs inspect / create / start / stop / rm cycles against a local stand-in
+Docker daemon over mutual TLS, with a new connection per operation (what
+every `docker` process does), with the pooled Engine client, and with the
+docker CLI when it is installed. `rtt` adds a simulated network round trip
+in milliseconds, the TCP and TLS handshakes of a new connection cost two.
+
+    python benchmarks/engine.py [cycles] [rtt]
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storm.engine import Engine  # noqa
+
+OPERATIONS = ["inspect", "create", "start", "stop", "rm"]
+
+def openssl(*args):
+    subprocess.check_call(("openssl",) + args, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+
+def certificates(path):
+    """
+    CA, server and client certificates like docker-machine generates
+    """
+    openssl("req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=storm-ca",
+            "-keyout", os.path.join(path, "ca-key.pem"), "-out", os.path.join(path, "ca.pem"))
+    for name in ("server", "cert"):
+        key = os.path.join(path, "key.pem" if name == "cert" else "server-key.pem")
+        csr = os.path.join(path, "%s.csr" % name)
+        openssl("req", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", csr)
+        openssl("x509", "-req", "-days", "1", "-in", csr, "-CA", os.path.join(path, "ca.pem"),
+                "-CAkey", os.path.join(path, "ca-key.pem"), "-CAcreateserial", "-out", os.path.join(path, "%s.pem" % name))
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one segment like dockerd does
+    wbufsize = -1
+
+    def setup(self):
+        # TCP and TLS handshakes
+        time.sleep(2 * self.server.rtt)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def respond(self, status, body=None):
+        time.sleep(self.server.rtt)
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/version"):
+            self.respond(200, {"Version": "1.10.3", "ApiVersion": "1.22"})
+        elif self.path.startswith("/containers/json"):
+            self.respond(200, [{"Id": "0123456789ab", "Names": ["/consul-0"]}])
+        else:
+            self.respond(200, {"Id": "0123456789ab", "NetworkSettings": {"IPAddress": "172.17.0.2"}})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.startswith("/containers/create"):
+            self.respond(201, {"Id": "0123456789ab", "Warnings": None})
+        else:
+            self.respond(204)
+
+    def do_DELETE(self):
+        self.respond(204)
+
+    def log_message(self, *args):
+        pass
+
+class Daemon(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, path, rtt):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.rtt = rtt
+        self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.context.load_cert_chain(os.path.join(path, "server.pem"), os.path.join(path, "server-key.pem"))
+        self.context.load_verify_locations(os.path.join(path, "ca.pem"))
+        self.context.verify_mode = ssl.CERT_REQUIRED
+
+    def handle_error(self, request, address):
+        # Clients without a pool hang up without a TLS close_notify
+        pass
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.context.wrap_socket(sock, server_side=True), address
+
+def cycle(engine):
+    timings = []
+    for operation in OPERATIONS:
+        start = time.time()
+        if operation == "inspect":
+            engine.inspect("consul-0")
+        elif operation == "create":
+            engine.create("gliderlabs/consul-server:0.6", name="consul-0")
+        elif operation == "start":
+            engine.start("consul-0")
+        elif operation == "stop":
+            engine.stop("consul-0")
+        elif operation == "rm":
+            engine.rm("consul-0", force=True)
+        timings.append(time.time() - start)
+    return timings
+
+def cli_cycle(port, path):
+    env = dict(os.environ, DOCKER_HOST="tcp://127.0.0.1:%d" % port, DOCKER_TLS_VERIFY="1", DOCKER_CERT_PATH=path)
+    commands = [["inspect", "consul-0"],
+                ["create", "--name", "consul-0", "gliderlabs/consul-server:0.6"],
+                ["start", "consul-0"],
+                ["stop", "consul-0"],
+                ["rm", "-f", "consul-0"]]
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for command in commands:
+            start = time.time()
+            subprocess.call(["docker"] + command, env=env, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return timings
+
+def report(name, runs):
+    averages = [sum(timing[i] for timing in runs) / len(runs) * 1000 for i in range(len(OPERATIONS))]
+    print("%-8s %s  %7.2fms" % (name, " ".join("%7.2fms" % average for average in averages), sum(averages) / len(averages)))
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rtt = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0
+    path = tempfile.mkdtemp()
+    try:
+        certificates(path)
+        daemon = Daemon(path, rtt)
+        port = daemon.server_address[1]
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        print("%d cycles, %.1fms round trip" % (cycles, rtt * 1000))
+        print("%-8s %s  %9s" % ("", " ".join("%9s" % operation for operation in OPERATIONS), "per op"))
+
+        fresh = Engine("127.0.0.1", port, cert_path=path, pool_size=0)
+        report("fresh", [cycle(fresh) for i in range(cycles)])
+
+        pooled = Engine("127.0.0.1", port, cert_path=path)
+        cycle(pooled)
+        report("pooled", [cycle(pooled) for i in range(cycles)])
+        pooled.close()
+
+        if find_executable("docker"):
+            report("cli", [cli_cycle(port, path) for i in range(max(1, cycles // 10))])
+        else:
+            print("docker client not found, skipping cli")
+
+        daemon.shutdown()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
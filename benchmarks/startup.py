@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Startup budget check
+
+Imports the CLI in a fresh interpreter for each command, parses its
+arguments and sets up logging, then reports how long that took, which
+heavy dependencies got loaded and how many subprocesses were forked on the
+way. Exits non-zero if any command goes
+over its budget (see "Startup budget" in README.md).
+
+    python benchmarks/startup.py
+"""
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ["boto", "azure", "fabric", "progressbar", "colorlog", "yaml", "argcomplete"]
+
+# Milliseconds allowed between interpreter start and command dispatch
+BUDGETS = {
+    "env": 150,
+    "ls": 150,
+    "ps": 150,
+    "up": 150,
+    "stop": 150,
+    "rm": 150,
+    "teardown": 150,
+    "launch": 150,
+    "deploy": 150,
+}
+
+PROBE = """
+import sys, time, json, subprocess
+forks = []
+popen_init = subprocess.Popen.__init__
+def counting_init(self, *args, **kwargs):
+    forks.append(args[0] if args else kwargs.get("args"))
+    popen_init(self, *args, **kwargs)
+subprocess.Popen.__init__ = counting_init
+start = time.time()
+sys.argv = ["docker-storm", %r, "0"]
+from storm import storm
+args = storm.parse_arguments(storm.ArgumentParser())
+storm.set_logging(args.debug)
+elapsed = (time.time() - start) * 1000
+heavy = sorted(set(m.split(".")[0] for m in sys.modules if m.split(".")[0] in %r and sys.modules[m] is not None))
+print(json.dumps({"elapsed": elapsed, "heavy": heavy, "forks": len(forks)}))
+"""
+
+def measure(command):
+    out = subprocess.check_output([sys.executable, "-c", PROBE % (command, HEAVY)], cwd=ROOT)
+    return json.loads(out.splitlines()[-1])
+
+def main():
+    failed = []
+    for command in sorted(BUDGETS):
+        result = measure(command)
+        ok = result["elapsed"] <= BUDGETS[command] and not result["heavy"] and not result["forks"]
+        if not ok:
+            failed.append(command)
+        print("%-10s %7.1fms / %4dms  %d forks  %s  %s" % (command, result["elapsed"], BUDGETS[command], result["forks"],
+                                                           "ok  " if ok else "FAIL", ", ".join(result["heavy"])))
+    if failed:
+        print("Over budget: %s" % ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,41 @@
 #!/usr/bin/env python
 
+import os
 from setuptools import setup, find_packages
+from setuptools.command.develop import develop as _develop
 import versioneer
 
+STATIC_VERSION_PY = """# This file was generated by setup.py at build time, it is used instead of
+# storm/_version.py so that running docker-storm never has to ask git.
+version = %r
+"""
+STATIC_VERSIONFILE = os.path.join("storm", "_build_version.py")
+
+VERSION = versioneer.get_version()
+CMDCLASS = versioneer.get_cmdclass()
+
+def write_static_version(target):
+    print("UPDATING %s" % target)
+    with open(target, "w") as f:
+        f.write(STATIC_VERSION_PY % VERSION)
+
+
+_build_py = CMDCLASS["build_py"]
+
+class cmd_build_py(_build_py):
+    def run(self):
+        _build_py.run(self)
+        write_static_version(os.path.join(self.build_lib, STATIC_VERSIONFILE))
+
+class cmd_develop(_develop):
+    def run(self):
+        write_static_version(STATIC_VERSIONFILE)
+        _develop.run(self)
+
+
+CMDCLASS["build_py"] = cmd_build_py
+CMDCLASS["develop"] = cmd_develop
+
 CONSOLE_SCRIPTS = ['docker-storm=storm.storm:main']
 LONG = """
 Storm - Multi-cloud load-balanced orchestration for Docker
@@ -27,8 +60,8 @@ setup(name="docker-storm",
           "progressbar2",
       ],
       entry_points=dict(console_scripts=CONSOLE_SCRIPTS),
-      version=versioneer.get_version(),
-      cmdclass=versioneer.get_cmdclass(),
+      version=VERSION,
+      cmdclass=CMDCLASS,
       classifiers=[
           "Development Status :: 2 - Pre-Alpha",
           "Environment :: Console",
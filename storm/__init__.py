@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+# Version baked in at build time by setup.py, git is only asked through
+# storm._version when --version is requested
+try:
+    from ._build_version import version as __version__
+except ImportError:
+    __version__ = "0+unknown"
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Baked machine images
+
+`docker-storm bake <provider> [region ...]` creates a machine the usual way
+with the engine on STORAGE_DRIVER, pulls the images deployments run
+(Consul, Registrator, HAProxy and the services in storm.yml), then turns it
+into a provider image: an AMI, an Azure OS image or a DigitalOcean
+snapshot. Images are recorded per provider and region in
+~/.storm/images.json, deploy uses them for groups that don't set an image
+of their own unless they have `baked: false`. docker-machine doesn't
+install the engine where there already is one, so machines only need to be
+configured.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+import store
+import bulk
+import tasks
+from lazy import lazy_import
+from credentials import credentials, STORM_PATH
+from coroutines import Return, blocking, gather
+
+# uuid forks ldconfig on import in Python 2
+uuid = lazy_import("uuid")
+yaml = lazy_import("yaml")
+
+log = logging.getLogger(__name__)
+
+IMAGES_PATH = os.path.join(STORM_PATH, "images.json")
+
+STORAGE_DRIVER = "overlay"
+IMAGE_TIMEOUT = 1800
+POLL_INTERVAL = 15
+
+DEFAULT_REGIONS = {
+    "aws": "us-east-1",
+    "azure": "East US",
+    "digitalocean": "nyc3"
+}
+
+# storm.yml keys for the region and image of a group
+REGION_OPTIONS = {
+    "aws": "region",
+    "azure": "location",
+    "digitalocean": "region"
+}
+IMAGE_OPTIONS = {
+    "aws": "ami",
+    "azure": "image",
+    "digitalocean": "image"
+}
+
+# Swarm needs every engine to have its own ID, docker-machine puts new
+# certificates and options in place when it configures the machine
+PREPARE = "sudo service docker stop; sudo rm -f /etc/docker/key.json /etc/docker/*.pem"
+
+images_lock = threading.Lock()
+
+class BakeError(Exception):
+    pass
+
+def load_images(path=IMAGES_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def record_image(provider, region, image, name, pulled, storage_driver=STORAGE_DRIVER, path=IMAGES_PATH):
+    with images_lock:
+        images = load_images(path)
+        images.setdefault(provider, {})[region] = {
+            "image": image,
+            "name": name,
+            "created": time.time(),
+            "images": pulled,
+            "storage_driver": storage_driver
+        }
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(images, f, indent=2)
+        os.rename(tmp, path)
+
+def baked_image(provider, region=None):
+    """
+    Latest image baked for `provider` in `region`, None if there's none
+    """
+    entry = load_images().get(provider, {}).get(region or DEFAULT_REGIONS.get(provider))
+    return entry["image"] if entry else None
+
+def use_baked(instance, images=None):
+    """
+    Fill in the baked image of an instance's provider and region unless it
+    has one already or `baked: false`, with the storage driver its images
+    were pulled with
+    """
+    provider = instance["provider"]
+    if provider not in IMAGE_OPTIONS or IMAGE_OPTIONS[provider] in instance or not instance.get("baked", True):
+        return instance
+    region = instance.get(REGION_OPTIONS[provider], DEFAULT_REGIONS[provider])
+    entry = (images if images is not None else load_images()).get(provider, {}).get(region)
+    if entry:
+        instance[IMAGE_OPTIONS[provider]] = entry["image"]
+        # Images baked before the driver was recorded used the same one
+        instance["storage_driver"] = entry.get("storage_driver", STORAGE_DRIVER)
+    return instance
+
+def compose_images(path):
+    """
+    Images of the services in a docker-compose.yml
+    """
+    try:
+        with open(path) as f:
+            compose = yaml.safe_load(f) or {}
+    except IOError:
+        return []
+    services = compose.get("services", compose) if compose.get("version") else compose
+    return [service["image"] for service in services.values() if isinstance(service, dict) and "image" in service]
+
+def bake_images(storm=None):
+    """
+    Images every deployment runs, and the services of `storm` (storm.yml)
+    """
+    images = [tasks.CONSUL_IMAGE]
+    for name in ("registrator", "haproxy"):
+        images += compose_images(os.path.join(os.path.dirname(__file__), "compose", name, "docker-compose.yml"))
+    for name in (storm or {}).get("deploy", {}):
+        images += compose_images(os.path.join(os.getcwd(), "deploy", name, "docker-compose.yml"))
+    return sorted(set(images), key=images.index)
+
+def wait(check, what):
+    deadline = time.time() + IMAGE_TIMEOUT
+    while not check():
+        if time.time() > deadline:
+            raise BakeError("Timed out waiting for %s" % what)
+        time.sleep(POLL_INTERVAL)
+
+def capture_aws(machine, name, region):
+    ec2 = bulk.ec2_connection(region)
+    image_id = ec2.create_image(machine.config["Driver"]["InstanceId"], name, description="docker-storm")
+
+    def available():
+        image = ec2.get_image(image_id)
+        if image.state == "failed":
+            raise BakeError("Creating %s failed" % image_id)
+        return image.state == "available"
+    wait(available, image_id)
+    return image_id
+
+def capture_digitalocean(machine, name, region):
+    api = bulk.DigitalOcean(credentials.digitalocean().token)
+    droplet = machine.config["Driver"]["DropletID"]
+
+    def action(kind, **arguments):
+        arguments["type"] = kind
+        action_id = api.request("POST", "/v2/droplets/%s/actions" % droplet, arguments)["action"]["id"]
+
+        def completed():
+            status = api.request("GET", "/v2/actions/%s" % action_id)["action"]["status"]
+            if status == "errored":
+                raise BakeError("%s of droplet %s failed" % (kind, droplet))
+            return status == "completed"
+        wait(completed, "%s of droplet %s" % (kind, droplet))
+
+    action("power_off")
+    action("snapshot", name=name)
+    for snapshot in api.request("GET", "/v2/droplets/%s/snapshots?per_page=200" % droplet)["snapshots"]:
+        if snapshot["name"] == name:
+            return snapshot["id"]
+    raise BakeError("Snapshot %s not found" % name)
+
+def capture_azure(machine, name, region):
+    with tasks.azure_service() as sms:
+        result = sms.capture_role(machine.name, machine.name, machine.name, "Delete", name, name)
+        sms.wait_for_operation_status(result.request_id, timeout=IMAGE_TIMEOUT, sleep_interval=POLL_INTERVAL)
+    return name
+
+
+CAPTURES = {
+    "aws": capture_aws,
+    "azure": capture_azure,
+    "digitalocean": capture_digitalocean
+}
+
+def bake_async(provider, region, images):
+    """
+    Coroutine baking an image of `provider` in `region` with `images`
+    pulled, returns its ID
+    """
+    name = "bake-%s-%s" % (provider, str(uuid.uuid4())[:8])
+    command = tasks.CREATE_COMMANDS[provider](name, storage_driver=STORAGE_DRIVER, **{REGION_OPTIONS[provider]: region})
+    # Labelled so the builder doesn't count as part of the cluster
+    command = command.replace("--engine-label com.storm.managed=true ", "--engine-label com.storm.bake=true ")
+
+    try:
+        # Removed below even if creating it fails partway
+        log.info("Creating %s in %s..." % (name, region))
+        yield tasks.local_async(command, threadName="create %s" % name)
+
+        log.info("Pulling %s on %s..." % (", ".join(images), name))
+        engine = yield blocking(tasks.engine_on, name)
+        yield [blocking(engine.pull, image) for image in images]
+
+        prepare = PREPARE
+        if provider == "azure":
+            # Captured OS images have to be generalized
+            prepare += "; sudo waagent -force -deprovision"
+        yield tasks.local_async("docker-machine ssh %s -- '%s'" % (name, prepare), threadName="ssh %s" % name)
+
+        image_name = "docker-storm-%s" % time.strftime("%Y%m%d-%H%M%S")
+        log.info("Creating image %s from %s..." % (image_name, name))
+        image = yield blocking(CAPTURES[provider], store.load(name), image_name, region)
+        record_image(provider, region, image, image_name, images)
+    finally:
+        yield tasks.machine_async("rm -y %s" % name, threadName="rm %s" % name)
+        tasks.environments.invalidate(name)
+    log.info("Baked %s in %s: %s" % (provider, region, image))
+    raise Return(image)
+
+def bake_all_async(provider, regions, images):
+    """
+    Coroutine baking in all `regions` at once
+    """
+    results = yield gather(*[bake_async(provider, region, images) for region in regions], return_exceptions=True)
+    tasks.raise_first(regions, results)
+    raise Return(results)
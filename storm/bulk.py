@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+Bulk provisioning
+
+Creates a whole group of machines in as few provider API calls as possible,
+one EC2 RunInstances call with MinCount/MaxCount, DigitalOcean droplets ten
+names per call, and waits for all of them with one call per poll.
+docker-machine then only installs Docker on them over SSH with its generic
+driver. Since docker-machine can't stop or remove what it didn't create,
+these VMs are recorded in ~/.storm/bulk.json and stop() and terminate() go
+through the provider. Azure has no bulk API, its machines are still created
+one by one.
+"""
+import os
+import json
+import time
+import hashlib
+import httplib
+import logging
+import threading
+import subprocess
+
+from lazy import lazy_import
+from credentials import credentials, STORM_PATH
+
+# uuid forks ldconfig on import in Python 2
+uuid = lazy_import("uuid")
+boto_ec2 = lazy_import("boto.ec2")
+boto_vpc = lazy_import("boto.vpc")
+boto_exception = lazy_import("boto.exception")
+networkinterface = lazy_import("boto.ec2.networkinterface")
+
+log = logging.getLogger(__name__)
+
+BULK_PATH = os.path.join(STORM_PATH, "bulk.json")
+KEY_PATH = os.path.join(STORM_PATH, "keys", "storm_rsa")
+
+READY_TIMEOUT = 600
+POLL_INTERVAL = 5
+
+SSH_USERS = {
+    "aws": "ubuntu",
+    "digitalocean": "root"
+}
+
+# Ports docker-machine opens in the security groups it creates
+AWS_MACHINE_PORTS = [22, 2376, 3376]
+
+DIGITALOCEAN_API = "api.digitalocean.com"
+DIGITALOCEAN_BATCH = 10
+DIGITALOCEAN_IMAGE = "ubuntu-16-04-x64"
+
+records_lock = threading.Lock()
+
+class BulkError(Exception):
+    """
+    A provider call failed, the message keeps the provider's error code so
+    throttling can be told apart
+    """
+
+def keypair(path=KEY_PATH):
+    """
+    SSH key for machines created in bulk, returns its path and public key
+    """
+    try:
+        if not os.path.exists(path):
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call(["ssh-keygen", "-q", "-t", "rsa", "-b", "4096", "-N", "", "-C", "docker-storm", "-f", path],
+                                      stdout=devnull, stderr=subprocess.STDOUT)
+        with open(path + ".pub") as f:
+            return path, f.read().strip()
+    except (IOError, OSError, subprocess.CalledProcessError) as e:
+        raise BulkError("Could not create SSH key %s: %s" % (path, e))
+
+def load_records(path=BULK_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_records(records, path=BULK_PATH):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(records, f, indent=2)
+    os.rename(tmp, path)
+
+def record(provider, region, ids, path=BULK_PATH):
+    with records_lock:
+        records = load_records(path)
+        for name, id in ids.items():
+            records[name] = {"provider": provider, "region": region, "id": id}
+        save_records(records, path)
+
+def forget(names, path=BULK_PATH):
+    with records_lock:
+        records = load_records(path)
+        for name in names:
+            records.pop(name, None)
+        save_records(records, path)
+
+def created(names, path=BULK_PATH):
+    """
+    Records of the machines in `names` that were created in bulk
+    """
+    records = load_records(path)
+    return dict((name, records[name]) for name in names if name in records)
+
+def by_region(records):
+    groups = {}
+    for name, entry in records.items():
+        groups.setdefault((entry["provider"], entry["region"]), {})[name] = entry["id"]
+    return groups
+
+def wait(poll, names):
+    """
+    Call poll() until it has an IP for every name
+    """
+    deadline = time.time() + READY_TIMEOUT
+    while True:
+        ips = poll()
+        if all(ips.get(name) for name in names):
+            return ips
+        if time.time() > deadline:
+            raise BulkError("Timed out waiting for %s" % ", ".join(name for name in names if not ips.get(name)))
+        time.sleep(POLL_INTERVAL)
+
+#
+# AWS
+#
+
+def ec2_connection(region):
+    aws = credentials.aws()
+    return boto_ec2.connect_to_region(region, aws_access_key_id=aws.access_key, aws_secret_access_key=aws.secret_key)
+
+def ec2_error(e):
+    return BulkError("%s: %s" % (getattr(e, "error_code", None) or e.status, getattr(e, "error_message", None) or e.reason))
+
+def ec2_key(ec2, public_key):
+    name = "docker-storm-%s" % hashlib.md5(public_key).hexdigest()[:12]
+    try:
+        ec2.get_all_key_pairs(keynames=[name])
+    except boto_exception.EC2ResponseError as e:
+        if e.error_code != "InvalidKeyPair.NotFound":
+            raise
+        ec2.import_key_pair(name, public_key)
+    return name
+
+def ec2_security_group(ec2, name, vpc=None):
+    """
+    ID of the security group, created with docker-machine's ports if missing
+    """
+    for group in ec2.get_all_security_groups():
+        if group.name == name and (vpc is None or group.vpc_id == vpc):
+            return group.id
+    group = ec2.create_security_group(name, "Docker Storm", vpc_id=vpc)
+    for port in AWS_MACHINE_PORTS:
+        ec2.authorize_security_group(group_id=group.id, ip_protocol="tcp", from_port=port, to_port=port, cidr_ip="0.0.0.0/0")
+    return group.id
+
+def ec2_subnet(region, vpc, zone):
+    aws = credentials.aws()
+    connection = boto_vpc.connect_to_region(region, aws_access_key_id=aws.access_key, aws_secret_access_key=aws.secret_key)
+    subnets = connection.get_all_subnets(filters={"vpc-id": vpc, "availability-zone": region + zone})
+    if not subnets:
+        raise BulkError("No subnet in %s%s for %s" % (region, zone, vpc))
+    return subnets[0].id
+
+def provision_aws(names, vpc=None, ami=None, region="us-east-1", zone="c", instance_type="t2.medium",
+                  security_group="docker-storm", **options):
+    """
+    One RunInstances call for all of `names`, returns their IPs
+    """
+    if not ami:
+        raise BulkError("Creating AWS machines in bulk needs an AMI")
+    key_path, public_key = keypair()
+    ec2 = ec2_connection(region)
+    try:
+        key_name = ec2_key(ec2, public_key)
+        group_id = ec2_security_group(ec2, security_group, vpc)
+        arguments = {
+            "min_count": len(names),
+            "max_count": len(names),
+            "key_name": key_name,
+            "instance_type": instance_type
+        }
+        if vpc:
+            subnet = ec2_subnet(region, vpc, zone)
+            interface = networkinterface.NetworkInterfaceSpecification(subnet_id=subnet, groups=[group_id],
+                                                                       associate_public_ip_address=True)
+            arguments["network_interfaces"] = networkinterface.NetworkInterfaceCollection(interface)
+        else:
+            arguments["placement"] = region + zone
+            arguments["security_group_ids"] = [group_id]
+        reservation = ec2.run_instances(ami, **arguments)
+    except boto_exception.BotoServerError as e:
+        raise ec2_error(e)
+
+    ids = dict(zip(names, [instance.id for instance in reservation.instances]))
+    record("aws", region, ids)
+
+    def poll():
+        try:
+            instances = ec2.get_only_instances(instance_ids=ids.values())
+        except boto_exception.EC2ResponseError as e:
+            # Instances take a moment to show up
+            if e.error_code != "InvalidInstanceID.NotFound":
+                raise ec2_error(e)
+            return {}
+        ips = dict((instance.id, instance.ip_address) for instance in instances if instance.state == "running")
+        return dict((name, ips.get(id)) for name, id in ids.items())
+
+    try:
+        return wait(poll, names)
+    except BulkError:
+        terminate(names)
+        raise
+
+#
+# DigitalOcean
+#
+
+class DigitalOcean(object):
+    """
+    Just enough of the DigitalOcean API
+    """
+    def __init__(self, token):
+        self.token = token
+
+    def request(self, method, path, body=None):
+        connection = httplib.HTTPSConnection(DIGITALOCEAN_API, timeout=60)
+        try:
+            connection.request(method, path, json.dumps(body) if body is not None else None,
+                               {"Authorization": "Bearer %s" % self.token, "Content-Type": "application/json"})
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, IOError) as e:
+            raise BulkError("%s %s: %s" % (method, path, e))
+        finally:
+            connection.close()
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get("message")
+            except ValueError:
+                message = data
+            raise BulkError("%s %s: %d %s" % (method, path, response.status, message))
+        return json.loads(data) if data else None
+
+def digitalocean_key(api, public_key):
+    for key in api.request("GET", "/v2/account/keys?per_page=200")["ssh_keys"]:
+        if key["public_key"].strip() == public_key:
+            return key["id"]
+    return api.request("POST", "/v2/account/keys", {"name": "docker-storm", "public_key": public_key})["ssh_key"]["id"]
+
+def provision_digitalocean(names, size="512mb", region="nyc3", image=None, **options):
+    """
+    Droplets for all of `names`, ten per call, returns their IPs
+    """
+    key_path, public_key = keypair()
+    api = DigitalOcean(credentials.digitalocean().token)
+    key = digitalocean_key(api, public_key)
+    # Tagged to find them all in one call
+    tag = "docker-storm-%s" % str(uuid.uuid4())[:8]
+    ids = {}
+    try:
+        for i in range(0, len(names), DIGITALOCEAN_BATCH):
+            batch = names[i:i + DIGITALOCEAN_BATCH]
+            response = api.request("POST", "/v2/droplets", {
+                "names": batch,
+                "region": region,
+                "size": size,
+                # Snapshots are referred to by ID
+                "image": int(image) if str(image).isdigit() else image or DIGITALOCEAN_IMAGE,
+                "ssh_keys": [key],
+                "tags": [tag]
+            })
+            batch_ids = dict((droplet["name"], droplet["id"]) for droplet in response["droplets"])
+            ids.update(batch_ids)
+            record("digitalocean", region, batch_ids)
+
+        def poll():
+            droplets = api.request("GET", "/v2/droplets?per_page=200&tag_name=%s" % tag)["droplets"]
+            ips = {}
+            for droplet in droplets:
+                if droplet["status"] == "active":
+                    ips[droplet["name"]] = next((network["ip_address"] for network in droplet["networks"]["v4"]
+                                                 if network["type"] == "public"), None)
+            return ips
+
+        return wait(poll, names)
+    except BulkError:
+        terminate(ids.keys())
+        raise
+
+
+PROVISIONERS = {
+    "aws": provision_aws,
+    "digitalocean": provision_digitalocean
+}
+
+def provision(provider, names, **options):
+    """
+    Create VMs for all of `names` with `provider`, returns their IPs by name
+    """
+    log.debug("Creating %s in bulk on %s" % (", ".join(names), provider))
+    return PROVISIONERS[provider](names, **options)
+
+def ssh_options(provider):
+    """
+    User and key docker-machine logs in with
+    """
+    return SSH_USERS[provider], keypair()[0]
+
+def stop(names):
+    """
+    Stop machines created in bulk, the others are left alone
+    """
+    for (provider, region), ids in by_region(created(names)).items():
+        try:
+            if provider == "aws":
+                ec2_connection(region).stop_instances(instance_ids=ids.values())
+            elif provider == "digitalocean":
+                api = DigitalOcean(credentials.digitalocean().token)
+                for id in ids.values():
+                    api.request("POST", "/v2/droplets/%s/actions" % id, {"type": "shutdown"})
+        except (BulkError, boto_exception.BotoServerError) as e:
+            log.warn("Could not stop %s: %s" % (", ".join(ids), e))
+
+def terminate(names):
+    """
+    Remove the VMs of machines created in bulk, the others are left alone
+    """
+    for (provider, region), ids in by_region(created(names)).items():
+        removed = []
+        try:
+            if provider == "aws":
+                ec2_connection(region).terminate_instances(instance_ids=ids.values())
+                removed = ids.keys()
+            elif provider == "digitalocean":
+                api = DigitalOcean(credentials.digitalocean().token)
+                for name, id in ids.items():
+                    try:
+                        api.request("DELETE", "/v2/droplets/%s" % id)
+                    except BulkError as e:
+                        # Already gone
+                        if ": 404 " not in str(e):
+                            raise
+                    removed.append(name)
+        except (BulkError, boto_exception.BotoServerError) as e:
+            log.warn("Could not remove %s: %s" % (", ".join(sorted(set(ids) - set(removed))), e))
+        forget(removed)
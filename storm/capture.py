@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Captured command output
+
+Output is kept in memory up to STORM_CAPTURE_LIMIT bytes (1MB by default),
+then moves to a temporary file, so `docker ps` on a big swarm or long
+compose logs don't have to fit in memory.
+"""
+import os
+import mmap
+import tempfile
+
+CAPTURE_LIMIT = int(os.environ.get("STORM_CAPTURE_LIMIT", 1024 * 1024))
+
+class CaptureBuffer(object):
+    """
+    Append-only output buffer that spills to disk past `limit` bytes
+    """
+    def __init__(self, limit=CAPTURE_LIMIT):
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.file = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """
+        Lines of output, read lazily once spilled
+        """
+        if self.file is None:
+            return iter(list(self.chunks))
+        self.file.flush()
+        return self.lines()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def spilled(self):
+        return self.file is not None
+
+    def write(self, data):
+        if self.file is None and self.size + len(data) > self.limit:
+            self.spill()
+        if self.file is None:
+            self.chunks.append(data)
+        else:
+            self.file.write(data)
+        self.size += len(data)
+
+    def spill(self):
+        self.file = tempfile.TemporaryFile(prefix="storm-capture-")
+        self.file.writelines(self.chunks)
+        self.chunks = []
+
+    def lines(self):
+        # Reads through its own descriptor so writes and other readers don't move it
+        with os.fdopen(os.dup(self.file.fileno()), "rb") as f:
+            f.seek(0)
+            for line in f:
+                yield line
+
+    def getvalue(self):
+        if self.file is None:
+            return "".join(self.chunks)
+        self.file.flush()
+        self.file.seek(0)
+        return self.file.read()
+
+    def mmap(self):
+        """
+        Read-only view of the output for parsing (slicing, find(), re), a
+        memory map once spilled, the string itself otherwise
+        """
+        if self.file is None or not self.size:
+            return self.getvalue()
+        self.file.flush()
+        return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.chunks = []
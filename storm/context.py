@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Task contexts
+
+Every operation (a launch, a Consul deployment, stopping machines...) gets
+its own TaskContext, passed down to the functions doing the work, with its
+progress, timing and cancellation. Nothing is shared between operations, so
+several of them can run at once in one process:
+
+    with TaskContext("Launch", len(instances) * 10) as context:
+        create(instance, context=context)
+
+    log.info("Launch duration: %ss" % context.elapsed)
+
+Progress goes out as events, the progress module's reporter thread renders
+them.
+"""
+import time
+import logging
+import itertools
+import threading
+from concurrent.futures import CancelledError
+
+import progress
+
+log = logging.getLogger(__name__)
+
+ids = itertools.count(1)
+
+class TaskContext(object):
+    """
+    Progress (`completed` steps out of `total`), timing and cancellation of
+    one operation, safe to update from any thread
+    """
+    def __init__(self, name, total):
+        self.id = next(ids)
+        self.name = name
+        self.total = max(total, 1)
+        self.completed = 0
+        self.started = None
+        self.ended = None
+        self.reporter = None
+        self.lock = threading.Lock()
+        self.cancellation = threading.Event()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+    def start(self):
+        self.started = time.time()
+        self.reporter = progress.get_reporter()
+        self.reporter.publish("start", id=self.id, operation=self.name, total=self.total, time=self.started)
+        return self
+
+    def advance(self, steps=1):
+        with self.lock:
+            self.completed = min(self.total, self.completed + steps)
+            if self.reporter is not None and self.ended is None:
+                self.reporter.publish("progress", id=self.id, completed=self.completed)
+
+    def step(self, name, duration):
+        """
+        Report how long a named step of the operation took
+        """
+        if self.reporter is not None:
+            self.reporter.publish("step", id=self.id, step=name, duration=round(duration, 3))
+
+    def finish(self):
+        with self.lock:
+            if self.ended is not None:
+                return
+            self.ended = time.time()
+            if self.reporter is None:
+                return
+            self.reporter.publish("finish", id=self.id, completed=self.completed, time=self.ended)
+        # Whatever gets logged next comes after the finished bar
+        self.reporter.flush()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.ended or time.time()) - self.started
+
+    def cancel(self):
+        """
+        Ask the work of this operation to stop, checked between steps
+        """
+        self.cancellation.set()
+
+    @property
+    def cancelled(self):
+        return self.cancellation.is_set()
+
+    def check(self):
+        """
+        Raise CancelledError if the operation was cancelled
+        """
+        if self.cancelled:
+            raise CancelledError("%s cancelled" % self.name)
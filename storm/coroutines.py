@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+Coroutines
+
+Generator-based coroutines on a single-thread event loop, to drive whole
+deployments from one thread. A coroutine is a generator that yields what it
+waits for: futures (like processes started on the output pump), other
+coroutines, or lists of them to wait for all. It returns a value with
+`raise Return(value)`:
+
+    def uptime(instance):
+        env = yield machine_env_async(instance)
+        out = yield local_async("uptime", env=env, capture=True)
+        raise Return(out)
+
+    run(uptime("storm-aws-0-abcd1234"))
+
+Cancelling a task throws CancelledError into it and kills the child
+processes it started, Ctrl-C cancels the coroutine given to run(). Blocking
+calls (cloud SDKs, the Engine API, ...) go through blocking(), which runs
+them on a small thread pool.
+"""
+import os
+import sys
+import time
+import errno
+import fcntl
+import heapq
+import select
+import logging
+import itertools
+import threading
+import collections
+import types
+import concurrent.futures as futures
+from concurrent.futures import CancelledError
+
+log = logging.getLogger(__name__)
+
+BLOCKING_WORKERS = 32
+
+state = threading.local()
+
+executor = None
+executor_lock = threading.Lock()
+
+class Return(Exception):
+    """
+    Raised to return a value from a coroutine
+    """
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+def current_loop():
+    loop = getattr(state, "loop", None)
+    if loop is None:
+        raise RuntimeError("No event loop running in this thread")
+    return loop
+
+def current_task():
+    """
+    Task running in this thread, or the one a blocking() call was made from
+    """
+    return getattr(state, "task", None)
+
+class Task(futures.Future):
+    """
+    Coroutine running on a loop, a future for its result, `context` starts
+    as a copy of the spawning task's
+    """
+    def __init__(self, loop, coroutine):
+        futures.Future.__init__(self)
+        self.set_running_or_notify_cancel()
+        self.loop = loop
+        self.coroutine = coroutine
+        parent = current_task()
+        self.context = dict(parent.context) if parent is not None else {}
+        self.waiting = None
+        self.cancelling = False
+        self.lock = threading.Lock()
+        self.processes = set()
+
+    def __repr__(self):
+        return "<Task %s>" % getattr(self.coroutine, "__name__", self.coroutine)
+
+    def step(self, value=None, error=None):
+        if self.done():
+            return
+        previous = getattr(state, "task", None)
+        state.task = self
+        try:
+            if error is not None:
+                yielded = self.coroutine.throw(error)
+            else:
+                yielded = self.coroutine.send(value)
+        except Return as r:
+            self.set_result(r.value)
+        except StopIteration:
+            self.set_result(None)
+        except (Exception, SystemExit) as e:
+            # Fabric's abort() included, it reaches the caller like it would without coroutines
+            self.set_exception_info(e, sys.exc_info()[2])
+        else:
+            self.wait(yielded)
+        finally:
+            state.task = previous
+
+    def wait(self, yielded):
+        if isinstance(yielded, (list, tuple)):
+            yielded = gather(*yielded)
+        elif isinstance(yielded, types.GeneratorType):
+            yielded = self.loop.spawn(yielded)
+        if not isinstance(yielded, futures.Future):
+            error = TypeError("Coroutines must yield futures or coroutines, not %r" % (yielded,))
+            self.loop.call_soon(self.step, None, error)
+            return
+        self.waiting = yielded
+        yielded.add_done_callback(lambda future: self.loop.call_soon(self.resume, future))
+
+    def resume(self, future):
+        if future is not self.waiting:
+            return
+        self.waiting = None
+        try:
+            value = future.result()
+        except (Exception, SystemExit) as e:
+            self.step(error=e)
+        else:
+            self.step(value)
+
+    def cancel(self):
+        if self.done():
+            return False
+        self.loop.call_soon(self.interrupt)
+        return True
+
+    def interrupt(self):
+        if self.done() or self.cancelling:
+            return
+        self.cancelling = True
+        self.kill()
+        waiting, self.waiting = self.waiting, None
+        if waiting is not None:
+            # Tasks, gathers and queued calls stop, running work ignores it
+            waiting.cancel()
+        self.step(error=CancelledError())
+
+    def track(self, process):
+        """
+        Kill `process` if this task gets cancelled
+        """
+        with self.lock:
+            self.processes.add(process)
+        process.future.add_done_callback(lambda future: self.forget(process))
+        # Blocking calls of a cancelled task don't get to start anything new
+        if self.cancelling and getattr(state, "loop", None) is not self.loop:
+            process.kill()
+
+    def forget(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def kill(self):
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            process.kill()
+
+def failure(future):
+    """
+    Exception of a done future, cancellation included
+    """
+    try:
+        return future.exception()
+    except CancelledError as e:
+        return e
+
+class Gather(futures.Future):
+    """
+    Future for the results of several futures, the first failure fails it
+    unless exceptions are returned as results
+    """
+    def __init__(self, children, return_exceptions=False):
+        futures.Future.__init__(self)
+        self.set_running_or_notify_cancel()
+        self.children = children
+        self.return_exceptions = return_exceptions
+        self.remaining = len(children)
+        self.lock = threading.Lock()
+        if not children:
+            self.set_result([])
+        for child in children:
+            child.add_done_callback(self.child_done)
+
+    def child_done(self, child):
+        with self.lock:
+            if self.done():
+                return
+            error = failure(child)
+            if error is not None and not self.return_exceptions:
+                self.set_exception(error)
+                return
+            self.remaining -= 1
+            if self.remaining:
+                return
+        self.set_result([failure(future) or future.result() for future in self.children])
+
+    def cancel(self):
+        cancelled = [child.cancel() for child in self.children]
+        return any(cancelled)
+
+def gather(*items, **kwargs):
+    """
+    Wait for all futures and coroutines in `items`, running the coroutines
+    concurrently, with return_exceptions=True failures are returned too
+    """
+    loop = current_loop()
+    return Gather([loop.spawn(item) if isinstance(item, types.GeneratorType) else item for item in items],
+                  return_exceptions=kwargs.get("return_exceptions", False))
+
+def first(*items):
+    """
+    Wait for whichever of `items` (futures and coroutines) is done first and
+    return it, the others keep going
+    """
+    loop = current_loop()
+    children = [loop.spawn(item) if isinstance(item, types.GeneratorType) else item for item in items]
+    result = futures.Future()
+    result.set_running_or_notify_cancel()
+    lock = threading.Lock()
+
+    def done(child):
+        with lock:
+            if result.done():
+                return
+            result.set_result(child)
+    for child in children:
+        child.add_done_callback(done)
+    return result
+
+class Loop(object):
+    """
+    Runs ready callbacks, timers and coroutine steps on one thread
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = collections.deque()
+        self.timers = []
+        self.counter = itertools.count()
+        self.closed = False
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def call_soon(self, callback, *args):
+        """
+        Run `callback` on the loop, can be called from any thread
+        """
+        with self.lock:
+            # Work finishing after run() returned has nobody waiting for it
+            if self.closed:
+                return
+            self.ready.append((callback, args))
+            try:
+                os.write(self.wakeup[1], "x")
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def call_later(self, delay, callback, *args):
+        heapq.heappush(self.timers, (time.time() + delay, next(self.counter), callback, args))
+
+    def spawn(self, coroutine):
+        task = Task(self, coroutine)
+        self.call_soon(task.step)
+        return task
+
+    def run(self, coroutine):
+        """
+        Run `coroutine` to completion and return its result
+        """
+        previous = getattr(state, "loop", None)
+        state.loop = self
+        main = self.spawn(coroutine)
+        interrupted = None
+        try:
+            while not main.done():
+                try:
+                    self.run_once()
+                except KeyboardInterrupt as e:
+                    interrupted = e
+                    main.cancel()
+        finally:
+            state.loop = previous
+            with self.lock:
+                self.closed = True
+                for fd in self.wakeup:
+                    os.close(fd)
+        if interrupted is not None:
+            raise interrupted
+        return main.result()
+
+    def run_once(self):
+        with self.lock:
+            timeout = 0 if self.ready else None
+        if timeout is None and self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+
+        try:
+            readable = select.select([self.wakeup[0]], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if readable:
+            try:
+                os.read(self.wakeup[0], 4096)
+            except OSError:
+                pass
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            with self.lock:
+                self.ready.append((callback, args))
+
+        with self.lock:
+            ready, self.ready = self.ready, collections.deque()
+        for callback, args in ready:
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("Error in event loop callback %r" % callback)
+
+def run(coroutine):
+    """
+    Run `coroutine` on a new event loop in this thread
+    """
+    return Loop().run(coroutine)
+
+def spawn(coroutine):
+    """
+    Start `coroutine` concurrently on the current loop, returns its Task
+    """
+    return current_loop().spawn(coroutine)
+
+def sleep(seconds, result=None):
+    future = futures.Future()
+
+    def wake():
+        if future.set_running_or_notify_cancel():
+            future.set_result(result)
+    current_loop().call_later(seconds, wake)
+    return future
+
+def blocking(fn, *args, **kwargs):
+    """
+    Future for fn(*args, **kwargs) run on the blocking call thread pool,
+    processes it starts belong to the calling task
+    """
+    global executor
+    task = current_task()
+    with executor_lock:
+        if executor is None:
+            executor = futures.ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+
+    def call():
+        state.task = task
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            state.task = None
+    return executor.submit(call)
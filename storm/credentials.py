@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Cloud provider credentials
+
+Credentials are read from ~/.storm the first time a provider needs them, and
+cached until one of their files changes, so rotated keys get picked up
+without restarting long-running processes.
+"""
+import os
+import logging
+import threading
+import ConfigParser
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+STORM_PATH = os.path.join(os.path.expanduser("~"), ".storm")
+
+AWSCredentials = namedtuple("AWSCredentials", ["access_key", "secret_key"])
+AzureCredentials = namedtuple("AzureCredentials", ["subscription_id", "certificate"])
+DigitalOceanCredentials = namedtuple("DigitalOceanCredentials", ["token"])
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def read_aws(credentials_path):
+    config = ConfigParser.ConfigParser()
+    config.read([str(credentials_path)])
+    return AWSCredentials(config.get('Credentials', 'aws_access_key_id'),
+                          config.get('Credentials', 'aws_secret_access_key'))
+
+def read_azure(subscription_id_path, certificate_path):
+    with open(subscription_id_path, 'r') as f:
+        subscription_id = f.read().splitlines()[0]
+    return AzureCredentials(subscription_id, certificate_path)
+
+def read_digitalocean(token_path):
+    with open(token_path, 'r') as f:
+        return DigitalOceanCredentials(f.read().splitlines()[0])
+
+class Credentials(object):
+    """
+    Lazily resolved, cached credentials for each cloud provider
+    """
+    def __init__(self, path=STORM_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def aws(self):
+        return self.resolve("aws", read_aws, AWSCredentials(None, None),
+                            os.path.join(self.path, "aws", "credentials"))
+
+    def azure(self):
+        return self.resolve("azure", read_azure, AzureCredentials(None, None),
+                            os.path.join(self.path, "azure", "subscription-id"),
+                            os.path.join(self.path, "azure", "certificate.pem"))
+
+    def digitalocean(self):
+        return self.resolve("digitalocean", read_digitalocean, DigitalOceanCredentials(None),
+                            os.path.join(self.path, "digitalocean", "token"))
+
+    def invalidate(self, provider=None):
+        with self.lock:
+            if provider:
+                self.cache.pop(provider, None)
+            else:
+                self.cache.clear()
+
+    def resolve(self, provider, reader, missing, *paths):
+        """
+        Return cached credentials for `provider` unless one of `paths` was
+        modified, created or removed since they were read
+        """
+        stamp = tuple(mtime(path) for path in paths)
+        with self.lock:
+            cached = self.cache.get(provider)
+            if cached and cached[0] == stamp:
+                return cached[1]
+
+        try:
+            value = reader(*paths)
+        except Exception as e:
+            log.debug("Unable to read %s credentials in %s: %r" % (provider, os.path.dirname(paths[0]), e))
+            value = missing
+
+        with self.lock:
+            self.cache[provider] = (stamp, value)
+        return value
+
+
+credentials = Credentials()
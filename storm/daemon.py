@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Storm daemon
+
+`docker-storm serve` keeps the inventory and machine environments warm in a
+long-lived process and answers `ps` and `env` over a Unix socket.
+`docker-storm` forwards those commands to it when it is running, and falls
+back to running them itself otherwise. docker-compose passthrough commands
+(`logs -f`, `up` without `-d`...) can run for as long as they like and
+always run locally, with their output going straight to the terminal.
+"""
+import os
+import json
+import time
+import errno
+import socket
+import signal
+import logging
+import threading
+import SocketServer
+
+from tasks import docker, machine_env, machine_exports, environments
+from inventory import Inventory
+
+log = logging.getLogger(__name__)
+
+SOCKET_PATH = os.path.join(os.path.expanduser("~"), ".storm", "storm.sock")
+
+# Commands answered by the daemon, the rest always runs locally
+FORWARDED = ["ps", "env"]
+
+class DaemonError(Exception):
+    pass
+
+class State(object):
+    """
+    Inventory and machine environments kept warm between requests
+    """
+    def __init__(self, refresh=30):
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.inventory = None
+        self.loaded = 0
+
+    def get_inventory(self):
+        with self.lock:
+            if self.inventory is None or time.time() - self.loaded > self.refresh:
+                inventory = Inventory(refresh=True)
+                if self.inventory is not None:
+                    for name in set(self.inventory.entries) - set(inventory.entries):
+                        environments.invalidate(name)
+                self.inventory = inventory
+                self.loaded = time.time()
+            return self.inventory
+
+    def invalidate(self):
+        with self.lock:
+            self.inventory = None
+        environments.invalidate()
+
+    def environment(self, instance, swarm=False):
+        env = machine_env(instance, swarm=swarm)
+        if not env:
+            raise DaemonError("Error getting machine environment for %s" % instance)
+        return env
+
+    def export(self, instance, swarm=False):
+        out = machine_exports(instance, swarm=swarm)
+        if not out:
+            raise DaemonError("Error getting machine environment for %s" % instance)
+        return out
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            output = self.server.dispatch(request)
+            response = {"output": output}
+        except Exception as e:
+            log.exception("Error handling request")
+            response = {"error": "%s" % e}
+        self.wfile.write(json.dumps(response) + "\n")
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET_PATH, refresh=30):
+        self.path = path
+        self.state = State(refresh)
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def warm(self):
+        """
+        Keep the inventory loaded, refreshing it in the background
+        """
+        while True:
+            try:
+                self.state.get_inventory()
+            except Exception as e:
+                log.warn("Error refreshing inventory: %r" % e)
+            time.sleep(self.state.refresh)
+
+    def dispatch(self, request):
+        command = request["command"]
+        parameters = request.get("parameters", [])
+
+        if command == "invalidate":
+            self.state.invalidate()
+            return ""
+        elif command == "ping":
+            return "pong"
+
+        inventory = self.state.get_inventory()
+        if command == "env":
+            if parameters[0] == 'swarm':
+                return self.state.export(inventory.master, swarm=True)
+            elif parameters[0] == 'discovery':
+                return self.state.export(inventory.get("discovery", int(parameters[1])).name)
+            else:
+                return self.state.export(inventory.get("host", int(parameters[0])).name)
+
+        if command != "ps":
+            raise DaemonError("Command %s is not handled by the daemon" % command)
+
+        discovery_host = inventory.discovery_ip  # FIXME
+        master_instance = inventory.master  # FIXME too
+        env = self.state.environment(master_instance, swarm=True)
+        env["DISCOVERY_IP"] = discovery_host
+
+        out = docker("ps " + " ".join(parameters), threadName="ps swarm %s" % master_instance, capture=True, env=env)
+        # The command ran, a failure must not send the client running it again
+        if out is None:
+            raise DaemonError("Command %s failed on %s" % (command, master_instance))
+        return out
+
+def serve(path=SOCKET_PATH, refresh=30):
+    """
+    Run the daemon in the foreground until interrupted
+    """
+    if request("ping", path=path) is not None:
+        raise DaemonError("Already running on %s" % path)
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = Server(path, refresh)
+    os.chmod(path, 0600)
+
+    warm = threading.Thread(target=server.warm, name="warm inventory")
+    warm.daemon = True
+    warm.start()
+
+    def stop(signum, frame):
+        raise SystemExit
+    signal.signal(signal.SIGTERM, stop)
+
+    log.info("Listening on %s" % path)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def request(command, parameters=None, path=SOCKET_PATH):
+    """
+    Send a command to the daemon, returns None if it isn't running
+    """
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    try:
+        sock.sendall(json.dumps({
+            "command": command,
+            "parameters": parameters or [],
+            "cwd": os.getcwd()
+        }) + "\n")
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        sock.close()
+
+    response = json.loads("".join(data))
+    if "error" in response:
+        raise DaemonError(response["error"])
+    return response["output"]
+
+def forward(command, parameters):
+    """
+    Run a command through the daemon if possible, returns None when it has
+    to run locally
+    """
+    if command not in FORWARDED:
+        return None
+    return request(command, parameters)
+
+def notify_changed():
+    """
+    Tell a running daemon that machines were added or removed
+    """
+    try:
+        request("invalidate")
+    except (socket.error, DaemonError) as e:
+        log.debug("Could not notify daemon: %r" % e)
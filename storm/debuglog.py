@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Asynchronous debug log
+
+Records are handed over to a queue and written by a single background thread
+in batches, so threads streaming subprocess output never wait on the disk.
+The log file is rotated by size instead of on every invocation.
+"""
+import os
+import Queue
+import logging
+import threading
+
+STOP = object()
+
+class AsyncFileHandler(logging.Handler):
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5, batch_size=1024):
+        logging.Handler.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.stream = None
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            self.queue.put(self.prepare(record))
+            if self.writer is None:
+                self.start()
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        """
+        Resolve the message and traceback in the calling thread, arguments
+        could be mutated by the time the writer gets to them
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def start(self):
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name="debug log writer")
+                self.writer.daemon = True
+                self.writer.start()
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch_size:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stop = STOP in records
+            batch = [record for record in records if record is not STOP]
+            try:
+                self.write(batch)
+            except Exception:
+                self.handleError(batch[0])
+            finally:
+                for _ in records:
+                    self.queue.task_done()
+            if stop:
+                break
+
+    def write(self, records):
+        if not records:
+            return
+        if self.stream is None:
+            self.stream = self.open()
+
+        size = self.stream.tell()
+        chunk = []
+        for record in records:
+            line = "%s\n" % self.format(record)
+            if isinstance(line, unicode):
+                line = line.encode("utf-8", "replace")
+            if self.max_bytes and size and size + len(line) > self.max_bytes:
+                self.stream.write("".join(chunk))
+                self.rollover()
+                size = 0
+                chunk = []
+            chunk.append(line)
+            size += len(line)
+        self.stream.write("".join(chunk))
+        self.stream.flush()
+
+    def open(self):
+        path = os.path.dirname(self.filename)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        stream = open(self.filename, "a")
+        stream.seek(0, os.SEEK_END)
+        return stream
+
+    def rollover(self):
+        self.stream.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (self.filename, i)
+            target = "%s.%d" % (self.filename, i + 1)
+            if os.path.exists(source):
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+        if self.backup_count > 0:
+            target = "%s.1" % self.filename
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(self.filename, target)
+        self.stream = open(self.filename, "w")
+
+    def flush(self):
+        """
+        Wait for queued records to be written
+        """
+        if self.writer is not None and self.writer.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.writer is not None and self.writer.is_alive():
+            self.queue.put(STOP)
+            self.writer.join()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        logging.Handler.close(self)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Docker Engine API client
+
+Talks to remote Docker daemons directly, keeping a pool of keep-alive TLS
+connections per host instead of spawning a `docker` process (and doing a
+new TLS handshake) for every operation.
+"""
+import os
+import ssl
+import json
+import shlex
+import socket
+import select
+import urllib
+import httplib
+import logging
+import threading
+import urlparse
+
+log = logging.getLogger(__name__)
+
+ENGINE_TIMEOUT = 60
+POOL_SIZE = 8
+
+# Failures talking to the daemon (or reading certificates), reported as EngineError
+TRANSPORT_ERRORS = (httplib.HTTPException, socket.error, ssl.SSLError, IOError)
+
+# Requests that can be sent again if the daemon may have seen them already
+IDEMPOTENT = ("GET", "HEAD", "DELETE")
+
+class EngineError(Exception):
+    def __init__(self, status, message):
+        super(EngineError, self).__init__("%s (%s)" % (message, status) if status else message)
+        self.status = status
+        self.message = message
+
+class UnsupportedOptions(ValueError):
+    pass
+
+def tls_context(cert_path):
+    """
+    TLS context from the ca.pem, cert.pem and key.pem in `cert_path`
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = False
+    context.load_verify_locations(os.path.join(cert_path, "ca.pem"))
+    context.load_cert_chain(os.path.join(cert_path, "cert.pem"), os.path.join(cert_path, "key.pem"))
+    return context
+
+def split_image(image):
+    """
+    Split an image reference into name and tag for /images/create
+    """
+    name, _, tag = image.rpartition(":")
+    if not name or "/" in tag:
+        return image, "latest"
+    return name, tag
+
+def parse_run_options(options):
+    """
+    Translate `docker run` options into create parameters, only what storm
+    uses is supported, anything else raises UnsupportedOptions
+    """
+    config = {}
+    host_config = {}
+    detach = False
+    args = shlex.split(options or "")
+    while args:
+        arg = args.pop(0)
+        value = None
+        if arg.startswith("--") and "=" in arg:
+            arg, value = arg.split("=", 1)
+        if arg in ("-d", "--detach"):
+            detach = True
+            continue
+        if arg not in ("-p", "--publish", "-e", "--env", "-v", "--volume", "-l", "--label",
+                       "--restart", "--net", "--name"):
+            raise UnsupportedOptions("Unsupported run option %s" % arg)
+        if value is None:
+            if not args:
+                raise UnsupportedOptions("Missing value for %s" % arg)
+            value = args.pop(0)
+
+        if arg in ("-p", "--publish"):
+            mapping, _, protocol = value.partition("/")
+            parts = mapping.split(":")
+            container_port = "%s/%s" % (parts[-1], protocol or "tcp")
+            binding = {"HostIp": parts[0] if len(parts) == 3 else "",
+                       "HostPort": parts[-2] if len(parts) > 1 else ""}
+            config.setdefault("ExposedPorts", {})[container_port] = {}
+            host_config.setdefault("PortBindings", {}).setdefault(container_port, []).append(binding)
+        elif arg in ("-e", "--env"):
+            config.setdefault("Env", []).append(value)
+        elif arg in ("-v", "--volume"):
+            host_config.setdefault("Binds", []).append(value)
+        elif arg in ("-l", "--label"):
+            key, _, label = value.partition("=")
+            config.setdefault("Labels", {})[key] = label
+        elif arg == "--restart":
+            name, _, retries = value.partition(":")
+            host_config["RestartPolicy"] = {"Name": name, "MaximumRetryCount": int(retries or 0)}
+        elif arg == "--net":
+            host_config["NetworkMode"] = value
+        elif arg == "--name":
+            config["name"] = value
+
+    if not detach:
+        raise UnsupportedOptions("Only detached containers are supported")
+    if host_config:
+        config["HostConfig"] = host_config
+    return config
+
+class Engine(object):
+    """
+    Engine API client for one Docker host
+    """
+    def __init__(self, host, port=2376, cert_path=None, tls=True, timeout=ENGINE_TIMEOUT, pool_size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.cert_path = cert_path
+        self.tls = tls
+        self.context = None
+        self.lock = threading.Lock()
+        self.pool = []
+
+    def __repr__(self):
+        return "<Engine %s:%s>" % (self.host, self.port)
+
+    def connect(self):
+        if self.tls:
+            if self.context is None:
+                self.context = tls_context(self.cert_path)
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.context)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def acquire(self):
+        with self.lock:
+            while self.pool:
+                connection = self.pool.pop()
+                # An idle connection with something to read was closed by the daemon
+                if connection.sock and not select.select([connection.sock], [], [], 0)[0]:
+                    return connection, True
+                connection.close()
+        return self.connect(), False
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path, params=None, body=None):
+        """
+        Send a request, returns (status, decoded JSON body or None)
+        """
+        if params:
+            path = "%s?%s" % (path, urllib.urlencode(params))
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        connection = None
+        try:
+            connection, reused = self.acquire()
+            sent = False
+            try:
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+            except TRANSPORT_ERRORS:
+                connection.close()
+                # A container created or started twice isn't a retry
+                if not reused or (sent and method not in IDEMPOTENT):
+                    raise
+                # The daemon closed an idle connection, try again on a new one
+                connection = self.connect()
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            data = response.read()
+        except TRANSPORT_ERRORS as e:
+            if connection:
+                connection.close()
+            raise EngineError(None, "%s %s: %s" % (method, path, str(e) or e.__class__.__name__))
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(connection)
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get("message", data)
+            except ValueError:
+                message = data.strip()
+            raise EngineError(response.status, message)
+
+        content_type = response.getheader("Content-Type", "")
+        if data and "json" in content_type:
+            try:
+                return response.status, json.loads(data)
+            except ValueError:
+                # Progress streams are one JSON document per line
+                return response.status, [json.loads(line) for line in data.splitlines() if line.strip()]
+        return response.status, None
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for connection in pool:
+            connection.close()
+
+    def version(self):
+        return self.request("GET", "/version")[1]
+
+    def ps(self, all=False, filters=None):
+        params = {"all": 1 if all else 0}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        return self.request("GET", "/containers/json", params)[1]
+
+    def inspect(self, container):
+        return self.request("GET", "/containers/%s/json" % container)[1]
+
+    def pull(self, image):
+        name, tag = split_image(image)
+        status, events = self.request("POST", "/images/create", {"fromImage": name, "tag": tag})
+        for event in events or []:
+            if isinstance(event, dict) and event.get("error"):
+                raise EngineError(500, event["error"])
+        return events
+
+    def create(self, image, name=None, command=None, config=None):
+        body = dict(config or {})
+        body.pop("name", None)
+        body["Image"] = image
+        if command:
+            body["Cmd"] = shlex.split(command) if isinstance(command, basestring) else command
+        params = {"name": name} if name else None
+        try:
+            return self.request("POST", "/containers/create", params, body)[1]
+        except EngineError as e:
+            if e.status != 404:
+                raise
+        # Pull missing images like `docker run` does
+        self.pull(image)
+        return self.request("POST", "/containers/create", params, body)[1]
+
+    def start(self, container):
+        self.request("POST", "/containers/%s/start" % container)
+
+    def run(self, image, options="", command="", name=None):
+        """
+        Create and start a detached container from `docker run` options
+        """
+        config = parse_run_options(options)
+        container = self.create(image, name=name or config.get("name"), command=command, config=config)
+        self.start(container["Id"])
+        return container["Id"]
+
+    def stop(self, container, timeout=30):
+        self.request("POST", "/containers/%s/stop" % container, {"t": timeout})
+
+    def rm(self, container, force=False):
+        self.request("DELETE", "/containers/%s" % container, {"force": 1 if force else 0})
+
+
+engines = {}
+engines_lock = threading.Lock()
+
+def engine_for(env, timeout=ENGINE_TIMEOUT):
+    """
+    Shared Engine for a Docker client environment (DOCKER_HOST, ...)
+    """
+    url = urlparse.urlparse(env["DOCKER_HOST"])
+    tls = env.get("DOCKER_TLS_VERIFY") == "1"
+    key = (url.hostname, url.port, env.get("DOCKER_CERT_PATH"), tls)
+    with engines_lock:
+        if key not in engines:
+            engines[key] = Engine(url.hostname, url.port or 2376, cert_path=env.get("DOCKER_CERT_PATH"),
+                                  tls=tls, timeout=timeout)
+        return engines[key]
+
+def discard(cert_path=None):
+    """
+    Close and forget engines of a removed or recreated machine, or all of them
+    """
+    with engines_lock:
+        for key in engines.keys():
+            if cert_path is None or key[2] == cert_path:
+                engines.pop(key).close()
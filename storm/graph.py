@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Task graphs
+
+A graph starts each of its nodes as soon as the nodes it depends on are
+done instead of phase by phase, so one slow machine only holds up what
+actually needs it. A node is a name, what it's waiting for and a function
+returning what to yield for it (a coroutine or a future):
+
+    graph = Graph()
+    graph.add("launch a", lambda: create_async(a))
+    graph.add("launch b", lambda: create_async(b))
+    graph.add("prepare a", lambda: prepare_haproxy_instance("a"), after=["launch a"])
+    graph.add("registrator", deploy, after=["launch a", "launch b"])
+    run(graph.run())
+
+The first failure cancels the nodes still running and is raised. Once done,
+report() logs the critical path: the chain of nodes, each one the last the
+next was waiting for, that the whole run took as long as.
+"""
+import sys
+import time
+import logging
+import collections
+import concurrent.futures as futures
+
+import trace
+from coroutines import Return, spawn, gather, failure
+
+log = logging.getLogger(__name__)
+
+class GraphError(Exception):
+    pass
+
+class Node(object):
+    def __init__(self, name, start, after, phase):
+        self.name = name
+        self.start = start
+        self.after = list(after)
+        self.phase = phase
+        self.started = None
+        self.ended = None
+
+    @property
+    def duration(self):
+        return self.ended - self.started
+
+class Graph(object):
+    def __init__(self):
+        self.nodes = collections.OrderedDict()
+        self.started = None
+        self.failed = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def add(self, name, start, after=(), phase=None):
+        """
+        Add a node running start() once everything in `after` is done,
+        processes it starts are traced under `phase`
+        """
+        if name in self.nodes:
+            raise GraphError("Duplicate node %s" % name)
+        self.nodes[name] = Node(name, start, after, phase)
+        return name
+
+    def check(self):
+        """
+        Raise GraphError for unknown dependencies and cycles
+        """
+        for node in self.nodes.values():
+            for name in node.after:
+                if name not in self.nodes:
+                    raise GraphError("%s depends on unknown node %s" % (node.name, name))
+        waiting = dict((name, set(node.after)) for name, node in self.nodes.items())
+        while waiting:
+            ready = [name for name, after in waiting.items() if not after]
+            if not ready:
+                raise GraphError("Cycle between %s" % ", ".join(sorted(waiting)))
+            for name in ready:
+                del waiting[name]
+            for after in waiting.values():
+                after.difference_update(ready)
+
+    def execute(self, node):
+        node.started = time.time()
+        try:
+            with trace.phase(node.phase or node.name):
+                result = yield node.start()
+        finally:
+            node.ended = time.time()
+        raise Return(result)
+
+    def run(self, context=None):
+        """
+        Coroutine running every node, returns their results by name,
+        advancing `context` (a TaskContext) a step per node
+        """
+        self.check()
+        self.started = time.time()
+        waiting = dict((name, set(node.after)) for name, node in self.nodes.items())
+        running = {}
+        finished = collections.deque()
+        results = {}
+        wakeup = [None]
+
+        def done(name, task):
+            finished.append((name, task))
+            if wakeup[0] is not None and not wakeup[0].done():
+                wakeup[0].set_running_or_notify_cancel()
+                wakeup[0].set_result(None)
+
+        try:
+            while waiting or running:
+                for name in [name for name in self.nodes if name in waiting and not waiting[name]]:
+                    del waiting[name]
+                    running[name] = spawn(self.execute(self.nodes[name]))
+                    running[name].add_done_callback(lambda task, name=name: done(name, task))
+                if not finished:
+                    wakeup[0] = futures.Future()
+                    yield wakeup[0]
+                while finished:
+                    name, task = finished.popleft()
+                    del running[name]
+                    if failure(task) is not None:
+                        self.failed = name
+                    results[name] = task.result()
+                    for after in waiting.values():
+                        after.discard(name)
+                    if context:
+                        node = self.nodes[name]
+                        context.step(name, node.duration)
+                        context.advance(1)
+        except BaseException:
+            error = sys.exc_info()
+            if context:
+                context.cancel()
+            tasks = running.values()
+            for task in tasks:
+                task.cancel()
+            yield gather(*tasks, return_exceptions=True)
+            raise error[0], error[1], error[2]
+        raise Return(results)
+
+    def critical_path(self):
+        """
+        Nodes from the first to the one that ended last, each one the
+        dependency its successor waited for the longest
+        """
+        ended = [node for node in self.nodes.values() if node.ended is not None]
+        if not ended:
+            return []
+        node = max(ended, key=lambda node: node.ended)
+        path = [node]
+        while node.after:
+            node = max((self.nodes[name] for name in node.after), key=lambda node: node.ended)
+            path.append(node)
+        path.reverse()
+        return path
+
+    def report(self, title="Duration"):
+        path = self.critical_path()
+        if not path:
+            return
+        log.info("%s: %.1fs" % (title, path[-1].ended - self.started))
+        log.info("Critical path: %s" % " > ".join("%s (%.1fs)" % (node.name, node.duration) for node in path))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Hedged launches
+
+With a `hedge` section in storm.yml, machines of a batch (the discovery
+instances or the hosts of a deploy, the instances of a launch) that are
+still not ready well after most of the batch is get a replacement created
+next to them. Whichever is ready first is kept under the machine's name,
+the other one is removed:
+
+    hedge:
+      percentile: 90    # once this share of the batch is ready...
+      factor: 1.5       # ...replace what takes this many times longer than it did
+      min_delay: 120    # never before this many seconds
+      max_fraction: 0.2 # replacements for at most this share of the batch
+
+`hedge: true` uses these defaults. Replacements are renamed in the
+docker-machine store when they win, so like the standby pool it only works
+for providers whose machines can be renamed.
+"""
+import math
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "percentile": 90,
+    "factor": 1.5,
+    "min_delay": 120,
+    "max_fraction": 0.2
+}
+
+# Azure machines are known by their cloud service name
+PROVIDERS = ("aws", "digitalocean")
+
+POLL_INTERVAL = 1
+
+def settings(configured):
+    """
+    Policy from the `hedge` section of storm.yml, None when not hedging
+    """
+    if not configured:
+        return None
+    options = dict(DEFAULTS)
+    if isinstance(configured, dict):
+        options.update((key, value) for key, value in configured.items() if key in DEFAULTS)
+    return options
+
+class Hedge(object):
+    """
+    Launch times of a batch of `total` machines, and the replacements left
+    """
+    def __init__(self, total, percentile, factor, min_delay, max_fraction):
+        self.total = total
+        self.percentile = percentile
+        self.factor = factor
+        self.min_delay = min_delay
+        self.remaining = max(1, int(math.ceil(total * max_fraction)))
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def record(self, duration):
+        with self.lock:
+            self.durations.append(duration)
+
+    def deadline(self):
+        """
+        Seconds after which a machine gets replaced, None until enough of
+        the batch is ready to tell
+        """
+        with self.lock:
+            needed = max(1, int(math.ceil(self.total * self.percentile / 100.0)))
+            if len(self.durations) < needed:
+                return None
+            return max(self.min_delay, sorted(self.durations)[needed - 1] * self.factor)
+
+    def take(self):
+        """
+        Whether there's a replacement left to launch, taking it
+        """
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+def for_batch(configured, total):
+    """
+    Hedge for a batch of `total` machines, None when not hedging
+    """
+    options = settings(configured)
+    if options is None:
+        return None
+    return Hedge(total, **options)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Inventory of machines managed by storm
+
+Machines are read from the docker-machine store by default, `probe=True`
+asks `docker-machine ls` instead, which checks every machine over the
+network. Either way the result is kept in ~/.storm/inventory.json for
+STORM_INVENTORY_TTL seconds (300 by default), commands that add or remove
+machines update it as they go, and `refresh=True` bypasses it.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+
+import store
+
+log = logging.getLogger(__name__)
+
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".storm", "inventory.json")
+CACHE_TTL = int(os.environ.get("STORM_INVENTORY_TTL", 300))
+
+cache_lock = threading.Lock()
+
+Entry = namedtuple("Entry", ["name", "ip", "role", "provider", "group", "ordinal"])
+
+def parse_name(name, ip=None):
+    """
+    Split names like consul-aws-0-abcd1234 or storm-aws-1-2-abcd1234 (with a
+    location group) into an Entry, machines launched by hand get no
+    provider, group or ordinal
+    """
+    role = "discovery" if name.startswith("consul-") else "host"
+    fields = name.split("-")
+    try:
+        if len(fields) == 5:
+            return Entry(name, ip, role, fields[1], int(fields[2]), int(fields[3]))
+        elif len(fields) == 4:
+            return Entry(name, ip, role, fields[1], 0, int(fields[2]))
+    except ValueError:
+        pass
+    return Entry(name, ip, role, None, None, None)
+
+def sort_key(entry):
+    return (entry.provider is None, entry.provider, entry.group, entry.ordinal, entry.name)
+
+class Inventory(object):
+    """
+    Machines indexed by role ("discovery" or "host"), provider and location
+    group, in a stable order: provider, group, ordinal, then name
+    """
+    def __init__(self, probe=False, refresh=False, ttl=CACHE_TTL):
+        machines = None
+        if not refresh and not probe:
+            machines = load_cache(ttl)
+
+        if machines is None:
+            if probe:
+                machines = self.probe_machines()
+            else:
+                machines = self.parse_machines()
+            save_cache(machines)
+
+        self.index(machines)
+
+    def index(self, machines):
+        entries = [parse_name(name, ip) for name, ip in machines['discovery'].items()]
+        entries += [parse_name(name, ip) for name, ip in machines['instances'].items()]
+        entries.sort(key=sort_key)
+
+        self.entries = {}
+        self.groups = {}
+        for entry in entries:
+            self.entries[entry.name] = entry
+            for key in ((entry.role,),
+                        (entry.role, entry.provider),
+                        (entry.role, entry.provider, entry.group)):
+                self.groups.setdefault(key, []).append(entry)
+
+        self.discovery = OrderedDict((entry.name, entry.ip) for entry in self.select("discovery"))
+        self.instances = OrderedDict((entry.name, entry.ip) for entry in self.select("host"))
+
+    def select(self, role, provider=None, group=None):
+        """
+        Entries for a role, optionally for one provider and location group
+        """
+        if group is not None:
+            key = (role, provider, group)
+        elif provider is not None:
+            key = (role, provider)
+        else:
+            key = (role,)
+        return self.groups.get(key, [])
+
+    def get(self, role, index=0, provider=None, group=None):
+        """
+        Entry at `index` in the selection, raises IndexError if there's none
+        """
+        entries = self.select(role, provider, group)
+        if not entries:
+            raise IndexError("No %s machine%s%s" % (role,
+                                                    " on %s" % provider if provider else "",
+                                                    " in group %d" % group if group is not None else ""))
+        return entries[index]
+
+    @property
+    def master(self):
+        """
+        Name of the swarm master, the first host
+        """
+        return self.get("host").name
+
+    @property
+    def discovery_ip(self):
+        """
+        Address of the first discovery instance
+        """
+        return self.get("discovery").ip
+
+    def parse_machines(self):
+        parsed = {}
+        discovery = {}
+        instances = {}
+
+        for mach in store.machines():
+            if mach.name.startswith('consul-'):
+                discovery.update({mach.name: mach.ip})
+            else:
+                instances.update({mach.name: mach.ip})
+
+        parsed['discovery'] = discovery
+        parsed['instances'] = instances
+
+        return parsed
+
+    def probe_machines(self):
+        from tasks import machine_list
+
+        machines = machine_list().splitlines()[1:]
+        parsed = {}
+        discovery = {}
+        instances = {}
+
+        for mach in machines:
+            fields = mach.split()
+            ip = fields[4][6:-5]
+            if mach.startswith('consul-'):
+                discovery.update({fields[0]: ip})
+            else:
+                instances.update({fields[0]: ip})
+
+        parsed['discovery'] = discovery
+        parsed['instances'] = instances
+
+        return parsed
+
+def load_cache(ttl=CACHE_TTL, path=CACHE_PATH):
+    """
+    Return cached machines if they're fresher than `ttl` seconds
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if time.time() - cached.get("updated", 0) > ttl:
+        log.debug("Inventory cache expired")
+        return None
+    return {
+        "discovery": dict((str(name), str(ip) if ip else None) for name, ip in cached["discovery"].items()),
+        "instances": dict((str(name), str(ip) if ip else None) for name, ip in cached["instances"].items())
+    }
+
+def save_cache(machines, path=CACHE_PATH):
+    cached = {
+        "updated": time.time(),
+        "discovery": machines["discovery"],
+        "instances": machines["instances"]
+    }
+    try:
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(cached, f, indent=2)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write inventory cache: %r" % e)
+
+def update_cache(names, path=CACHE_PATH):
+    """
+    Write-through for machines that were created, stopped or removed,
+    re-reading each of them from the docker-machine store
+    """
+    with cache_lock:
+        machines = load_cache(path=path)
+        if machines is None:
+            return
+        for name in names:
+            role = "discovery" if name.startswith("consul-") else "instances"
+            machine = store.load(name)
+            if machine is None:
+                machines[role].pop(name, None)
+            else:
+                machines[role][name] = machine.ip
+        save_cache(machines, path=path)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Lazy imports for heavy dependencies
+
+Cloud SDKs, Fabric and the progress bar / log formatting libraries are only
+imported the first time one of their attributes is used, so quick commands
+like `env` and `ls` don't pay for modules they never touch.
+"""
+import sys
+import threading
+import importlib
+
+_lock = threading.RLock()
+
+class LazyModule(object):
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._hooks = []
+
+    def __repr__(self):
+        return "<lazy module '%s'%s>" % (self._name, " (loaded)" if self._module else "")
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def when_loaded(self, hook):
+        """
+        Call `hook(module)` once the module gets imported, right away if it
+        already is
+        """
+        with _lock:
+            if self._module is None and self._name not in sys.modules:
+                self._hooks.append(hook)
+                return
+        hook(self._load())
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    self._module = module
+                    hooks, self._hooks = self._hooks, []
+                    for hook in hooks:
+                        hook(module)
+        return self._module
+
+def lazy_import(name):
+    """
+    Return a placeholder for module `name` that imports it on first use
+    """
+    return LazyModule(name)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Standby pool
+
+`docker-storm pool fill` creates machines ahead of time from the `pool`
+section of storm.yml, swarm-ready with the cluster's discovery and labelled
+com.storm.standby=true instead of com.storm.managed=true so they're not
+part of the inventory:
+
+    pool:
+      digitalocean:
+        standby: 3
+        size: 512mb
+
+Creating a machine with the same provider and options (deploy, launch)
+claims a standby one instead: it's renamed in the docker-machine store and
+labelled as managed, which takes moments instead of minutes, and refill()
+starts a background `docker-storm pool fill` to replace it. The engine
+itself keeps its standby label until the machine is provisioned again.
+Azure machines are known by their cloud service name and can't be renamed,
+they're never pooled.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+
+import store
+from credentials import STORM_PATH
+
+log = logging.getLogger(__name__)
+
+POOL_PATH = os.path.join(STORM_PATH, "pool.json")
+LOG_PATH = os.path.join(STORM_PATH, "pool.log")
+
+STANDBY_LABEL = "com.storm.standby=true"
+PROVIDERS = ("aws", "digitalocean")
+
+pool_lock = threading.Lock()
+
+# Machines claimed by this process, to refill
+claimed = []
+
+@contextmanager
+def locked(path=POOL_PATH):
+    """
+    Exclusive access to the pool, across processes too
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with pool_lock:
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+def load(path=POOL_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save(records, path=POOL_PATH):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(records, f, indent=2)
+    os.rename(tmp, path)
+
+def key(provider, options):
+    """
+    Machines are interchangeable when their provider and create options are
+    """
+    return json.dumps([provider, options], sort_keys=True)
+
+def add(name, provider, options):
+    with locked():
+        records = load()
+        records[name] = {"provider": provider, "options": options, "key": key(provider, options), "created": time.time()}
+        save(records)
+
+def forget(names):
+    with locked():
+        records = load()
+        for name in names:
+            records.pop(name, None)
+        save(records)
+
+def standby(provider=None, options=None):
+    """
+    Names of standby machines, of a provider with given options if any
+    """
+    records = load()
+    if provider is None:
+        return sorted(records)
+    return sorted(name for name, entry in records.items() if entry["key"] == key(provider, options))
+
+def claim(name, provider, options, join=False):
+    """
+    Rename a standby machine with the same provider and options to `name`,
+    returns whether there was one. With `join` the machine is joined to the
+    swarm afterwards and its discovery doesn't matter.
+    """
+    if provider not in PROVIDERS:
+        return False
+    with locked():
+        records = load()
+        if join:
+            wanted = key(provider, dict(options, discovery=None))
+            matching = sorted(machine for machine, entry in records.items()
+                              if key(entry["provider"], dict(entry["options"], discovery=None)) == wanted)
+        else:
+            matching = sorted(machine for machine, entry in records.items() if entry["key"] == key(provider, options))
+        if not matching:
+            return False
+        machine = matching[0]
+        del records[machine]
+        save(records)
+
+    config = store.load(machine)
+    if config is None:
+        log.warn("Standby machine %s is gone from the store" % machine)
+        return False
+    labels = [store.MANAGED_LABEL if label == STANDBY_LABEL else label for label in config.labels]
+    try:
+        store.rename(machine, name, labels=labels)
+    except (IOError, OSError) as e:
+        log.warn("Could not claim standby machine %s: %s" % (machine, e))
+        return False
+    log.debug("Claimed standby machine %s as %s" % (machine, name))
+    claimed.append(name)
+    return True
+
+def refill():
+    """
+    Replace claimed machines in the background, with storm.yml from the
+    current directory
+    """
+    if not claimed or not os.path.exists("storm.yml"):
+        return
+    del claimed[:]
+    with open(LOG_PATH, "a") as output:
+        subprocess.Popen([sys.executable, "-c", "from storm.storm import main; main()", "pool", "fill"],
+                         stdin=open(os.devnull), stdout=output, stderr=subprocess.STDOUT,
+                         close_fds=True, preexec_fn=os.setsid)
+    log.info("Refilling the standby pool in the background, see %s" % LOG_PATH)
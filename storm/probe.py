@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Fleet health probe
+
+Checks every machine's Docker daemon and swarm agent in parallel, on at most
+STORM_PROBE_WORKERS threads (64 by default), all within one deadline, and
+yields results as hosts answer.
+"""
+import os
+import ssl
+import json
+import time
+import socket
+import httplib
+import logging
+import concurrent.futures as futures
+from collections import namedtuple
+
+import store
+from engine import tls_context
+
+log = logging.getLogger(__name__)
+
+PROBE_TIMEOUT = 5.0
+PROBE_WORKERS = int(os.environ.get("STORM_PROBE_WORKERS", 64))
+
+Result = namedtuple("Result", ["machine", "reachable", "version", "swarm", "error", "elapsed"])
+
+def engine_get(connection, path, deadline):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout("deadline exceeded")
+    if connection.sock:
+        connection.sock.settimeout(remaining)
+    connection.request("GET", path)
+    response = connection.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise httplib.HTTPException("%s returned %d" % (path, response.status))
+    return json.loads(body)
+
+def check(machine, timeout=PROBE_TIMEOUT, deadline=None):
+    """
+    Check the Docker daemon of `machine` and whether it runs a swarm agent,
+    giving up after `timeout` seconds or at `deadline`
+    """
+    start = time.time()
+    deadline = min(deadline or start + timeout, start + timeout)
+    if not machine.ip:
+        return Result(machine, False, None, None, "no address", 0)
+
+    connection = None
+    try:
+        connection = httplib.HTTPSConnection(machine.ip, store.engine_port(machine.config),
+                                             timeout=max(deadline - start, 0.001),
+                                             context=tls_context(machine.path))
+        version = engine_get(connection, "/version", deadline)["Version"]
+        containers = engine_get(connection, '/containers/json?filters={"name":["swarm-agent"]}', deadline)
+        names = set(name.lstrip("/") for container in containers for name in container.get("Names", []))
+        if "swarm-agent-master" in names:
+            swarm = "master"
+        elif "swarm-agent" in names:
+            swarm = "agent"
+        else:
+            swarm = None
+        return Result(machine, True, version, swarm, None, time.time() - start)
+    except (socket.error, ssl.SSLError, httplib.HTTPException, IOError, ValueError, KeyError) as e:
+        return Result(machine, False, None, None, str(e) or e.__class__.__name__, time.time() - start)
+    finally:
+        if connection:
+            connection.close()
+
+def probe(machines, timeout=PROBE_TIMEOUT, max_workers=PROBE_WORKERS):
+    """
+    Probe `machines` concurrently, yielding results as they come in, then
+    Result(reachable=None) for hosts that didn't answer in time
+    """
+    if not machines:
+        return
+
+    # The whole fleet shares one `timeout`, hosts still waiting for a worker
+    # when it's over count as timed out
+    deadline = time.time() + timeout
+    window = timeout + 1
+    executor = futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(machines))))
+    pending = dict((executor.submit(check, machine, timeout, deadline), machine) for machine in machines)
+    try:
+        for future in futures.as_completed(pending, window):
+            del pending[future]
+            yield future.result()
+    except futures.TimeoutError:
+        pass
+    finally:
+        executor.shutdown(wait=False)
+
+    for future, machine in sorted(pending.items(), key=lambda item: item[1].name):
+        future.cancel()
+        yield Result(machine, None, None, None, "timed out", window)
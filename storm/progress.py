@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Progress reporting
+
+Operations (see context.TaskContext) publish events, started, advanced,
+step done and finished, to a queue that a single reporter thread reads and
+renders, at most every RENDER_INTERVAL seconds and every TICK_INTERVAL
+seconds to keep timers moving. Workers never touch the terminal
+themselves.
+
+STORM_PROGRESS picks how: "bar" for progress bars, "json" for one JSON
+object per line (what CI wants to parse), "off" for nothing. It defaults to
+bars on a terminal and JSON lines otherwise:
+
+    {"event": "start", "id": 1, "operation": "Launch", "time": 1476680000.0, "total": 30}
+    {"completed": 12, "elapsed": 41.2, "event": "progress", "id": 1, "operation": "Launch", "total": 30}
+    {"duration": 12.5, "event": "step", "id": 2, "operation": "Deploy", "step": "consul consul-aws-0-ab12cd34"}
+    {"completed": 30, "elapsed": 95.7, "event": "finish", "id": 1, "operation": "Launch", "total": 30}
+"""
+import os
+import sys
+import json
+import time
+import Queue
+import logging
+import threading
+
+from lazy import lazy_import
+
+progressbar = lazy_import("progressbar")
+
+log = logging.getLogger(__name__)
+
+RENDER_INTERVAL = 0.2
+TICK_INTERVAL = 1.0
+
+MODES = ("bar", "json", "off")
+
+reporter = None
+reporter_lock = threading.Lock()
+
+def progress_bar(max_value, stream=None):
+    widgets = ['Progress: ', progressbar.Percentage(), '   ', progressbar.Timer(), ' ',
+               progressbar.Bar(marker='#', left='[', right=']'), ' ', progressbar.ETA()]
+    return progressbar.ProgressBar(widgets=widgets, max_value=max_value, fd=stream or sys.stderr).start()
+
+def default_mode(stream=None):
+    mode = os.environ.get("STORM_PROGRESS")
+    if mode in MODES:
+        return mode
+    stream = stream or sys.stderr
+    return "bar" if hasattr(stream, "isatty") and stream.isatty() else "json"
+
+class Operation(object):
+    """
+    What the reporter knows about one operation
+    """
+    def __init__(self, id, name, total, started):
+        self.id = id
+        self.name = name
+        self.total = total
+        self.started = started
+        self.completed = 0
+        self.rendered = None
+        self.bar = None
+
+class Reporter(threading.Thread):
+    """
+    Renders the events of every operation from one thread
+    """
+    def __init__(self, mode=None, stream=None):
+        threading.Thread.__init__(self, name="progress")
+        self.daemon = True
+        self.stream = stream or sys.stderr
+        self.mode = mode or default_mode(self.stream)
+        self.events = Queue.Queue()
+        self.operations = {}
+        self.dirty = set()
+        self.rendered = 0
+        self.ticked = 0
+
+    def publish(self, event, **fields):
+        fields["event"] = event
+        self.events.put(fields)
+
+    def flush(self):
+        """
+        Wait until everything published so far is rendered
+        """
+        self.events.join()
+
+    def run(self):
+        while True:
+            now = time.time()
+            timeout = RENDER_INTERVAL if self.dirty else max(0, self.ticked + TICK_INTERVAL - now)
+            try:
+                event = self.events.get(timeout=timeout if self.operations else None)
+            except Queue.Empty:
+                event = None
+            # Take everything queued at once, a redraw covers all of it
+            events = []
+            while event is not None:
+                events.append(event)
+                try:
+                    event = self.events.get_nowait()
+                except Queue.Empty:
+                    event = None
+            try:
+                for event in events:
+                    self.handle(event)
+                self.render()
+            except Exception:
+                log.debug("Could not report progress", exc_info=True)
+            finally:
+                for event in events:
+                    self.events.task_done()
+
+    def handle(self, event):
+        kind = event["event"]
+        if kind == "start":
+            operation = self.operations[event["id"]] = Operation(event["id"], event["operation"], event["total"],
+                                                                 event["time"])
+            if self.mode == "bar":
+                operation.bar = progress_bar(operation.total, self.stream)
+            self.emit(event)
+            return
+
+        operation = self.operations.get(event["id"])
+        if operation is None:
+            return
+        if kind == "progress":
+            operation.completed = event["completed"]
+            self.dirty.add(operation.id)
+        elif kind == "step":
+            self.emit(dict(event, operation=operation.name))
+        elif kind == "finish":
+            operation.completed = event["completed"]
+            del self.operations[operation.id]
+            self.dirty.discard(operation.id)
+            if operation.bar is not None:
+                operation.bar.update(operation.completed)
+                operation.bar.finish()
+            self.emit({"event": "finish", "id": operation.id, "operation": operation.name,
+                       "completed": operation.completed, "total": operation.total,
+                       "elapsed": round(event["time"] - operation.started, 3)})
+
+    def render(self):
+        now = time.time()
+        tick = now - self.ticked >= TICK_INTERVAL
+        if not tick and (not self.dirty or now - self.rendered < RENDER_INTERVAL):
+            return
+        for operation in self.operations.values():
+            if operation.id not in self.dirty and not (tick and operation.bar is not None):
+                continue
+            if operation.bar is not None:
+                operation.bar.update(operation.completed)
+            elif operation.rendered != operation.completed:
+                self.emit({"event": "progress", "id": operation.id, "operation": operation.name,
+                           "completed": operation.completed, "total": operation.total,
+                           "elapsed": round(now - operation.started, 3)})
+            operation.rendered = operation.completed
+        self.dirty.clear()
+        self.rendered = now
+        if tick:
+            self.ticked = now
+
+    def emit(self, event):
+        if self.mode != "json":
+            return
+        self.stream.write(json.dumps(event, sort_keys=True) + "\n")
+        self.stream.flush()
+
+def get_reporter():
+    """
+    The reporter thread, started on first use
+    """
+    global reporter
+    with reporter_lock:
+        if reporter is None:
+            reporter = Reporter()
+            reporter.start()
+        return reporter
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Subprocess output pump
+
+A single thread waits on the output of every child process with epoll (or
+poll where there's no epoll), hands complete lines to per-process callbacks
+and resolves a future once the process has exited, so hundreds of
+docker-machine processes don't need hundreds of threads.
+
+Callbacks run on the pump thread, they must not block or wait for other
+processes started through the pump.
+"""
+import os
+import fcntl
+import errno
+import signal
+import select
+import logging
+import threading
+import subprocess
+import concurrent.futures as futures
+
+log = logging.getLogger(__name__)
+
+# How often processes that closed their output are checked for exit
+REAP_INTERVAL = 0.1
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class Poller(object):
+    """
+    epoll where available, poll otherwise, with timeouts in seconds
+    """
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.flags = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.flags = select.POLLIN | select.POLLHUP | select.POLLERR
+            self.scale = 1000
+
+    def register(self, fd):
+        self.poller.register(fd, self.flags)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            return self.poller.poll(-1)
+        return self.poller.poll(timeout * self.scale)
+
+class Process(object):
+    """
+    Child process with its output merged into one pipe, in a session of its
+    own with `session=True` so kill() also reaches what the shell started
+    """
+    def __init__(self, cmd, on_line=None, on_exit=None, cwd=None, env=None, session=False):
+        self.cmd = cmd
+        self.on_line = on_line
+        self.on_exit = on_exit
+        self.session = session
+        self.future = futures.Future()
+        # Running, cancelling the future won't stop the process, kill() does
+        self.future.set_running_or_notify_cancel()
+        self.future.process = self
+        self.buffer = ""
+        self.popen = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                      cwd=cwd, env=env, close_fds=True, preexec_fn=os.setsid if session else None)
+        self.fd = self.popen.stdout.fileno()
+        set_nonblocking(self.fd)
+
+    def kill(self, sig=signal.SIGTERM):
+        if self.popen.returncode is not None:
+            return
+        try:
+            if self.session:
+                os.killpg(self.popen.pid, sig)
+            else:
+                self.popen.send_signal(sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def feed(self, data):
+        lines = (self.buffer + data).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            self.line(line + "\n")
+
+    def line(self, line):
+        if self.on_line:
+            try:
+                self.on_line(line)
+            except Exception:
+                log.exception("Error handling output of %s" % self.cmd)
+
+    def eof(self):
+        if self.buffer:
+            self.line(self.buffer)
+            self.buffer = ""
+        self.popen.stdout.close()
+
+    def finish(self, rc):
+        try:
+            result = self.on_exit(rc) if self.on_exit else rc
+        except Exception as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+class Pump(object):
+    """
+    Runs child processes and delivers their output from a single thread,
+    started with the first process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.exiting = []
+        self.poller = None
+        self.wakeup = None
+        self.thread = None
+
+    def start(self):
+        self.poller = Poller()
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            set_nonblocking(fd)
+        self.poller.register(self.wakeup[0])
+        self.thread = threading.Thread(target=self.run, name="pump")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def spawn(self, cmd, on_line=None, on_exit=None, cwd=None, env=None, session=False):
+        """
+        Start `cmd` in a shell, returns a future for on_exit(returncode), or
+        the return code itself without on_exit, with the Process as its
+        `process` attribute
+        """
+        process = Process(cmd, on_line, on_exit, cwd=cwd, env=env, session=session)
+        with self.lock:
+            if self.thread is None:
+                self.start()
+            self.processes[process.fd] = process
+            self.poller.register(process.fd)
+        try:
+            os.write(self.wakeup[1], "x")
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return process.future
+
+    def run(self):
+        while True:
+            try:
+                events = self.poller.poll(REAP_INTERVAL if self.exiting else None)
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == self.wakeup[0]:
+                    try:
+                        os.read(fd, 4096)
+                    except OSError:
+                        pass
+                    continue
+
+                with self.lock:
+                    process = self.processes.get(fd)
+                if process is None:
+                    continue
+
+                try:
+                    data = os.read(fd, 65536)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    data = ""
+
+                if data:
+                    process.feed(data)
+                else:
+                    self.close(process)
+
+            self.reap()
+
+    def close(self, process):
+        with self.lock:
+            del self.processes[process.fd]
+            self.poller.unregister(process.fd)
+        process.eof()
+        self.exiting.append(process)
+
+    def reap(self):
+        for process in list(self.exiting):
+            rc = process.popen.poll()
+            if rc is not None:
+                self.exiting.remove(process)
+                process.finish(rc)
+
+def then(future, callback):
+    """
+    Future for callback(future) once `future` is done, if the callback
+    returns a future its result is passed on
+    """
+    result = futures.Future()
+    result.set_running_or_notify_cancel()
+
+    def forward(inner):
+        try:
+            result.set_result(inner.result())
+        except Exception as e:
+            result.set_exception(e)
+
+    def done(future):
+        try:
+            value = callback(future)
+        except Exception as e:
+            result.set_exception(e)
+            return
+        if isinstance(value, futures.Future):
+            value.add_done_callback(forward)
+        else:
+            result.set_result(value)
+
+    future.add_done_callback(done)
+    return result
+
+
+pump = Pump()
+
+def spawn(cmd, on_line=None, on_exit=None, cwd=None, env=None, session=False):
+    return pump.spawn(cmd, on_line=on_line, on_exit=on_exit, cwd=cwd, env=env, session=session)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Launch scheduling
+
+Machines are created through a scheduler per provider and region, which
+combines a token bucket (how fast creations may start) with an AIMD limit
+on how many run at once: the limit grows by one every time a full window
+of creations succeeds and halves when the provider throttles us (EC2's
+RequestLimitExceeded, HTTP 429, ...), throttled creations are retried.
+Defaults can be overridden per provider and region in storm.yml:
+
+    limits:
+      aws:
+        rate: 2             # creations started per second
+        burst: 5            # started at once after a quiet period
+        concurrency: 12     # creations running at once, to start with
+        min_concurrency: 1
+        max_concurrency: 32
+        retries: 3          # times a throttled creation is retried
+        regions:
+          eu-west-1:
+            concurrency: 4
+"""
+import re
+import time
+import logging
+import threading
+import collections
+import concurrent.futures as futures
+from concurrent.futures import CancelledError
+
+from coroutines import Return, sleep, spawn, failure
+
+log = logging.getLogger(__name__)
+
+# EC2 refills RunInstances tokens at 2/s up to 5, the other two are guesses
+# leaving room for the other calls docker-machine makes per machine
+DEFAULT_LIMITS = {
+    "aws": {"rate": 2, "burst": 5},
+    "azure": {"rate": 1, "burst": 5},
+    "digitalocean": {"rate": 1, "burst": 10}
+}
+
+DEFAULTS = {
+    "rate": 1,
+    "burst": 5,
+    "concurrency": 12,
+    "min_concurrency": 1,
+    "max_concurrency": 32,
+    "retries": 3
+}
+
+THROTTLED = re.compile(r"RequestLimitExceeded|Throttl|TooManyRequests|Too Many Requests|rate limit|\b429\b",
+                       re.IGNORECASE)
+
+limits = {}
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+def throttled(message):
+    """
+    Whether a provider error means we're being rate limited
+    """
+    return bool(message) and THROTTLED.search(message) is not None
+
+class TokenBucket(object):
+    """
+    `rate` tokens per second, up to `burst` saved up
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, returns how many seconds to wait until it's available
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def drain(self):
+        """
+        Give up saved tokens, so what's next goes at `rate`
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+            self.updated = time.time()
+
+class Limit(object):
+    """
+    AIMD concurrency limit, acquire() returns a future for the window the
+    slot was handed out in
+    """
+    def __init__(self, concurrency, minimum=1, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum or concurrency
+        self.limit = float(max(minimum, min(concurrency, self.maximum)))
+        self.active = 0
+        self.window = 0
+        self.waiters = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        future = futures.Future()
+        with self.lock:
+            if self.active >= int(self.limit):
+                self.waiters.append(future)
+                return future
+            self.active += 1
+            window = self.window
+        future.set_running_or_notify_cancel()
+        future.set_result(window)
+        return future
+
+    def release(self, window, throttled=False, used=True):
+        """
+        Give back a slot, the limit only moves for slots that were `used`
+        """
+        with self.lock:
+            self.active -= 1
+            if used and throttled:
+                # Slots from before the last decrease were part of the same burst
+                if window == self.window:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.window += 1
+            elif used:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            ready = []
+            while self.waiters and self.active < int(self.limit):
+                waiter = self.waiters.popleft()
+                # Skip waiters whose task was cancelled
+                if waiter.set_running_or_notify_cancel():
+                    self.active += 1
+                    ready.append(waiter)
+            window = self.window
+        for waiter in ready:
+            waiter.set_result(window)
+
+class Slot(object):
+    """
+    Permission to create one machine, released once it's done
+    """
+    def __init__(self, scheduler, window):
+        self.scheduler = scheduler
+        self.window = window
+        self.released = False
+
+    def release(self, throttled=False, used=True):
+        if self.released:
+            return
+        self.released = True
+        self.scheduler.limit.release(self.window, throttled, used)
+        if throttled:
+            self.scheduler.bucket.drain()
+            log.debug("Throttled by %s, down to %d at once" % (self.scheduler, self.scheduler.concurrency))
+
+class Acquisition(futures.Future):
+    """
+    Future for the Slot `task` gets, given back if the task waiting for it
+    is cancelled after it was handed out
+    """
+    def __init__(self, task):
+        futures.Future.__init__(self)
+        self.set_running_or_notify_cancel()
+        self.task = task
+        self.abandoned = False
+        task.add_done_callback(self.acquired)
+
+    def acquired(self, task):
+        error = failure(task)
+        if error is not None:
+            self.set_exception(error)
+            return
+        if self.abandoned:
+            task.result().release(used=False)
+        self.set_result(task.result())
+
+    def cancel(self):
+        self.abandoned = True
+        if not self.done():
+            return self.task.cancel()
+        if self.exception() is None:
+            self.result().release(used=False)
+        return False
+
+class Scheduler(object):
+    """
+    Rate and concurrency of machine creation on one provider and region
+    """
+    def __init__(self, provider, region, rate, burst, concurrency, min_concurrency, max_concurrency, retries):
+        self.provider = provider
+        self.region = region
+        self.retries = retries
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = Limit(concurrency, min_concurrency, max_concurrency)
+
+    def __str__(self):
+        return "%s %s" % (self.provider, self.region) if self.region else self.provider
+
+    @property
+    def concurrency(self):
+        return int(self.limit.limit)
+
+    def acquire(self):
+        """
+        Future for a Slot, once there's one and a token
+        """
+        return Acquisition(spawn(self.wait()))
+
+    def wait(self):
+        """
+        Coroutine waiting for a slot, then for a token
+        """
+        acquired = self.limit.acquire()
+        try:
+            window = yield acquired
+        except CancelledError:
+            # The slot may have been handed out before the cancellation got here
+            if acquired.done() and not acquired.cancelled():
+                self.limit.release(acquired.result(), used=False)
+            raise
+        slot = Slot(self, window)
+        try:
+            delay = self.bucket.reserve()
+            if delay:
+                yield sleep(delay)
+        except BaseException:
+            slot.release(used=False)
+            raise
+        raise Return(slot)
+
+def settings(provider, region=None):
+    options = dict(DEFAULTS)
+    options.update(DEFAULT_LIMITS.get(provider, {}))
+    configured = limits.get(provider) or {}
+    regional = (configured.get("regions") or {}).get(region) or {} if region is not None else {}
+    for overrides in (configured, regional):
+        options.update((key, value) for key, value in overrides.items() if key in DEFAULTS)
+    return options
+
+def configure(configured):
+    """
+    Use the `limits` section of storm.yml, schedulers start over
+    """
+    with schedulers_lock:
+        limits.clear()
+        limits.update(configured or {})
+        schedulers.clear()
+
+def scheduler_for(provider, region=None):
+    with schedulers_lock:
+        key = (provider, region)
+        if key not in schedulers:
+            schedulers[key] = Scheduler(provider, region, **settings(provider, region))
+        return schedulers[key]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+docker-machine store
+
+Reads machine configurations straight from ~/.docker/machine (or
+$MACHINE_STORAGE_PATH) instead of asking docker-machine, which probes every
+machine over the network.
+"""
+import os
+import json
+import logging
+import urlparse
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+STORAGE_PATH = os.environ.get("MACHINE_STORAGE_PATH",
+                              os.path.join(os.path.expanduser("~"), ".docker", "machine"))
+
+MANAGED_LABEL = "com.storm.managed=true"
+
+Machine = namedtuple("Machine", ["name", "driver", "ip", "labels", "path", "config"])
+
+def machines_path(path=None):
+    return os.path.join(path or STORAGE_PATH, "machines")
+
+def machine_host(name, config):
+    """
+    Address docker-machine would use for this machine
+    """
+    driver = config.get("Driver") or {}
+    # The Azure driver only knows the cloud service's hostname
+    if config.get("DriverName") == "azure":
+        return "%s.cloudapp.net" % name
+    return driver.get("IPAddress")
+
+def engine_port(config):
+    return (config.get("Driver") or {}).get("DockerPort") or 2376
+
+def environment(machine, swarm=False):
+    """
+    Docker client environment for `machine`, the same `docker-machine env`
+    would print, or None if it can't be worked out from the store
+    """
+    if not machine.ip:
+        return None
+    port = engine_port(machine.config)
+    if swarm:
+        options = (machine.config.get("HostOptions") or {}).get("SwarmOptions") or {}
+        if not options.get("Master"):
+            return None
+        port = urlparse.urlparse(options.get("Host") or "tcp://0.0.0.0:3376").port or 3376
+    return {
+        'DOCKER_TLS_VERIFY': "1",
+        'DOCKER_CERT_PATH': machine.path,
+        'DOCKER_HOST': "tcp://%s:%s" % (machine.ip, port)
+    }
+
+def load(name, path=None):
+    """
+    Load a machine's config.json, returns None if it can't be read
+    """
+    machine_path = os.path.join(machines_path(path), name)
+    try:
+        with open(os.path.join(machine_path, "config.json")) as f:
+            config = json.load(f)
+    except (IOError, ValueError) as e:
+        log.debug("Could not read configuration of %s: %r" % (name, e))
+        return None
+
+    labels = ((config.get("HostOptions") or {}).get("EngineOptions") or {}).get("Labels") or []
+    ip = machine_host(name, config)
+    return Machine(name=str(config.get("Name", name)),
+                   driver=str(config.get("DriverName")),
+                   ip=str(ip) if ip else None,
+                   labels=[str(label) for label in labels],
+                   path=machine_path,
+                   config=config)
+
+def machines(label=MANAGED_LABEL, path=None):
+    """
+    List machines in the store, filtered by engine label
+    """
+    try:
+        names = sorted(os.listdir(machines_path(path)))
+    except OSError:
+        return []
+
+    found = []
+    for name in names:
+        machine = load(name, path)
+        if machine is None:
+            continue
+        if label and label not in machine.labels:
+            continue
+        found.append(machine)
+    return found
+
+def rename(old, new, labels=None, path=None):
+    """
+    Move a machine to a new name in the store, optionally with new engine
+    labels, the provider still knows the VM by its old name
+    """
+    old_path = os.path.join(machines_path(path), old)
+    new_path = os.path.join(machines_path(path), new)
+    with open(os.path.join(old_path, "config.json")) as f:
+        config = json.load(f)
+
+    def moved(value):
+        if isinstance(value, dict):
+            return dict((key, moved(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return [moved(item) for item in value]
+        if isinstance(value, basestring) and (value == old_path or value.startswith(old_path + os.sep)):
+            return new_path + value[len(old_path):]
+        return value
+
+    config = moved(config)
+    config["Name"] = new
+    config.setdefault("Driver", {})["MachineName"] = new
+    if labels is not None:
+        config.setdefault("HostOptions", {}).setdefault("EngineOptions", {})["Labels"] = labels
+
+    os.rename(old_path, new_path)
+    save(new_path, config)
+
+def save(machine_path, config):
+    tmp = os.path.join(machine_path, "config.json.%d.tmp" % os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(config, f, indent=4)
+    os.rename(tmp, os.path.join(machine_path, "config.json"))
+
+def join_swarm(name, discovery, path=None):
+    """
+    Set the swarm and cluster store options tasks.swarm_options() would
+    have created the machine with, for `docker-machine provision` to apply
+    """
+    machine_path = os.path.join(machines_path(path), name)
+    with open(os.path.join(machine_path, "config.json")) as f:
+        config = json.load(f)
+
+    host_options = config.setdefault("HostOptions", {})
+    swarm = host_options.get("SwarmOptions") or {}
+    swarm.update({
+        "IsSwarm": True,
+        "Master": True,
+        "Discovery": "consul://%s:8500" % discovery,
+        "ArbitraryFlags": ["replication=true"]
+    })
+    swarm.setdefault("Host", "tcp://0.0.0.0:3376")
+    host_options["SwarmOptions"] = swarm
+
+    engine = host_options.get("EngineOptions") or {}
+    flags = [flag for flag in engine.get("ArbitraryFlags") or []
+             if not flag.startswith("cluster-store=") and not flag.startswith("cluster-advertise=")]
+    engine["ArbitraryFlags"] = flags + ["cluster-store=consul://%s:8500" % discovery, "cluster-advertise=eth0:2376"]
+    host_options["EngineOptions"] = engine
+
+    save(machine_path, config)
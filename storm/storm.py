@@ -9,73 +9,99 @@ Storm - multi-cloud load-balanced deployments
     TODO Make a futures wrapper for better pattern reuse in tasks
 """
 import os
+import sys
 import json
+import atexit
 import base64
-import uuid
-import yaml
 import logging
-import argcomplete
 from colors import colors
-from fabric.api import settings
-from fabric.contrib.console import confirm
-from tasks import set_logging, machine, machine_list, docker_on, compose_on
-from tasks import launch, deploy_consul, deploy_registrator, prepare_haproxy, deploy_haproxy
-from tasks import stop_machines, teardown, rollback
-from tasks import AWS_ACCESS_KEY, AWS_SECRET_KEY, AZURE_SUBSCRIPTION_ID, AZURE_CERTIFICATE, DIGITALOCEAN_ACCESS_TOKEN
-from argparse import ArgumentParser
+from lazy import lazy_import
+from tasks import set_logging, machine, machine_list, machine_exports, docker_on, compose_on
+from tasks import creations, compose_consul, join_discovery_async, deploy_registrator_async, prepare_haproxy_instance
+from tasks import deploy_haproxy_async
+from tasks import compose_on_async, stop_machines, teardown, create, create_options, pool_fill_async, pool_drain
+from coroutines import Return, run, blocking
+from graph import Graph
+from context import TaskContext
+from credentials import credentials
+from inventory import Inventory, update_cache
+from probe import probe, PROBE_TIMEOUT
+import store
+import trace
+import scheduler
+import bake
+import pool
+from daemon import DaemonError, serve, forward, notify_changed
+from argparse import ArgumentParser, Action, SUPPRESS
 from . import __version__
 
+# uuid forks ldconfig on import in Python 2
+uuid = lazy_import("uuid")
+yaml = lazy_import("yaml")
+argcomplete = lazy_import("argcomplete")
+fabric_api = lazy_import("fabric.api")
+console = lazy_import("fabric.contrib.console")
+
 log = logging.getLogger(__name__)
 
 # Get available scenarios
 path = os.path.dirname(__file__)
 
+# Commands that launch or remove machines
+TRACED_COMMANDS = ("launch", "deploy", "bake", "pool", "stop", "rm", "teardown")
+
+class VersionAction(Action):
+    """
+    Show the version from git in source checkouts, only when asked for it
+    """
+    def __init__(self, option_strings, dest=SUPPRESS, default=SUPPRESS, help=None):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings,
+            dest=dest,
+            default=default,
+            nargs=0,
+            help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from ._version import get_versions
+        parser.exit(message="%s\n" % get_versions()['version'])
+
 def parse_arguments(parser):
+    parser.add_argument(
+        "-v", "--version",
+        action=VersionAction,
+        help="show program's version number and exit")
     parser.add_argument(
         "--debug",
         default=False,
         dest="debug",
         type=bool,
         help="Debug (default: %(default)s)")
+    parser.add_argument(
+        "--probe",
+        default=False,
+        action="store_true",
+        help="Check machines over the network with docker-machine instead of reading its store")
+    parser.add_argument(
+        "--refresh",
+        default=False,
+        action="store_true",
+        help="Ignore the cached inventory")
     parser.add_argument(
         "command",
-        choices=["launch", "deploy", "repair", "env", "ls", "ps", "up", "scale", "stop", "rm", "teardown"],
+        choices=["launch", "deploy", "bake", "pool", "repair", "env", "ls", "ps", "up", "scale", "stop", "rm", "teardown", "serve"],
         help="Storm commands for deployments and maintenance")
     parser.add_argument(
         "parameters",
         nargs='*',
         help="Optional parameters per command")
 
-    argcomplete.autocomplete(parser)
+    # Only load argcomplete when the shell is actually asking for completions
+    if "_ARGCOMPLETE" in os.environ:
+        argcomplete.autocomplete(parser)
 
     return parser.parse_args()
 
-class Inventory(object):
-    def __init__(self):
-        machines = self.parse_machines()
-
-        self.discovery = machines['discovery']
-        self.instances = machines['instances']
-
-    def parse_machines(self):
-        machines = machine_list().splitlines()[1:]
-        parsed = {}
-        discovery = {}
-        instances = {}
-
-        for mach in machines:
-            fields = mach.split()
-            ip = fields[4][6:-5]
-            if mach.startswith('consul-'):
-                discovery.update({fields[0]: ip})
-            else:
-                instances.update({fields[0]: ip})
-
-        parsed['discovery'] = discovery
-        parsed['instances'] = instances
-
-        return parsed
-
 def load_yaml():
     log.debug("Loading storm.yml ...")
     f = open("storm.yml")
@@ -94,8 +120,245 @@ def create_certs():
         machine("rm -y dummy", threadName="rm")
         log.info("Certificates created.\n")
 
+def pool_groups(storm, discovery):
+    """
+    (provider, create options, standby count) of the `pool` section of
+    storm.yml
+    """
+    images = bake.load_images()
+    groups = []
+    for provider, configs in (storm.get("pool") or {}).items():
+        for config in configs if isinstance(configs, list) else [configs]:
+            instance = dict(config, provider=provider, discovery=discovery)
+            groups.append((provider, create_options(bake.use_baked(instance, images)), config.get("standby", 1)))
+    return groups
+
+def deploy_cluster(storm, summary, args):
+    """
+    Coroutine launching and deploying everything in storm.yml as a graph,
+    every machine going on to the next step as soon as it's ready, returns
+    the names of all machines
+    """
+    instances = {}
+    discovery = {}
+    scheduler.configure(storm.get("limits"))
+    # Images from `docker-storm bake`
+    images = bake.load_images()
+    inventory = Inventory(probe=args.probe, refresh=args.refresh)
+    log.debug("Current inventory: %s, %s" % (inventory.discovery, inventory.instances))
+    # Inventory as of the last step that changed it
+    cluster = {"inventory": inventory}
+    # Machines this deploy did create, failed creations are removed
+    launched = set()
+    graph = Graph()
+    # Create hosts alongside discovery instances, they join the swarm once Consul is up
+    overlap = storm.get("overlap_discovery", False) and summary["discovery"]["total"] and not inventory.discovery
+
+    def reload_inventory():
+        notify_changed()
+        cluster["inventory"] = Inventory(probe=args.probe, refresh=args.refresh)
+        return cluster["inventory"]
+
+    def launch(created, creation):
+        # Hosts join the discovery of a Consul cluster that may not have been there yet
+        for name in created:
+            if name in instances and overlap:
+                # Joined to the swarm later, standby machines of any discovery will do
+                instances[name]["join"] = True
+            elif name in instances:
+                instances[name]["discovery"] = cluster["discovery_host"]
+        yield creation
+        update_cache(created)
+        launched.update(name for name in created if store.load(name) is not None)
+
+    def deploy_consul(name):
+        inventory = cluster["inventory"]
+        if name not in inventory.discovery:
+            log.warn("%s wasn't created, not deploying Consul on it" % name)
+            return
+        yield blocking(compose_consul, name, ip=inventory.discovery[name], servers=inventory.discovery.values(),
+                       encrypt=cluster["encrypt"])
+
+    def prepare(name):
+        if name in launched:
+            yield prepare_haproxy_instance(name)
+
+    def join(name):
+        if name in launched:
+            yield join_discovery_async(name, cluster["discovery_host"])
+
+    def add_launches(machines, phase, after=()):
+        """
+        Graph nodes creating `machines`, with the names each one creates
+        """
+        return [(graph.add("launch %s" % ", ".join(created),
+                           lambda created=created, creation=creation: launch(created, creation),
+                           after=after, phase=phase), created)
+                for created, creation in creations(machines, hedging=storm.get("hedge"))]
+
+    #
+    # Launch discovery instances
+    #
+    log.info("Launching %sdiscovery%s instances..." % (colors.PURPLE, colors.ENDC))
+
+    # Launch service discovery instances
+    for provider in storm["discovery"]:
+        if isinstance(storm["discovery"][provider], list):
+            for l, location in enumerate(storm["discovery"][provider]):
+                for index in range(location["scale"]):
+                    name = "consul-%s-%d-%d-%s" % (provider, l, index, str(uuid.uuid4())[:8])
+                    instance = location.copy()
+                    instance["provider"] = provider
+                    instance["name"] = name
+                    discovery[name] = bake.use_baked(instance, images)
+        else:
+            for index in range(storm["discovery"][provider]["scale"]):
+                name = "consul-%s-%d-%s" % (provider, index, str(uuid.uuid4())[:8])
+                instance = storm["discovery"][provider].copy()
+                instance["provider"] = provider
+                instance["name"] = name
+                discovery[name] = bake.use_baked(instance, images)
+
+    if len(discovery) == 1:
+        log.warn("%sWARNING%s: Using a single instance for service discovery provides no fault tolerance." % (colors.YELLOW, colors.ENDC))
+
+    discovery_launches = []
+    consul = []
+    if summary["discovery"]["total"] and not inventory.discovery:
+        discovery_launches = [node for node, created in add_launches(discovery, "launch discovery")]
+
+        def discovery_ready():
+            inventory = yield blocking(reload_inventory)
+            log.info("Deploying %sConsul%s%s..." % (colors.PURPLE, colors.ENDC, " cluster" if len(inventory.discovery) > 1 else ""))
+            cluster["encrypt"] = base64.b64encode(str(uuid.uuid4()).replace('-', '')[:16])
+            cluster["discovery_host"] = inventory.discovery_ip
+        graph.add("discovery ready", discovery_ready, after=discovery_launches)
+
+        # Deploy Consul on discovery instances
+        for name in discovery:
+            consul.append(graph.add("consul %s" % name, lambda name=name: deploy_consul(name),
+                                    after=["discovery ready"], phase="deploy consul"))
+    else:
+        # FIXME Setting discovery as first IP of Consul cluster until DNS setup is implemented
+        cluster["discovery_host"] = inventory.discovery_ip
+
+    #
+    # Launch cluster instances
+    #
+    log.info("Launching %scluster%s instances..." % (colors.BLUE, colors.ENDC))
+
+    for provider in storm["hosts"]:
+        if isinstance(storm["hosts"][provider], list):
+            for l, location in enumerate(storm["hosts"][provider]):
+                for index in range(location["scale"]):
+                    name = "storm-%s-%d-%d-%s" % (provider, l, index, str(uuid.uuid4())[:8])
+                    instance = location.copy()
+                    instance["provider"] = provider
+                    instance["name"] = name
+                    instances[name] = bake.use_baked(instance, images)
+        else:
+            for index in range(storm["hosts"][provider]["scale"]):
+                name = "storm-%s-%d-%s" % (provider, index, str(uuid.uuid4())[:8])
+                instance = storm["hosts"][provider].copy()
+                instance["provider"] = provider
+                instance["name"] = name
+                instances[name] = bake.use_baked(instance, images)
+
+    # Each host is prepared for HAProxy (certificate for HTTPS) as soon as it's up
+    hosts_launched = []
+    prepared = []
+    joined = []
+    if summary["hosts"]["total"] and not inventory.instances:
+        for node, created in add_launches(instances, "launch hosts", after=[] if overlap else consul):
+            hosts_launched.append(node)
+            for name in created:
+                prepared.append(graph.add("prepare %s" % name, lambda name=name: prepare(name),
+                                          after=[node], phase="prepare haproxy"))
+                if overlap:
+                    joined.append(graph.add("join %s" % name,
+                                            lambda name=name: join(name),
+                                            after=[node] + consul, phase="join discovery"))
+    else:
+        for name in inventory.instances:
+            prepared.append(graph.add("prepare %s" % name, lambda name=name: prepare_haproxy_instance(name),
+                                      phase="prepare haproxy"))
+
+    def hosts_ready():
+        if hosts_launched:
+            yield blocking(reload_inventory)
+    graph.add("hosts ready", hosts_ready, after=hosts_launched + joined + consul)
+
+    def registrator():
+        inventory = cluster["inventory"]
+        log.info("Launched %s%d instances%s, %s%d discovery instances%s" % (
+                 colors.GREEN, len(inventory.instances), colors.ENDC,
+                 colors.PURPLE, len(inventory.discovery), colors.ENDC))
+
+        # Deploy and scale registrator to all instances
+        log.info("Deploying %sregistrator%s..." % (colors.GREEN, colors.ENDC))
+        yield deploy_registrator_async(
+            inventory.master,
+            len(inventory.instances),
+            cluster["discovery_host"])
+    graph.add("registrator", registrator, after=["hosts ready"], phase="deploy registrator")
+
+    def haproxy():
+        # Deploy HAProxy
+        log.info("Deploying %s%d HAProxy%s instances..." % (colors.GREEN, storm["load_balancers"], colors.ENDC))
+        yield deploy_haproxy_async(
+            cluster["inventory"].master,
+            storm["load_balancers"],
+            cluster["discovery_host"])
+    graph.add("haproxy", haproxy, after=["registrator"] + prepared, phase="deploy haproxy")
+
+    # Deploy services, one after the other in each deployment since they share a compose project
+    def deploy_service(name, service, config):
+        log.info("Deploying %s%s%s..." % (colors.GREEN, service, colors.ENDC))
+        # with lcd(os.path.join(os.getcwd(), 'deploy', name)):
+        yield compose_on_async(cluster["inventory"].master, "up -d", cluster["discovery_host"],
+                               cwd=os.path.join(os.getcwd(), 'deploy', name))
+        yield compose_on_async(cluster["inventory"].master, "scale %s=%d" % (service, config["scale"]), cluster["discovery_host"],
+                               cwd=os.path.join(os.getcwd(), 'deploy', name))
+
+    for name in storm["deploy"]:
+        services = storm["deploy"][name]["services"]
+        previous = "registrator"
+        for service in services:
+            previous = graph.add("deploy %s/%s" % (name, service),
+                                 lambda name=name, service=service, config=services[service]: deploy_service(name, service, config),
+                                 after=[previous], phase="deploy %s" % service)
+
+    context = TaskContext("Deploy", len(graph)).start()
+    try:
+        yield graph.run(context)
+    except SystemExit:
+        if graph.failed in discovery_launches:
+            teardown(discovery.keys())
+            fabric_api.abort("Bad failure...")
+        raise
+    finally:
+        context.finish()
+    graph.report("Deploy duration")
+
+    inventory = cluster["inventory"]
+    names = inventory.discovery.keys() + inventory.instances.keys()
+
+    # List inventory
+    if args.debug:
+        # List machines
+        machines = machine_list()
+        log.info("Machines:")
+        log.info(machines)
+        log.info("===")
+
+        log.debug('Discovery: %s' % inventory.discovery)
+        log.debug('Instances: %s' % inventory.instances)
+        log.debug("Names: %s" % names)
+
+    raise Return(names)
+
 def main():
-    parser = ArgumentParser(version=__version__)
+    parser = ArgumentParser()
     args = parse_arguments(parser)
 
     set_logging(args.debug)
@@ -110,12 +373,49 @@ def main():
         log.info('%s%s%s' % (colors.GREEN, logo, colors.ENDC))
         log.info('%s========================%s\n' % (colors.PURPLE, colors.ENDC))
 
-    if args.command == "ls":
+    # Let a running `docker-storm serve` answer if possible
+    try:
+        out = None if args.probe or args.refresh else forward(args.command, args.parameters)
+    except DaemonError as e:
+        log.error("%sERROR%s: %s" % (colors.RED, colors.ENDC, e))
+        raise SystemExit(1)
+    if out is not None:
+        print out
+        raise SystemExit
+
+    # Runs that change machines leave a trace in ~/.storm/traces
+    if args.command in TRACED_COMMANDS:
+        trace.start(args.command)
+        atexit.register(trace.finish)
+
+    if args.command == "serve":
+        serve(refresh=int(args.parameters[0]) if args.parameters else 30)
+        raise SystemExit
+
+    elif args.command == "ls":
         # List machines
-        machines = machine_list()
-        log.info("Machines:")
-        log.info(machines)
-        log.info("===")
+        if args.probe:
+            machines = machine_list()
+            log.info("Machines:")
+            log.info(machines)
+            log.info("===")
+            raise SystemExit
+
+        row = "%-36s %-40s %-14s %-10s %-7s %s"
+        log.info(row % ("NAME", "ADDRESS", "DRIVER", "DOCKER", "SWARM", "TIME"))
+        stragglers = []
+        for result in probe(store.machines(), timeout=float(args.parameters[0]) if args.parameters else PROBE_TIMEOUT):
+            if result.reachable is None:
+                stragglers.append(result.machine.name)
+                continue
+            log.info(row % (result.machine.name,
+                            result.machine.ip,
+                            result.machine.driver,
+                            result.version if result.reachable else "%s%s%s" % (colors.RED, "Error", colors.ENDC),
+                            result.swarm or "-",
+                            "%.2fs" % result.elapsed if result.reachable else result.error))
+        if stragglers:
+            log.warn("%sNo answer%s from: %s" % (colors.YELLOW, colors.ENDC, ", ".join(stragglers)))
         raise SystemExit
 
     elif args.command == "stop":
@@ -123,37 +423,43 @@ def main():
         if not names:
             log.warn("No machine specified.")
         else:
-            if not confirm("This will terminate %s, continue?" % names, default=False):
+            if not console.confirm("This will terminate %s, continue?" % names, default=False):
                 log.warn("Aborting...")
                 raise SystemExit
-        stop_machines(names)
+        with trace.phase("stop"):
+            stop_machines(names)
+        notify_changed()
         raise SystemExit
 
     elif args.command == "rm":
         names = args.parameters
         if not names:
-            inventory = Inventory()
+            inventory = Inventory(probe=args.probe, refresh=args.refresh)
             for name in inventory.instances:
                 names.append(name)
-        if not confirm("This will terminate %s, continue?" % names, default=False):
+        if not console.confirm("This will terminate %s, continue?" % names, default=False):
             log.warn("Aborting...")
             raise SystemExit
-        teardown(names)
+        with trace.phase("teardown"):
+            teardown(names)
+        notify_changed()
         raise SystemExit
 
     elif args.command == "teardown":
         # Cleanup - TODO filters
-        if not confirm("This will terminate all instances, continue?", default=False):
+        if not console.confirm("This will terminate all instances, continue?", default=False):
             log.warn("Aborting...")
             raise SystemExit
         names = []
-        inventory = Inventory()
+        inventory = Inventory(probe=args.probe, refresh=args.refresh)
         for name in inventory.instances:
             names.append(name)
         if args.parameters and args.parameters[0] == "all":
             for name in inventory.discovery:
                 names.append(name)
-        teardown(names)
+        with trace.phase("teardown"):
+            teardown(names)
+        notify_changed()
         raise SystemExit
 
     elif args.command == "launch":
@@ -164,35 +470,80 @@ def main():
             log.warn("Please select a provider and unique instance name.")
             raise SystemExit
 
-        provider = args.parameters[0]
+        provider, name = args.parameters[:2]
         if provider == "azure":
-            if AZURE_SUBSCRIPTION_ID and AZURE_CERTIFICATE:
-                machine('create -d azure --azure-subscription-id="%s" --azure-subscription-cert="%s" %s' % (AZURE_SUBSCRIPTION_ID,
-                                                                                                            AZURE_CERTIFICATE,
-                                                                                                            args.parameters[1]),
-                        threadName="create %s" % args.parameters[1])
-            else:
+            azure = credentials.azure()
+            if not (azure.subscription_id and azure.certificate):
                 log.warn("Missing Azure credentials, set them in ~/.storm/azure/")
+                raise SystemExit
 
         elif provider == "aws":
-            if AWS_ACCESS_KEY and AWS_SECRET_KEY:
-                machine('create -d amazonec2 --amazonec2-access-key="%s" --amazonec2-secret-key="%s" %s' % (AWS_ACCESS_KEY,
-                                                                                                            AWS_SECRET_KEY,
-                                                                                                            args.parameters[1]),
-                        threadName="create %s" % args.parameters[1])
-            else:
+            aws = credentials.aws()
+            if not (aws.access_key and aws.secret_key):
                 log.warn("Missing AWS credentials, set them as standard credentials in ~/.aws/credentials")
+                raise SystemExit
 
         elif provider == "digitalocean":
-            if AWS_ACCESS_KEY and AWS_SECRET_KEY:
-                machine('create -d digitalocean --digitalocean-access-token="%s" %s' % (DIGITALOCEAN_ACCESS_TOKEN,
-                                                                                        args.parameters[1]),
-                        threadName="create %s" % args.parameters[1])
-            else:
+            if not credentials.digitalocean().token:
                 log.warn("Missing DigitalOcean token, set it in ~/.storm/digitalocean/token")
+                raise SystemExit
 
         else:
             log.warn("Unknown provider or not implemented yet.")
+            raise SystemExit
+
+        # Joins the swarm if there's one, claiming a standby machine with default options if there's any
+        inventory = Inventory(probe=args.probe, refresh=args.refresh)
+        instance = {"provider": provider, "name": name}
+        if inventory.discovery:
+            instance["discovery"] = inventory.discovery_ip
+        with trace.phase("launch"):
+            create(instance)
+        update_cache([name])
+        notify_changed()
+        pool.refill()
+        raise SystemExit
+
+    elif args.command == "bake":
+        # Make sure we have docker-machine certificates
+        create_certs()
+
+        if not args.parameters or args.parameters[0] not in bake.CAPTURES:
+            log.warn("Please select a provider (%s) and optionally regions." % ", ".join(sorted(bake.CAPTURES)))
+            raise SystemExit
+
+        provider = args.parameters[0]
+        regions = args.parameters[1:] or [bake.DEFAULT_REGIONS[provider]]
+        images = bake.bake_images(load_yaml() if os.path.exists("storm.yml") else None)
+        run(bake.bake_all_async(provider, regions, images))
+        raise SystemExit
+
+    elif args.command == "pool":
+        if not args.parameters:
+            for name, entry in sorted(pool.load().items()):
+                log.info("%s (%s, %s)" % (name, entry["provider"],
+                                          ", ".join("%s: %s" % option for option in sorted(entry["options"].items())
+                                                    if option[0] != "discovery")))
+        elif args.parameters[0] == "fill":
+            create_certs()
+            storm = load_yaml()
+            scheduler.configure(storm.get("limits"))
+            inventory = Inventory(probe=args.probe, refresh=args.refresh)
+            if not inventory.discovery:
+                log.error("%sERROR%s: No discovery instance, standby machines need one to join the swarm, "
+                          "deploy first." % (colors.RED, colors.ENDC))
+                raise SystemExit(1)
+            with trace.phase("pool fill"):
+                run(pool_fill_async(pool_groups(storm, inventory.discovery_ip)))
+        elif args.parameters[0] == "drain":
+            names = pool.standby()
+            if not names:
+                log.info("No standby machines.")
+            elif console.confirm("This will remove %d standby machines, continue?" % len(names), default=False):
+                with trace.phase("pool drain"):
+                    pool_drain(names)
+        else:
+            log.warn("Usage: pool [fill|drain]")
         raise SystemExit
 
     elif args.command == "deploy":
@@ -252,178 +603,53 @@ def main():
                  colors.PURPLE, summary["discovery"]["total"], colors.ENDC, colors.BLUE, len(storm["discovery"]), colors.ENDC))
 
         # Confirm setup parameters
-        if not confirm("Continue?"):
+        if not console.confirm("Continue?"):
             log.warn("Aborting...")
             raise SystemExit
 
-        names = []
-        instances = {}
-        discovery = {}
-        inventory = Inventory()
-        log.debug("Current inventory: %s, %s" % (inventory.discovery, inventory.instances))
-
-        #
-        # Launch discovery instances
-        #
-        log.info("Launching %sdiscovery%s instances..." % (colors.PURPLE, colors.ENDC))
-
-        # Launch service discovery instances
-        for provider in storm["discovery"]:
-            if isinstance(storm["discovery"][provider], list):
-                for l, location in enumerate(storm["discovery"][provider]):
-                    for index in range(location["scale"]):
-                        name = "consul-%s-%d-%d-%s" % (provider, l, index, str(uuid.uuid4())[:8])
-                        instance = location.copy()
-                        instance["provider"] = provider
-                        instance["name"] = name
-                        discovery[name] = instance
-            else:
-                for index in range(storm["discovery"][provider]["scale"]):
-                    name = "consul-%s-%d-%s" % (provider, index, str(uuid.uuid4())[:8])
-                    instance = storm["discovery"][provider].copy()
-                    instance["provider"] = provider
-                    instance["name"] = name
-                    discovery[name] = instance
-
-        if len(discovery) == 1:
-            log.warn("%sWARNING%s: Using a single instance for service discovery provides no fault tolerance." % (colors.YELLOW, colors.ENDC))
-
-        if summary["discovery"]["total"] and not inventory.discovery:
-            with settings(warn_only=False), rollback(discovery.keys()):
-                launch(discovery)
-
-            # Deploy Consul on discovery instances
-            inventory = Inventory()
-            log.info("Deploying %sConsul%s%s..." % (colors.PURPLE, colors.ENDC, " cluster" if len(inventory.discovery) > 1 else ""))
-            encrypt = base64.b64encode(str(uuid.uuid4()).replace('-', '')[:16])
-            deploy_consul(inventory.discovery, encrypt)
-
-        # Add discovery instances names to list
-        for name in inventory.discovery:
-            names.append(name)
-
-        # FIXME Setting discovery as first IP of Consul cluster until DNS setup is implemented
-        discovery_host = inventory.discovery[inventory.discovery.keys()[0]]
-
-        #
-        # Launch cluster instances
-        #
-        log.info("Launching %scluster%s instances..." % (colors.BLUE, colors.ENDC))
-
-        for provider in storm["hosts"]:
-            if isinstance(storm["hosts"][provider], list):
-                for l, location in enumerate(storm["hosts"][provider]):
-                    for index in range(location["scale"]):
-                        name = "storm-%s-%d-%d-%s" % (provider, l, index, str(uuid.uuid4())[:8])
-                        instance = location.copy()
-                        instance["discovery"] = discovery_host
-                        instance["provider"] = provider
-                        instance["name"] = name
-                        instances[name] = instance
-            else:
-                for index in range(storm["hosts"][provider]["scale"]):
-                    name = "storm-%s-%d-%s" % (provider, index, str(uuid.uuid4())[:8])
-                    instance = storm["hosts"][provider].copy()
-                    instance["discovery"] = discovery_host
-                    instance["provider"] = provider
-                    instance["name"] = name
-                    instances[name] = instance
-
-        if summary["hosts"]["total"] and not inventory.instances:
-            launch(instances)
-
-            # Reload inventory
-            inventory = Inventory()
-
-        log.info("Launched %s%d instances%s, %s%d discovery instances%s" % (
-                 colors.GREEN, len(inventory.instances), colors.ENDC,
-                 colors.PURPLE, len(inventory.discovery), colors.ENDC))
-
-        # Need a better way to get the swarm master...
-        swarm_master = inventory.instances.keys()[0]
-
-        # Deploy and scale registrator to all instances
-        log.info("Deploying %sregistrator%s..." % (colors.GREEN, colors.ENDC))
-        deploy_registrator(
-            swarm_master,
-            len(inventory.instances),
-            discovery_host)
-
-        # Prepare instances for HAProxy (transfer certificate for HTTPS)
-        log.info("Preparing %sHAProxy%s..." % (colors.GREEN, colors.ENDC))
-        prepare_haproxy(inventory.instances.keys())
-
-        # Deploy HAProxy
-        log.info("Deploying %s%d HAProxy%s instances..." % (colors.GREEN, storm["load_balancers"], colors.ENDC))
-        deploy_haproxy(
-            swarm_master,
-            storm["load_balancers"],
-            discovery_host)
-
-        # Add cluster instances names to list
-        for name in inventory.instances:
-            names.append(name)
-
-        # List inventory
-        if args.debug:
-            # List machines
-            machines = machine_list()
-            log.info("Machines:")
-            log.info(machines)
-            log.info("===")
-
-            log.debug('Discovery: %s' % inventory.discovery)
-            log.debug('Instances: %s' % inventory.instances)
-            log.debug("Names: %s" % names)
-
-        # Deploy services
-        for name in storm["deploy"]:
-            services = storm["deploy"][name]["services"]
-            for service in services:
-                log.info("Deploying %s%s%s..." % (colors.GREEN, service, colors.ENDC))
-                config = services[service]
-                # with lcd(os.path.join(os.getcwd(), 'deploy', name)):
-                compose_on(swarm_master, "up -d", discovery_host,
-                           cwd=os.path.join(os.getcwd(), 'deploy', name))
-                compose_on(swarm_master, "scale %s=%d" % (service, config["scale"]), discovery_host,
-                           cwd=os.path.join(os.getcwd(), 'deploy', name))
+        names = run(deploy_cluster(storm, summary, args))
+        pool.refill()
 
         # Teardown?
-        if confirm("Teardown running instances?", default=False):
-            teardown(names)
+        if console.confirm("Teardown running instances?", default=False):
+            with trace.phase("teardown"):
+                teardown(names)
+            notify_changed()
 
     elif args.command == "repair":
         log.warn("Not implemented, yet.")
         raise SystemExit
 
     elif args.command == "ps":
-        inventory = Inventory()
-        discovery_host = inventory.discovery[inventory.discovery.keys()[0]]  # FIXME
-        master_instance = inventory.instances.keys()[0]  # FIXME too
-        out = docker_on(master_instance, "ps " + " ".join(args.parameters), discovery_host, threadName="ps swarm %s" % master_instance, capture=True)
-        print out
+        inventory = Inventory(probe=args.probe, refresh=args.refresh)
+        discovery_host = inventory.discovery_ip  # FIXME
+        master_instance = inventory.master  # FIXME too
+        out = docker_on(master_instance, "ps " + " ".join(args.parameters), discovery_host, threadName="ps swarm %s" % master_instance, stream=True)
+        if out is not None:
+            with out:
+                for line in out:
+                    sys.stdout.write(line)
 
     elif args.command == "env":
-        inventory = Inventory()
+        inventory = Inventory(probe=args.probe, refresh=args.refresh)
         if args.parameters[0] == 'swarm':
-            instance = inventory.instances.keys()[0]
-            out = machine("env --shell bash --swarm %s" % instance, threadName="env %s" % instance, capture=True)
+            instance = inventory.master
+            out = machine_exports(instance, swarm=True)
             print out
         elif args.parameters[0] == 'discovery':
-            instance = inventory.discovery.keys()[int(args.parameters[1])]
-            out = machine("env --shell bash %s" % instance, threadName="env %s" % instance, capture=True)
+            instance = inventory.get("discovery", int(args.parameters[1])).name
+            out = machine_exports(instance)
             print out
         else:
-            instance = inventory.instances.keys()[int(args.parameters[0])]
-            out = machine("env --shell bash %s" % instance,
-                          threadName="env %s" % instance, capture=True)
+            instance = inventory.get("host", int(args.parameters[0])).name
+            out = machine_exports(instance)
             print out
 
     else:
         if args.command:
-            inventory = Inventory()
-            discovery_host = inventory.discovery[inventory.discovery.keys()[0]]  # FIXME
-            master_instance = inventory.instances.keys()[0]  # FIXME too
+            inventory = Inventory(probe=args.probe, refresh=args.refresh)
+            discovery_host = inventory.discovery_ip  # FIXME
+            master_instance = inventory.master  # FIXME too
             compose_on(master_instance, args.command + " " + " ".join(args.parameters), discovery_host, verbose=True)
         else:
             log.warn("No docker-compose arguments found to process.")
@@ -3,23 +3,38 @@ import os
 import time
 import random
 import logging
-import colorlog
 import threading
 import subprocess
-import ConfigParser
 import concurrent.futures as futures
 
 from colors import colors
-from progressbar import ProgressBar, Percentage, Bar, Timer, ETA
+from lazy import lazy_import
+from credentials import credentials
+from debuglog import AsyncFileHandler
+from inventory import update_cache
+from engine import EngineError, UnsupportedOptions, engine_for, discard
+from pump import spawn, then
+import coroutines
+from coroutines import Return, blocking, current_task, gather
+from context import TaskContext
+from scheduler import scheduler_for, throttled
+from capture import CaptureBuffer
+import bulk
+import pool
+import hedge
+import trace
+import store
 from contextlib import contextmanager
-from fabric.state import output
-from fabric.api import settings, task, abort
 
-import boto
-from boto.exception import EC2ResponseError
-
-from azure.servicemanagement import ServiceManagementService, ConfigurationSetInputEndpoint
-from azure.common import AzureHttpError
+# Heavy dependencies are only imported when a command actually needs them
+# uuid forks ldconfig on import in Python 2
+uuid = lazy_import("uuid")
+boto = lazy_import("boto")
+boto_exception = lazy_import("boto.exception")
+servicemanagement = lazy_import("azure.servicemanagement")
+azure_common = lazy_import("azure.common")
+fabric_api = lazy_import("fabric.api")
+colorlog = lazy_import("colorlog")
 
 log = logging.getLogger(__name__)
 
@@ -27,68 +42,54 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 logging.getLogger('boto').setLevel(logging.CRITICAL)
 
+class DebugFormatter(logging.Formatter):
+    """
+    Colored debug formatter, colorlog is only loaded for the first record
+    """
+    def __init__(self):
+        logging.Formatter.__init__(self)
+        self.formatter = None
+
+    def format(self, record):
+        if self.formatter is None:
+            self.formatter = colorlog.ColoredFormatter(
+                '%(log_color)s%(levelname)-8s%(reset)s [%(asctime)s] [%(blue)s%(name)s.%(funcName)s%(reset)s:%(bold)s%(lineno)d%(reset)s] %(message)s',
+                datefmt="%H:%M:%S",
+                reset=True,
+                log_colors=colorlog.default_log_colors)
+        return self.formatter.format(record)
+
+
 # Debug formatter
-formatter = colorlog.ColoredFormatter(
-    '%(log_color)s%(levelname)-8s%(reset)s [%(asctime)s] [%(blue)s%(name)s.%(funcName)s%(reset)s:%(bold)s%(lineno)d%(reset)s] %(message)s',
-    datefmt="%H:%M:%S",
-    reset=True,
-    log_colors=colorlog.default_log_colors)
+formatter = DebugFormatter()
 
 # Debug logger
 debug = logging.getLogger('debug')
 debug.setLevel(logging.DEBUG)
 debug.propagate = False
 debug_logfile = os.path.join(os.path.expanduser("~"), ".storm", 'debug.log')
-debuglog = logging.handlers.RotatingFileHandler(debug_logfile, backupCount=5, delay=True)
-if os.path.exists(debug_logfile):
-    debuglog.doRollover()
+debuglog = AsyncFileHandler(debug_logfile, backup_count=5)
 debuglog.setLevel(logging.DEBUG)
 debuglog.setFormatter(formatter)
 debug.addHandler(debuglog)
 
-# Get AWS credentials
-try:
-    path = os.path.join(os.path.expanduser("~"), ".storm", "aws")
-    config = ConfigParser.ConfigParser()
-    config.read([str(os.path.join(path, "credentials"))])
-    AWS_ACCESS_KEY = config.get('Credentials', 'aws_access_key_id')
-    AWS_SECRET_KEY = config.get('Credentials', 'aws_secret_access_key')
-except:
-    # logging.warn("No AWS credentials set. Please set them in ~/.aws/credentials")
-    AWS_ACCESS_KEY = None
-    AWS_SECRET_KEY = None
-
-# Get Azure credentials
-try:
-    path = os.path.join(os.path.expanduser("~"), ".storm", "azure")
-    subscription_id_path = os.path.join(path, "subscription-id")
-    with open(subscription_id_path, 'r') as f:
-        AZURE_SUBSCRIPTION_ID = f.read().splitlines()[0]
-    AZURE_CERTIFICATE = os.path.join(path, "certificate.pem")
-except Exception as e:
-    # logging.warn("Unable to read Azure credentials in ~/.storm/azure: %s" % repr(e))
-    AZURE_SUBSCRIPTION_ID = None
-    AZURE_CERTIFICATE = None
-
-# Get DigitalOcean credentials
-try:
-    path = os.path.join(os.path.expanduser("~"), ".storm", "digitalocean")
-    with open(os.path.join(path, "token"), 'r') as f:
-        DIGITALOCEAN_ACCESS_TOKEN = f.read().splitlines()[0]
-except Exception as e:
-    # logging.warn("Unable to read DigitalOcean credentials in ~/.storm/digitalocean: %s" % repr(e))
-    DIGITALOCEAN_ACCESS_TOKEN = None
-
-widgets = ['Progress: ', Percentage(), '   ', Timer(), ' ', Bar(marker='#', left='[', right=']'), ' ', ETA()]
-completed = 0
-
-ticker = None
-def tick(progress):
-    global ticker
-    global completed
-    progress.update(completed)
-    ticker = threading.Timer(1.0, tick, args=[progress])
-    ticker.start()
+def task(func):
+    """
+    Mark a function as a task
+
+    Fabric's @task only matters for fabfile discovery, using it here would
+    import Fabric along with this module.
+    """
+    return func
+
+def quiet_fabric(api):
+    # Set Fabric' output level, defaults:
+    # {'status': True, 'stdout': True, 'warnings': True, 'running': True,
+    #  'user': True, 'stderr': True, 'aborts': True, 'debug': False}
+    api.output['aborts'] = False
+    api.output['warnings'] = False
+    api.output['running'] = False
+    api.output['status'] = False
 
 def set_logging(debug=False):
     if debug:
@@ -102,14 +103,8 @@ def set_logging(debug=False):
             format="%(message)s",
             datefmt="%H:%M:%S")
 
-        # Set Fabric' output level, defaults:
-        # {'status': True, 'stdout': True, 'warnings': True, 'running': True,
-        #  'user': True, 'stderr': True, 'aborts': True, 'debug': False}
-        if not debug:
-            output['aborts'] = False
-            output['warnings'] = False
-            output['running'] = False
-            output['status'] = False
+        # Quiet Fabric whenever it ends up being loaded
+        fabric_api.when_loaded(quiet_fabric)
 
 @contextmanager
 def rollback(instances):
@@ -117,10 +112,103 @@ def rollback(instances):
         yield
     except SystemExit:
         teardown(instances)
-        abort("Bad failure...")
+        fabric_api.abort("Bad failure...")
+
+class EnvironmentCache(object):
+    """
+    Parsed machine environments by (instance, swarm)
+
+    Concurrent lookups of the same machine share a single call to `loader`,
+    failures are not cached.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.environments = {}
+        self.pending = {}
+
+    def get(self, instance, swarm=False):
+        key = (instance, swarm)
+        with self.lock:
+            if key in self.environments:
+                return dict(self.environments[key])
+            future = self.pending.get(key)
+            leader = future is None
+            if leader:
+                future = futures.Future()
+                self.pending[key] = future
+
+        if leader:
+            try:
+                env = self.loader(instance, swarm)
+            except Exception as e:
+                with self.lock:
+                    if self.pending.get(key) is future:
+                        del self.pending[key]
+                future.set_exception(e)
+                raise
+            with self.lock:
+                # Don't keep results for machines invalidated in the meantime
+                if self.pending.get(key) is future:
+                    del self.pending[key]
+                    if env:
+                        self.environments[key] = env
+            future.set_result(env)
+
+        env = future.result()
+        return dict(env) if env else env
+
+    def invalidate(self, instance=None):
+        """
+        Forget environments of a removed or recreated machine, or all of them
+        """
+        with self.lock:
+            for cache in (self.environments, self.pending):
+                for key in cache.keys():
+                    if instance is None or key[0] == instance:
+                        del cache[key]
+        # Recreated machines get new certificates
+        discard(os.path.join(store.machines_path(), instance) if instance else None)
 
 def machine_env(instance, swarm=False):
+    return environments.get(instance, swarm)
+
+def machine_env_async(instance, swarm=False):
+    """
+    Future for machine_env(), loaded off the event loop
+    """
+    return blocking(machine_env, instance, swarm)
+
+def load_machine_env(instance, swarm=False):
+    """
+    Work out the environment from the docker-machine store, only asking
+    docker-machine when that's not possible
+    """
+    mach = store.load(instance)
+    env = store.environment(mach, swarm) if mach else None
+    if env:
+        return env
+    return export_machine_env(instance, swarm)
+
+def machine_exports(instance, swarm=False):
+    """
+    Shell exports for a machine's environment, like `docker-machine env`
+    """
+    mach = store.load(instance)
+    env = store.environment(mach, swarm) if mach else None
+    if not env:
+        return machine("env --shell bash %s%s" % ("--swarm " if swarm else "", instance),
+                       threadName="env %s" % instance, capture=True)
+    return ('export DOCKER_TLS_VERIFY="{DOCKER_TLS_VERIFY}"\n'
+            'export DOCKER_HOST="{DOCKER_HOST}"\n'
+            'export DOCKER_CERT_PATH="{DOCKER_CERT_PATH}"\n'
+            'export DOCKER_MACHINE_NAME="{name}"\n'
+            '# Run this command to configure your shell: \n'
+            '# eval $(docker-machine env{swarm} {name})').format(name=instance, swarm=" --swarm" if swarm else "", **env)
+
+def export_machine_env(instance, swarm=False):
     env = {}
+    tls = cert_path = host = None
     log.debug("Getting environment for %s" % instance)
     env_export = machine("env --shell bash %s%s" % ("--swarm " if swarm else "", instance), capture=True, threadName="env %s" % instance)
     log.debug("Environment: %s" % env_export)
@@ -146,86 +234,144 @@ def machine_env(instance, swarm=False):
     env['DOCKER_HOST'] = host
     return env
 
-def local(cmd, capture=False, threadName=None, cwd=None, env=None, verbose=False):
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd, env=env)
-    stdout = []
-    previous = None
-    if threadName:
-        color = colors.LIST[random.randint(0, len(colors.LIST) - 1)]
-        threadName = "%s%s%s" % (color, threadName, colors.ENDC)
-    while True:
-        line = p.stdout.readline()
-        if line != '' and line != "\n":
-            previous = line[:-1]
-        if capture and line:
-            stdout.append(line)
-        rc = p.poll()
+
+environments = EnvironmentCache(load_machine_env)
+
+class OutputLogger(object):
+    """
+    Logs a command's output line by line, keeping the last non-empty line
+    to report if the command fails, captured output goes to a CaptureBuffer
+    which is returned as is with `stream=True`
+    """
+    def __init__(self, cmd, capture=False, threadName=None, verbose=False, stream=False, span=None):
+        self.cmd = cmd
+        self.span = span
+        self.capture = capture or stream
+        self.stream = stream
+        self.verbose = verbose
+        self.stdout = CaptureBuffer() if self.capture else None
+        self.previous = None
         if threadName:
-            if (rc is None or rc == 0) and "Error" not in line:
-                debug.debug("[%s] %s" % (threadName, line[:-1]))
-                if verbose:
-                    log.info("[%s] %s" % (threadName, line[:-1]))
-            else:
-                if "Error" in line:
-                    log.error("%sERROR%s [%s]: %s" % (colors.RED, colors.ENDC, threadName, line[:-1]))
-                    debug.error(line[:-1])
-                else:
-                    log.error("%sERROR%s [%s]: %s" % (colors.RED, colors.ENDC, threadName, previous))
-                    debug.error(previous)
-        else:
-            if (rc is None or rc == 0) and "Error" not in line:
-                debug.debug(line[:-1])
-                if verbose:
-                    log.info(line[:-1])
-            else:
-                if "Error" in line:
-                    log.error("%sERROR%s: %s" % (colors.RED, colors.ENDC, line[:-1]))
-                    debug.error(line[:-1])
-                else:
-                    log.error("%sERROR%s: %s" % (colors.RED, colors.ENDC, previous))
-                    debug.error(previous)
-        if line == '' and rc is not None:
-            if rc != 0:
-                raise subprocess.CalledProcessError(rc, cmd, previous)
-            break
-    return "".join(stdout)
+            color = colors.LIST[random.randint(0, len(colors.LIST) - 1)]
+            threadName = "%s%s%s" % (color, threadName, colors.ENDC)
+        self.threadName = threadName
 
-def docker(cmd, threadName=None, capture=False, cwd=None, env=None):
+    def error(self, message):
+        if self.threadName:
+            log.error("%sERROR%s [%s]: %s" % (colors.RED, colors.ENDC, self.threadName, message))
+        else:
+            log.error("%sERROR%s: %s" % (colors.RED, colors.ENDC, message))
+        debug.error(message)
+
+    def line(self, line):
+        if self.span:
+            self.span.output()
+        if line != "\n":
+            self.previous = line[:-1]
+        if self.capture:
+            self.stdout.write(line)
+        if "Error" in line:
+            self.error(line[:-1])
+        else:
+            message = "[%s] %s" % (self.threadName, line[:-1]) if self.threadName else line[:-1]
+            debug.debug(message)
+            if self.verbose:
+                log.info(message)
+
+    def exit(self, rc):
+        if self.span:
+            self.span.exit(rc)
+        if rc != 0:
+            if self.stdout is not None:
+                self.stdout.close()
+            self.error(self.previous)
+            raise subprocess.CalledProcessError(rc, self.cmd, self.previous)
+        if self.stdout is None:
+            return ""
+        if self.stream:
+            return self.stdout
+        with self.stdout:
+            return self.stdout.getvalue()
+
+def local_async(cmd, capture=False, threadName=None, cwd=None, env=None, verbose=False, stream=False):
+    """
+    Start a command on the output pump, returns a future for its output,
+    with `stream=True` a CaptureBuffer the caller iterates and closes
+    """
+    output = OutputLogger(cmd, capture=capture, threadName=threadName, verbose=verbose, stream=stream,
+                          span=trace.process(cmd, threadName, env))
+    # Processes of coroutines get a session of their own so cancelling can kill them
+    task = current_task()
+    future = spawn(cmd, on_line=output.line, on_exit=output.exit, cwd=cwd, env=env, session=task is not None)
+    if task is not None:
+        task.track(future.process)
+    return future
+
+def local(cmd, capture=False, threadName=None, cwd=None, env=None, verbose=False, stream=False):
+    return local_async(cmd, capture=capture, threadName=threadName, cwd=cwd, env=env, verbose=verbose,
+                       stream=stream).result()
+
+def docker(cmd, threadName=None, capture=False, cwd=None, env=None, stream=False):
     """
     Run Docker command
     """
-    try:
-        out = local("docker %s" % cmd, threadName=threadName, capture=capture, cwd=cwd, env=env)
-        return out
-    except subprocess.CalledProcessError as e:
-        debug.error("Exception running docker: %s" % e)
+    return docker_async(cmd, threadName=threadName, capture=capture, cwd=cwd, env=env, stream=stream).result()
+
+def docker_async(cmd, threadName=None, capture=False, cwd=None, env=None, stream=False):
+    """
+    Start Docker command, returns a future for its output
+    """
+    def done(future):
+        try:
+            return future.result()
+        except subprocess.CalledProcessError as e:
+            debug.error("Exception running docker: %s" % e)
+    return then(local_async("docker %s" % cmd, threadName=threadName, capture=capture, cwd=cwd, env=env, stream=stream),
+                done)
 
-def machine(cmd, threadName=None, capture=False, progress=None):
+def machine(cmd, threadName=None, capture=False, context=None):
     """
     Run Machine command
     """
-    try:
-        out = local("docker-machine %s" % cmd, threadName=threadName, capture=capture)
-        if progress:
-            global completed
-            completed += 1
-            progress.update(completed)
+    return machine_async(cmd, threadName=threadName, capture=capture, context=context).result()
+
+def machine_async(cmd, threadName=None, capture=False, context=None):
+    """
+    Start Machine command, returns a future for its output
+    """
+    def done(future):
+        try:
+            out = future.result()
+        except subprocess.CalledProcessError as e:
+            debug.error("Exception running docker-machine: %s" % e)
+            return None
+        if context:
+            context.advance(1)
         return out
-    except subprocess.CalledProcessError as e:
-        debug.error("Exception running docker-machine: %s" % e)
+    return then(local_async("docker-machine %s" % cmd, threadName=threadName, capture=capture), done)
 
-def compose(cmd, threadName=None, progress=None, cwd=None, env=None, verbose=False):
+def compose(cmd, threadName=None, context=None, cwd=None, env=None, verbose=False, capture=False):
     """
     Run Compose command
     """
-    try:
-        local("docker-compose %s" % cmd, threadName=threadName, cwd=cwd, env=env, verbose=verbose)
-        if progress:
-            global completed
-            completed += 1
-            progress.update(completed)
-    except subprocess.CalledProcessError as e:
-        debug.error("Exception running docker-compose: %s" % e)
+    return compose_async(cmd, threadName=threadName, context=context, cwd=cwd, env=env, verbose=verbose,
+                         capture=capture).result()
+
+def compose_async(cmd, threadName=None, context=None, cwd=None, env=None, verbose=False, capture=False):
+    """
+    Start Compose command, returns a future for its output
+    """
+    def done(future):
+        try:
+            out = future.result()
+        except subprocess.CalledProcessError as e:
+            debug.error("Exception running docker-compose: %s" % e)
+            return None
+        if context:
+            context.advance(1)
+        return out
+    return then(local_async("docker-compose %s" % cmd, threadName=threadName, capture=capture, cwd=cwd, env=env,
+                            verbose=verbose), done)
 
 def machine_list():
     """
@@ -256,84 +402,111 @@ def stop(name, rm=True, env=None):
 def exec_(container, command, env=None):
     docker("exec -it %s %s", container, command, env=env)
 
-def run_on(instance, image, options="", command="", name=None, progress=None):
+def engine_on(instance):
+    """
+    Engine API client for an instance, sharing its pooled connections
+    """
+    env = machine_env(instance)
+    if not env:
+        fabric_api.abort("Error getting machine environment")
+    return engine_for(env)
+
+def run_on(instance, image, options="", command="", name=None, context=None):
     if name is None:
         name = instance
 
     env = machine_env(instance)
 
     if not env:
-        abort("Error getting machine environment")
+        fabric_api.abort("Error getting machine environment")
 
-    docker("run --name %s %s %s %s" % (name, options, image, command), threadName="run %s" % name, env=env)
+    try:
+        engine_for(env).run(image, options, command, name=name)
+    except UnsupportedOptions as e:
+        debug.debug("Running %s with the docker client: %s" % (name, e))
+        docker("run --name %s %s %s %s" % (name, options, image, command), threadName="run %s" % name, env=env)
+    except EngineError as e:
+        debug.error("Exception running %s on %s: %s" % (name, instance, e))
     debug.info("Started on %s: %s" % (instance, image))
 
-    if progress:
-        global completed
-        completed += 9
-        progress.update(completed)
-
-def stop_on(instance, rm=True, progress=None):
-    global completed
+    if context:
+        context.advance(9)
 
-    env = machine_env(instance)
-
-    if not env:
-        abort("Error getting machine environment")
+def stop_on(instance, rm=True, context=None):
+    engine = engine_on(instance)
 
-    docker("stop --time=30 %s" % instance, threadName="stop %s" % instance, env=env)
+    try:
+        engine.stop(instance, timeout=30)
+    except EngineError as e:
+        debug.error("Exception stopping %s: %s" % (instance, e))
     debug.info("Stopped: %s" % instance)
 
-    if progress:
-        completed += 9
-        progress.update(completed)
+    if context:
+        context.advance(9)
 
     if rm:
-        docker("rm -f %s" % instance, threadName="rm %s" % instance, env=env)
+        try:
+            engine.rm(instance, force=True)
+        except EngineError as e:
+            debug.error("Exception removing %s: %s" % (instance, e))
         debug.info("Removed: %s" % instance)
-        if progress:
-            completed += 9
-            progress.update(completed)
+        if context:
+            context.advance(9)
 
-def docker_on(instance, command, discovery=None, threadName=None, capture=False):
+def docker_on(instance, command, discovery=None, threadName=None, capture=False, stream=False):
     env = machine_env(instance, swarm=True if discovery else False)
     if not env:
-        abort("Error getting machine environment")
+        fabric_api.abort("Error getting machine environment")
     if discovery:
         env["DISCOVERY_IP"] = discovery
-        return docker(command, threadName=threadName, capture=capture, env=env)
+        return docker(command, threadName=threadName, capture=capture, env=env, stream=stream)
     else:
-        return docker(command, threadName=threadName, capture=capture, env=env)
+        return docker(command, threadName=threadName, capture=capture, env=env, stream=stream)
 
 def exec_on(instance, container, command):
     env = machine_env(instance)
     if not env:
-        abort("Error getting machine environment")
+        fabric_api.abort("Error getting machine environment")
     exec_(container, command, env=env)
 
 def pull_on(instance, image):
-    env = machine_env(instance)
-    if not env:
-        abort("Error getting machine environment")
-    pull(image, env=env)
+    try:
+        engine_on(instance).pull(image)
+    except EngineError as e:
+        debug.error("Exception pulling %s on %s: %s" % (image, instance, e))
 
 def build_on(instance, folder, tag, cwd=None):
     env = machine_env(instance)
     if not env:
-        abort("Error getting machine environment")
+        fabric_api.abort("Error getting machine environment")
     build(folder, tag, cwd=cwd, env=env)
 
-def compose_on(instance, command, discovery=None, cwd=None, verbose=False):
+def compose_on(instance, command, discovery=None, cwd=None, verbose=False, capture=False):
     env = machine_env(instance, swarm=True if discovery else False)
     if not env:
-        abort("Error getting machine environment")
+        fabric_api.abort("Error getting machine environment")
     if discovery:
         env["DISCOVERY_IP"] = discovery
-        compose(command, threadName="compose %s" % instance, cwd=cwd, env=env, verbose=verbose)
+        out = compose(command, threadName="compose %s" % instance, cwd=cwd, env=env, verbose=verbose, capture=capture)
     else:
-        compose(command, threadName="compose %s" % instance, cwd=cwd, env=env, verbose=verbose)
+        out = compose(command, threadName="compose %s" % instance, cwd=cwd, env=env, verbose=verbose, capture=capture)
     debug.info("Composed on %s: %s" % (instance, command))
     log.info("Composed on %s: %s" % (instance, command))
+    return out
+
+def compose_on_async(instance, command, discovery=None, cwd=None, verbose=False, capture=False):
+    """
+    Coroutine for compose_on()
+    """
+    env = yield machine_env_async(instance, swarm=True if discovery else False)
+    if not env:
+        fabric_api.abort("Error getting machine environment")
+    if discovery:
+        env["DISCOVERY_IP"] = discovery
+    out = yield compose_async(command, threadName="compose %s" % instance, cwd=cwd, env=env, verbose=verbose, capture=capture)
+    debug.info("Composed on %s: %s" % (instance, command))
+    log.info("Composed on %s: %s" % (instance, command))
+    raise Return(out)
 
 def ssh_on(instance, command):
     machine("ssh %s -- %s" % (instance, command), threadName="ssh %s" % instance)
@@ -341,314 +514,566 @@ def ssh_on(instance, command):
 def scp_to(instance, src, dest):
     machine("scp %s %s:%s" % (src, instance, dest), threadName="scp %s" % instance)
 
-def create(instance, capture=True, progress=None):
-    global completed
-
-    # Delay instantiations slightly
-    index = int(instance["name"].split("-")[-2])
-    time.sleep(index)
-
-    if instance["provider"] == "aws":
-        completed += 1
-        progress.update(completed)
-
-        create_aws(instance["name"],
-                   vpc=instance["vpc"] if "vpc" in instance else None,
-                   ami=instance["ami"] if "ami" in instance else None,
-                   zone=instance["zone"] if "zone" in instance else "c",
-                   region=instance["region"] if "region" in instance else "us-east-1",
-                   instance_type=instance["size"] if "size" in instance else "t2.medium",
-                   security_group=instance["security_group"] if "security_group" in instance else "docker-storm",
-                   discovery=instance["discovery"] if "discovery" in instance else None,
-                   progress=progress)
-
-    elif instance["provider"] == "azure":
-        completed += 1
-        progress.update(completed)
-
-        create_azure(instance["name"],
-                     size=instance["size"] if "size" in instance else "Small",
-                     image=instance["image"] if "image" in instance else None,
-                     location=instance["location"] if "location" in instance else "East US",
-                     discovery=instance["discovery"] if "discovery" in instance else None,
-                     progress=progress)
-
-    elif instance["provider"] == "digitalocean":
-        completed += 1
-        progress.update(completed)
-
-        create_digitalocean(instance["name"],
-                            size=instance["size"] if "size" in instance else "512mb",
-                            image=instance["image"] if "image" in instance else None,
-                            region=instance["region"] if "region" in instance else "nyc3",
-                            discovery=instance["discovery"] if "discovery" in instance else None,
-                            progress=progress)
-
-def create_aws(name, vpc=None, ami=None, region="us-east-1", zone="c", instance_type="t2.medium", security_group="docker-storm",
-               discovery=None, progress=None):
-    """
-    Launch an AWS instance
+
+CONSUL_IMAGE = "gliderlabs/consul-server:0.6"
+
+# create() options by provider, from storm.yml keys to create_* arguments
+CREATE_OPTIONS = {
+    "aws": {
+        "vpc": "vpc",
+        "ami": "ami",
+        "zone": "zone",
+        "region": "region",
+        "size": "instance_type",
+        "security_group": "security_group",
+        "storage_driver": "storage_driver",
+        "discovery": "discovery"
+    },
+    "azure": {
+        "size": "size",
+        "image": "image",
+        "location": "location",
+        "storage_driver": "storage_driver",
+        "discovery": "discovery"
+    },
+    "digitalocean": {
+        "size": "size",
+        "image": "image",
+        "region": "region",
+        "storage_driver": "storage_driver",
+        "discovery": "discovery"
+    }
+}
+
+# Overlay network and service ports opened on AWS instances
+AWS_PORTS = [{
+    'protocol': 'udp',
+    'from_port': '4789',
+    'to_port': '4789'
+}, {
+    'protocol': 'udp',
+    'from_port': '7946',
+    'to_port': '7946'
+}, {
+    'protocol': 'tcp',
+    'from_port': '7946',
+    'to_port': '7946'
+}, {
+    'protocol': 'tcp',  # TODO Separate service ports
+    'from_port': '80',
+    'to_port': '80'
+}, {
+    'protocol': 'tcp',
+    'from_port': '88',
+    'to_port': '88'
+}, {
+    'protocol': 'tcp',
+    'from_port': '443',
+    'to_port': '443'
+}, {
+    'protocol': 'tcp',
+    'from_port': '8545',
+    'to_port': '8545'
+}]
+
+# Endpoints added to Azure instances, Consul included as adding them later takes too long
+AZURE_ENDPOINTS = [{
+    'service': 'docker vxlan',
+    'protocol': 'udp',
+    'port': '4789',
+    'local_port': '4789'
+}, {
+    'service': 'serf udp',
+    'protocol': 'udp',
+    'port': '7946',
+    'local_port': '7946'
+}, {
+    'service': 'serf tcp',
+    'protocol': 'tcp',
+    'port': '7946',
+    'local_port': '7946'
+}, {
+    'service': 'consul rpc',
+    'protocol': 'tcp',
+    'port': '8300',
+    'local_port': '8300'
+}, {
+    'service': 'consul wan',
+    'protocol': 'tcp',
+    'port': '8302',
+    'local_port': '8302'
+}, {
+    'service': 'consul wan udp',
+    'protocol': 'udp',
+    'port': '8302',
+    'local_port': '8302'
+}, {
+    'service': 'consul',
+    'protocol': 'tcp',
+    'port': '8500',
+    'local_port': '8500'
+}, {
+    'service': 'http',  # TODO Separate service ports
+    'protocol': 'tcp',
+    'port': '80',
+    'local_port': '80'
+}, {
+    'service': 'haproxy stats',
+    'protocol': 'tcp',
+    'port': '88',
+    'local_port': '88'
+}, {
+    'service': 'https',
+    'protocol': 'tcp',
+    'port': '443',
+    'local_port': '443'
+}, {
+    'service': 'geth',
+    'protocol': 'tcp',
+    'port': '8545',
+    'local_port': '8545'
+}]
+
+def create_options(instance):
     """
-    try:
-        global completed
-
-        swarm_options = (
-            "--swarm --swarm-master "
-            "--swarm-opt='replication=true' "
-            # "--swarm-opt='advertise=eth0:3376' "
-            "--swarm-discovery='consul://{0}:8500' "
-            "--engine-opt='cluster-store=consul://{0}:8500' "
-            "--engine-opt='cluster-advertise=eth0:2376' ".format(discovery)
-        ) if discovery else ""
-
-        conf = {
-            "access_key": AWS_ACCESS_KEY,
-            "secret_key": AWS_SECRET_KEY,
-            "vpc": ("--amazonec2-vpc-id %s " % vpc) if vpc else "",
-            "region": region,
-            "zone": zone,
-            "instance_type": instance_type,
-            "security_group": security_group,
-            "ami": ("--amazonec2-ami %s " % ami) if ami else "",
-            "swarm": swarm_options,
-            "name": name
-        }
-        local(("docker-machine create "
-               "--engine-label com.storm.managed=true "
-               "--driver amazonec2 "
-               "--amazonec2-access-key {access_key} "
-               "--amazonec2-secret-key {secret_key} "
-               "{vpc}"
-               "--amazonec2-region {region} "
-               "--amazonec2-zone {zone} "
-               "--amazonec2-instance-type {instance_type} "
-               "--amazonec2-root-size 8 "
-               "--amazonec2-security-group {security_group} "
-               "{ami}"
-               "{swarm}"
-               "{name}").format(**conf), threadName="create %s" % name)
-
-        debug.info("Launched %s" % name)
-
-        if progress:
-            completed += 7
-            progress.update(completed)
-
-        # Open overlay network ports in security group
-        aws_security_group_ports(name, [{
-            'protocol': 'udp',
-            'from_port': '4789',
-            'to_port': '4789'
-        }, {
-            'protocol': 'udp',
-            'from_port': '7946',
-            'to_port': '7946'
-        }, {
-            'protocol': 'tcp',
-            'from_port': '7946',
-            'to_port': '7946'
-        }, {
-            'protocol': 'tcp',  # TODO Separate service ports
-            'from_port': '80',
-            'to_port': '80'
-        }, {
-            'protocol': 'tcp',
-            'from_port': '88',
-            'to_port': '88'
-        }, {
-            'protocol': 'tcp',
-            'from_port': '443',
-            'to_port': '443'
-        }, {
-            'protocol': 'tcp',
-            'from_port': '8545',
-            'to_port': '8545'
-        }], security_group)
+    Keyword arguments for the create command of an instance's provider
+    """
+    options = CREATE_OPTIONS[instance["provider"]]
+    return dict((argument, instance[key]) for key, argument in options.items() if key in instance)
 
-        if progress:
-            completed += 2
-            progress.update(completed)
+def create(instance, capture=True, context=None):
+    """
+    Create one machine, see create_async()
+    """
+    return coroutines.run(create_async(instance, context=context))
+
+def swarm_options(discovery):
+    if not discovery:
+        return ""
+    return (
+        "--swarm --swarm-master "
+        "--swarm-opt='replication=true' "
+        # "--swarm-opt='advertise=eth0:3376' "
+        "--swarm-discovery='consul://{0}:8500' "
+        "--engine-opt='cluster-store=consul://{0}:8500' "
+        "--engine-opt='cluster-advertise=eth0:2376' ".format(discovery)
+    )
+
+def storage_options(storage_driver):
+    # Baked images have their images pulled into this driver's graph
+    return ("--engine-storage-driver %s " % storage_driver) if storage_driver else ""
+
+def aws_create_command(name, vpc=None, ami=None, region="us-east-1", zone="c", instance_type="t2.medium",
+                       security_group="docker-storm", storage_driver=None, discovery=None):
+    aws = credentials.aws()
+    conf = {
+        "access_key": aws.access_key,
+        "secret_key": aws.secret_key,
+        "vpc": ("--amazonec2-vpc-id %s " % vpc) if vpc else "",
+        "region": region,
+        "zone": zone,
+        "instance_type": instance_type,
+        "security_group": security_group,
+        "ami": ("--amazonec2-ami %s " % ami) if ami else "",
+        "storage": storage_options(storage_driver),
+        "swarm": swarm_options(discovery),
+        "name": name
+    }
+    return ("docker-machine create "
+            "--engine-label com.storm.managed=true "
+            "--driver amazonec2 "
+            "--amazonec2-access-key {access_key} "
+            "--amazonec2-secret-key {secret_key} "
+            "{vpc}"
+            "--amazonec2-region {region} "
+            "--amazonec2-zone {zone} "
+            "--amazonec2-instance-type {instance_type} "
+            "--amazonec2-root-size 8 "
+            "--amazonec2-security-group {security_group} "
+            "{ami}"
+            "{storage}"
+            "{swarm}"
+            "{name}").format(**conf)
+
+def azure_create_command(name, size="Small", location="East US", image=None, storage_driver=None, discovery=None):
+    azure = credentials.azure()
+    conf = {
+        "subscription_id": azure.subscription_id,
+        "certificate": azure.certificate,
+        "size": size,
+        "location": location,
+        "image": ("--azure-image %s " % image) if image else "",
+        "storage": storage_options(storage_driver),
+        "swarm": swarm_options(discovery),
+        "name": name
+    }
+    return ("docker-machine create "
+            "--engine-label com.storm.managed=true "
+            "--driver azure "
+            "--azure-subscription-id {subscription_id} "
+            "--azure-subscription-cert {certificate} "
+            "--azure-location '{location}' "
+            "--azure-size {size} "
+            "{image}"
+            "{storage}"
+            "{swarm}"
+            "{name}").format(**conf)
+
+def digitalocean_create_command(name, size="512mb", region="nyc3", image=None, storage_driver=None, discovery=None):
+    conf = {
+        "access_token": credentials.digitalocean().token,
+        "size": size,
+        "region": region,
+        "image": ("--digitalocean-image %s " % image) if image else "",
+        "storage": storage_options(storage_driver),
+        "swarm": swarm_options(discovery),
+        "name": name
+    }
+    return ("docker-machine create "
+            "--engine-label com.storm.managed=true "
+            "--driver digitalocean "
+            "--digitalocean-access-token {access_token} "
+            "--digitalocean-region {region} "
+            "--digitalocean-size {size} "
+            "{image} "
+            "{storage}"
+            "{swarm}"
+            "{name}").format(**conf)
+
+def generic_create_command(name, ip, ssh_user, ssh_key, storage_driver=None, discovery=None):
+    conf = {
+        "ip": ip,
+        "ssh_user": ssh_user,
+        "ssh_key": ssh_key,
+        "storage": storage_options(storage_driver),
+        "swarm": swarm_options(discovery),
+        "name": name
+    }
+    return ("docker-machine create "
+            "--engine-label com.storm.managed=true "
+            "--driver generic "
+            "--generic-ip-address {ip} "
+            "--generic-ssh-user {ssh_user} "
+            "--generic-ssh-key {ssh_key} "
+            "{storage}"
+            "{swarm}"
+            "{name}").format(**conf)
+
+
+CREATE_COMMANDS = {
+    "aws": aws_create_command,
+    "azure": azure_create_command,
+    "digitalocean": digitalocean_create_command
+}
+
+def remove_failed(name, error, context=None):
+    debug.error('Exception creating %s, removing... The error was: %s' % (name, error))
+    machine('rm -f %s' % name, threadName="rm %s" % name)
+    environments.invalidate(name)
+    debug.warn("Removed: %s" % name)
+    if context:
+        context.advance(9)
+
+def create_async(instance, context=None, acquired=None):
+    """
+    Coroutine creating a machine when its provider's scheduler lets it,
+    retrying if the provider throttled it, calling acquired() whenever it
+    gets a scheduler slot. Instances with `join` are joined to the swarm
+    afterwards, they can be any standby machine of the same options.
+    """
+    name = instance["name"]
+    provider = instance["provider"]
+    if provider not in CREATE_COMMANDS:
+        raise Return(None)
+    options = create_options(instance)
+    scheduler = scheduler_for(provider, instance.get("region", instance.get("location")))
+
+    environments.invalidate(name)
+
+    if context:
+        context.advance(1)
+        context.check()
+
+    claimed = yield blocking(pool.claim, name, provider, options, join=instance.get("join", False))
+    if claimed:
+        environments.invalidate(name)
+        debug.info("Launched %s from the standby pool" % name)
+        if context:
+            context.advance(9)
+        raise Return(None)
+
+    attempt = 0
+    while True:
+        slot = yield scheduler.acquire()
+        if acquired:
+            acquired()
+        try:
+            yield local_async(CREATE_COMMANDS[provider](name, **options), threadName="create %s" % name)
+        except subprocess.CalledProcessError as e:
+            if not throttled(e.output) or attempt >= scheduler.retries:
+                slot.release()
+                yield blocking(remove_failed, name, e, context)
+                raise Return(None)
+            slot.release(throttled=True)
+            attempt += 1
+            debug.warn("Throttled creating %s, retrying (%d/%d)" % (name, attempt, scheduler.retries))
+            yield machine_async("rm -f %s" % name, threadName="rm %s" % name)
+            environments.invalidate(name)
+            continue
+        except BaseException:
+            slot.release()
+            raise
+        slot.release()
+        break
+
+    debug.info("Launched %s" % name)
+
+    if provider == "aws":
+        if context:
+            context.advance(7)
+        yield blocking(aws_security_group_ports, name, AWS_PORTS, options.get("security_group", "docker-storm"))
+        if context:
+            context.advance(2)
+    elif provider == "azure":
+        if context:
+            context.advance(7)
+        yield blocking(azure_add_endpoints, name, AZURE_ENDPOINTS)
+        if context:
+            context.advance(2)
+    elif context:
+        context.advance(9)
+
+def hedged_create_async(instance, batch, context=None):
+    """
+    Coroutine creating a machine like create_async(), with a replacement
+    once it's later than `batch` allows, keeping whichever is ready first
+    under the instance's name
+    """
+    name = instance["name"]
+    # Time waiting for a scheduler slot is throttling, not a slow machine
+    started = {}
+    creating = {coroutines.spawn(create_async(instance, context=context,
+                                              acquired=lambda: started.update(time=time.time()))): name}
+    hedged = instance["provider"] not in hedge.PROVIDERS
+    winner = None
+    error = None
+    try:
+        while creating:
+            deadline = batch.deadline()
+            if not hedged and deadline is not None and started and time.time() - started["time"] > deadline:
+                hedged = True
+                if batch.take():
+                    replacement = "%s-hedge" % name
+                    log.info("%s is taking longer than %ds, launching %s" % (name, deadline, replacement))
+                    creating[coroutines.spawn(create_async(dict(instance, name=replacement)))] = replacement
+            done = yield coroutines.first(*(list(creating) + [coroutines.sleep(hedge.POLL_INTERVAL)]))
+            if done not in creating:
+                continue
+            created = creating.pop(done)
+            error = coroutines.failure(done)
+            # create_async() removes machines it couldn't create
+            if error is None and store.load(created) is not None:
+                winner = created
+                break
+    finally:
+        for task in creating:
+            task.cancel()
+        if creating:
+            yield gather(*creating.keys(), return_exceptions=True)
+        for other in creating.values():
+            yield machine_async("rm -f %s" % other, threadName="rm %s" % other)
+            environments.invalidate(other)
+
+    if winner is None:
+        if error is not None:
+            raise error
+        raise Return(None)
+    if winner != name:
+        debug.info("%s was ready first, keeping it as %s" % (winner, name))
+        yield blocking(store.rename, winner, name)
+        environments.invalidate(winner)
+        environments.invalidate(name)
+    # Standby machines are claimed without creating anything
+    if started:
+        batch.record(time.time() - started["time"])
+
+def join_discovery_async(name, discovery):
+    """
+    Coroutine putting a machine created without discovery into the swarm
+    """
+    debug.info("Joining %s to the swarm with discovery %s" % (name, discovery))
+    yield blocking(store.join_swarm, name, discovery)
+    environments.invalidate(name)
+    yield machine_async("provision %s" % name, threadName="provision %s" % name)
 
+def register_async(name, ip, provider, storage_driver=None, discovery=None, context=None):
+    """
+    Coroutine installing Docker on a VM created in bulk
+    """
+    ssh_user, ssh_key = bulk.ssh_options(provider)
+    try:
+        yield local_async(generic_create_command(name, ip, ssh_user, ssh_key, storage_driver=storage_driver,
+                                                 discovery=discovery),
+                          threadName="create %s" % name)
     except subprocess.CalledProcessError as e:
-        debug.error('Exception creating %s, removing... The error was: %s' % (name, e))
-        machine('rm -f %s' % name, threadName="rm %s" % name)
-        debug.warn("Removed: %s" % name)
-        if progress:
-            completed += 9
-            progress.update(completed)
-
-def create_azure(name, size="Small", location="East US", image=None,
-                 discovery=None, progress=None):
+        yield blocking(remove_failed, name, e)
+        yield blocking(bulk.terminate, [name])
+        raise Return(None)
+    finally:
+        if context:
+            context.advance(4)
+    debug.info("Launched %s" % name)
+
+def bulk_create_async(instances, context=None):
     """
-    Launch an Azure instance
+    Coroutine creating instances with the same options in bulk through
+    their provider's API, one by one with create_async() if that fails
     """
+    provider = instances[0]["provider"]
+    options = create_options(instances[0])
+    scheduler = scheduler_for(provider, instances[0].get("region", instances[0].get("location")))
+
+    for instance in instances:
+        environments.invalidate(instance["name"])
+
+    claimed = []
+    for instance in instances:
+        if (yield blocking(pool.claim, instance["name"], provider, options, join=instance.get("join", False))):
+            claimed.append(instance["name"])
+    if claimed:
+        for name in claimed:
+            environments.invalidate(name)
+        debug.info("Launched %s from the standby pool" % ", ".join(claimed))
+        if context:
+            context.advance(10 * len(claimed))
+        instances = [instance for instance in instances if instance["name"] not in claimed]
+        if not instances:
+            raise Return(None)
+    names = [instance["name"] for instance in instances]
+
+    slot = yield scheduler.acquire()
     try:
-        global completed
-
-        swarm_options = (
-            "--swarm --swarm-master "
-            "--swarm-opt='replication=true' "
-            # "--swarm-opt='advertise=eth0:3376' "
-            "--swarm-discovery='consul://{0}:8500' "
-            "--engine-opt='cluster-store=consul://{0}:8500' "
-            "--engine-opt='cluster-advertise=eth0:2376' ".format(discovery)
-        ) if discovery else ""
-
-        conf = {
-            "subscription_id": AZURE_SUBSCRIPTION_ID,
-            "certificate": AZURE_CERTIFICATE,
-            "size": size,
-            "location": location,
-            "image": ("--azure-image %s " % image) if image else "",
-            "swarm": swarm_options,
-            "name": name
-        }
-        local(("docker-machine create "
-               "--engine-label com.storm.managed=true "
-               "--driver azure "
-               "--azure-subscription-id {subscription_id} "
-               "--azure-subscription-cert {certificate} "
-               "--azure-location '{location}' "
-               "--azure-size {size} "
-               "{image}"
-               "{swarm}"
-               "{name}").format(**conf), threadName="create %s" % name)
-
-        debug.info("Launched %s" % name)
-
-        if progress:
-            completed += 7
-            progress.update(completed)
-
-        # Add endpoints for overlay network
-        azure_add_endpoints(name, [{
-            'service': 'docker vxlan',
-            'protocol': 'udp',
-            'port': '4789',
-            'local_port': '4789'
-        }, {
-            'service': 'serf udp',
-            'protocol': 'udp',
-            'port': '7946',
-            'local_port': '7946'
-        }, {
-            'service': 'serf tcp',
-            'protocol': 'tcp',
-            'port': '7946',
-            'local_port': '7946'
-        }, {
-            'service': 'consul rpc',
-            'protocol': 'tcp',
-            'port': '8300',
-            'local_port': '8300'
-        }, {
-            'service': 'consul wan',
-            'protocol': 'tcp',
-            'port': '8302',
-            'local_port': '8302'
-        }, {
-            'service': 'consul wan udp',
-            'protocol': 'udp',
-            'port': '8302',
-            'local_port': '8302'
-        }, {
-            'service': 'consul',
-            'protocol': 'tcp',
-            'port': '8500',
-            'local_port': '8500'
-        }, {
-            'service': 'http',  # TODO Separate service ports
-            'protocol': 'tcp',
-            'port': '80',
-            'local_port': '80'
-        }, {
-            'service': 'haproxy stats',
-            'protocol': 'tcp',
-            'port': '88',
-            'local_port': '88'
-        }, {
-            'service': 'https',
-            'protocol': 'tcp',
-            'port': '443',
-            'local_port': '443'
-        }, {
-            'service': 'geth',
-            'protocol': 'tcp',
-            'port': '8545',
-            'local_port': '8545'
-        }])
-
-        if progress:
-            completed += 2
-            progress.update(completed)
+        ips = yield blocking(bulk.provision, provider, names, **options)
+    except bulk.BulkError as e:
+        slot.release(throttled=throttled(str(e)))
+        debug.warn("Could not create %s in bulk, creating them one by one: %s" % (", ".join(names), e))
+        results = yield gather(*[create_async(instance, context=context) for instance in instances],
+                               return_exceptions=True)
+        raise_first(names, results)
+        raise Return(None)
+    except BaseException:
+        slot.release()
+        raise
+    slot.release()
+
+    if context:
+        context.advance(6 * len(names))
+
+    results = yield gather(*[register_async(name, ips[name], provider, storage_driver=options.get("storage_driver"),
+                                            discovery=options.get("discovery"), context=context)
+                             for name in names], return_exceptions=True)
+
+    if provider == "aws":
+        # Once for the whole group
+        yield blocking(aws_security_group_ports, names[0], AWS_PORTS, options.get("security_group", "docker-storm"))
+
+    raise_first(names, results)
+
+def standby_async(provider, options):
+    """
+    Coroutine creating a machine for the standby pool
+    """
+    name = "standby-%s-%s" % (provider, str(uuid.uuid4())[:8])
+    command = CREATE_COMMANDS[provider](name, **options)
+    command = command.replace("--engine-label %s " % store.MANAGED_LABEL, "--engine-label %s " % pool.STANDBY_LABEL)
+    scheduler = scheduler_for(provider, options.get("region", options.get("location")))
 
+    slot = yield scheduler.acquire()
+    try:
+        yield local_async(command, threadName="create %s" % name)
     except subprocess.CalledProcessError as e:
-        debug.error('Exception creating %s, removing... The error was: %s' % (name, e))
-        machine('rm -f %s' % name, threadName="rm %s" % name)
-        debug.warn("Removed: %s" % name)
-        if progress:
-            completed += 9
-            progress.update(completed)
+        slot.release(throttled=throttled(e.output))
+        yield blocking(remove_failed, name, e)
+        raise Return(None)
+    except BaseException:
+        slot.release()
+        raise
+    slot.release()
+
+    if provider == "aws":
+        yield blocking(aws_security_group_ports, name, AWS_PORTS, options.get("security_group", "docker-storm"))
+    pool.add(name, provider, options)
+    debug.info("Standing by: %s" % name)
+    raise Return(name)
+
+def pool_fill_async(groups):
+    """
+    Coroutine topping up the standby pool, `groups` are (provider, create
+    options, number of machines) tuples
+    """
+    start = time.time()
+    creations = []
+    for provider, options, count in groups:
+        if provider not in pool.PROVIDERS:
+            log.warn("Machines on %s can't be pooled" % provider)
+            continue
+        missing = count - len(pool.standby(provider, options))
+        creations += [standby_async(provider, options) for i in range(missing)]
+    results = yield gather(*creations, return_exceptions=True)
+    raise_first(["standby"] * len(results), results)
+    log.info("Pool fill duration: %ss" % (time.time() - start))
+    raise Return([name for name in results if name])
 
-def create_digitalocean(name, size="512mb", region="nyc3", image=None,
-                        discovery=None, progress=None):
+@task
+def pool_drain(names):
     """
-    Launch a DigitalOcean instance
+    Remove standby machines
     """
+    future_node = dict((machine_async("rm -y %s" % name, threadName="rm %s" % name), name) for name in names)
+    for future in completed(future_node, 30):
+        if future.result() is not None:
+            debug.info("Removed standby machine: %s" % future_node[future])
+    pool.forget(names)
+
+
+# Cloud API clients are kept around for reuse, one at a time per thread
+clients = {}
+clients_lock = threading.Lock()
+
+@contextmanager
+def cloud_client(key, factory):
+    with clients_lock:
+        pool = clients.setdefault(key, [])
+        client = pool.pop() if pool else None
+    if client is None:
+        client = factory()
     try:
-        global completed
-
-        swarm_options = (
-            "--swarm --swarm-master "
-            "--swarm-opt='replication=true' "
-            # "--swarm-opt='advertise=eth0:3376' "
-            "--swarm-discovery='consul://{0}:8500' "
-            "--engine-opt='cluster-store=consul://{0}:8500' "
-            "--engine-opt='cluster-advertise=eth0:2376' ".format(discovery)
-        ) if discovery else ""
-
-        conf = {
-            "access_token": DIGITALOCEAN_ACCESS_TOKEN,
-            "size": size,
-            "region": region,
-            "image": ("--digitalocean-image %s " % image) if image else "",
-            "swarm": swarm_options,
-            "name": name
-        }
-        local(("docker-machine create "
-               "--engine-label com.storm.managed=true "
-               "--driver digitalocean "
-               "--digitalocean-access-token {access_token} "
-               "--digitalocean-region {region} "
-               "--digitalocean-size {size} "
-               "{image} "
-               "{swarm}"
-               "{name}").format(**conf), threadName="create %s" % name)
-
-        debug.info("Launched %s" % name)
-
-        # TODO Open overlay network ports?
-
-        if progress:
-            completed += 9
-            progress.update(completed)
+        yield client
+    finally:
+        with clients_lock:
+            clients[key].append(client)
 
-    except subprocess.CalledProcessError as e:
-        debug.error('Exception creating %s, removing... The error was: %s' % (name, e))
-        machine('rm -f %s' % name, threadName="rm %s" % name)
-        debug.warn("Removed: %s" % name)
-        if progress:
-            completed += 9
-            progress.update(completed)
+def azure_service():
+    azure = credentials.azure()
+    return cloud_client(("azure",) + azure,
+                        lambda: servicemanagement.ServiceManagementService(azure.subscription_id, azure.certificate))
+
+def ec2_connection():
+    aws = credentials.aws()
+    return cloud_client(("aws",) + aws,
+                        lambda: boto.connect_ec2(aws_access_key_id=aws.access_key, aws_secret_access_key=aws.secret_key))
 
 def azure_add_endpoints(name, portConfigs):
-    sms = ServiceManagementService(AZURE_SUBSCRIPTION_ID, AZURE_CERTIFICATE)
+    with azure_service() as sms:
+        add_endpoints(sms, name, portConfigs)
+
+def add_endpoints(sms, name, portConfigs):
     role = sms.get_role(name, name, name)
 
     network_config = role.configuration_sets[0]
     for i, portConfig in enumerate(portConfigs):
         network_config.input_endpoints.input_endpoints.append(
-            ConfigurationSetInputEndpoint(
+            servicemanagement.ConfigurationSetInputEndpoint(
                 name=portConfig["service"],
                 protocol=portConfig["protocol"],
                 port=portConfig["port"],
@@ -659,13 +1084,14 @@ def azure_add_endpoints(name, portConfigs):
         )
     try:
         sms.update_role(name, name, name, network_config=network_config)
-    except AzureHttpError as e:
+    except azure_common.AzureHttpError as e:
         debug.warn("Exception opening ports for %s: %r" % (name, e))
 
 def aws_security_group_ports(name, portConfigs, security_group="docker-storm"):
-    ec2 = boto.connect_ec2(aws_access_key_id=AWS_ACCESS_KEY,
-                           aws_secret_access_key=AWS_SECRET_KEY)
+    with ec2_connection() as ec2:
+        authorize_ports(ec2, name, portConfigs, security_group)
 
+def authorize_ports(ec2, name, portConfigs, security_group):
     group_id = None
     groups = ec2.get_all_security_groups()
     for group in groups:
@@ -683,42 +1109,91 @@ def aws_security_group_ports(name, portConfigs, security_group="docker-storm"):
                                          from_port=portConfig["from_port"],
                                          to_port=portConfig["to_port"],
                                          cidr_ip="0.0.0.0/0")
-        except EC2ResponseError as e:
+        except boto_exception.EC2ResponseError as e:
             debug.warn("Exception opening ports for %s: %r" % (name, e))
 
 @task
-def launch(instances):
+def launch(instances, hedging=None):
+    """
+    Launch instances, see launch_async()
+    """
+    coroutines.run(launch_async(instances, hedging=hedging))
+
+def raise_first(names, results):
+    """
+    Log failures from gather(return_exceptions=True), then raise the first
+    one like the thread pool tasks do
+    """
+    failures = [(name, result) for name, result in zip(names, results) if isinstance(result, BaseException)]
+    for name, result in failures:
+        debug.error('%s generated an exception: %r' % (name, result))
+    if failures:
+        raise failures[0][1]
+
+def completed(future_node, timeout):
+    """
+    Futures of `future_node` as they're done, like as_completed(), logging
+    the ones still running after `timeout` seconds instead of waiting on
+    """
+    try:
+        for future in futures.as_completed(future_node, timeout):
+            yield future
+    except futures.TimeoutError:
+        pending = sorted(future_node[future] for future in future_node if not future.done())
+        debug.error("Timed out after %ds waiting for %s" % (timeout, ", ".join(pending)))
+
+def creations(instances, context=None, hedging=None):
+    """
+    Coroutines creating `instances`, one per machine and one per group with
+    `bulk: true` in storm.yml, with the names each one creates. Machines
+    created one by one are hedged as a batch with the `hedge` section of
+    storm.yml as `hedging`.
+    """
+    groups = {}
+    result = []
+    single = [name for name in instances
+              if not (instances[name].get("bulk") and instances[name]["provider"] in bulk.PROVISIONERS)]
+    batch = hedge.for_batch(hedging, len(single))
+    for name in instances:
+        instance = instances[name]
+        if name not in single:
+            key = (instance["provider"], tuple(sorted(create_options(instance).items())))
+            groups.setdefault(key, []).append(instance)
+        elif batch is not None:
+            result.append(([name], hedged_create_async(instance, batch, context=context)))
+        else:
+            result.append(([name], create_async(instance, context=context)))
+    for group in groups.values():
+        result.append(([member["name"] for member in group], bulk_create_async(group, context=context)))
+    return result
+
+def launch_async(instances, hedging=None):
     """
-    Launch instances using create()
+    Coroutine creating all instances at once, as fast as their providers'
+    schedulers allow, hedged with the `hedge` section of storm.yml as
+    `hedging`
     """
     debug.info("Launching instances: %s" % instances)
-    max_workers = len(instances)
 
-    global completed
-    completed = 0
-    progress = ProgressBar(widgets=widgets, max_value=max_workers * 10).start()
+    context = TaskContext("Launch", len(instances) * 10).start()
 
-    start = time.time()
-    tick(progress)
+    names = instances.keys()
+    launches = creations(instances, context=context, hedging=hedging)
+    labels = [", ".join(created) for created, creation in launches]
 
-    # AWS limits to 12 concurrent instantiations.
-    # TODO check / adapt for other cloud providers
-    with futures.ThreadPoolExecutor(max_workers=12) as executor:
-        future_node = dict((executor.submit(create,
-                                            instances[instance],
-                                            progress=progress), instance)
-                           for instance in instances)
+    try:
+        results = yield gather(*[creation for created, creation in launches], return_exceptions=True)
+    except BaseException:
+        # Stops work running on threads at its next step
+        context.cancel()
+        raise
+    finally:
+        context.finish()
 
-    for future in futures.as_completed(future_node, 300):
-        instance = future_node[future]
-        if future.exception() is not None:
-            debug.error('%s generated an exception: %r' % (instance, future.exception()))
-        if future.result() and "Exception" not in future.result():
-            debug.info('Launched %s: %r' % (instance, future.result()))
+    raise_first(labels, results)
 
-    ticker.cancel()
-    progress.finish()
-    log.info("Launch duration: %ss" % (time.time() - start))
+    update_cache(names)
+    log.info("Launch duration: %ss" % context.elapsed)
 
 @task
 def deploy_consul(instances, encrypt, path=None):
@@ -730,12 +1205,7 @@ def deploy_consul(instances, encrypt, path=None):
     debug.info("Launching Consul cluster on: %s" % instances)
     max_workers = len(instances)
 
-    global completed
-    completed = 0
-    progress = ProgressBar(widgets=widgets, max_value=max_workers * 10).start()
-
-    start = time.time()
-    tick(progress)
+    context = TaskContext("Deploy Consul", max_workers * 10).start()
 
     with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_node = dict((executor.submit(compose_consul,
@@ -744,7 +1214,7 @@ def deploy_consul(instances, encrypt, path=None):
                                             servers=instances.values(),
                                             encrypt=encrypt,
                                             path=path,
-                                            progress=progress), instance)
+                                            context=context), instance)
                            for instance in instances.keys())
 
     for future in futures.as_completed(future_node, 300):
@@ -754,15 +1224,12 @@ def deploy_consul(instances, encrypt, path=None):
         if future.result() and "Exception" not in future.result():
             debug.info('Launched %s: %r' % (instance, future.result()))
 
-    ticker.cancel()
-    progress.finish()
-    log.info("Deploy Consul duration: %ss" % (time.time() - start))
+    context.finish()
+    log.info("Deploy Consul duration: %ss" % context.elapsed)
 
-def compose_consul(instance, ip, servers, encrypt, path=None, progress=None):
-    global completed
-    if progress:
-        completed += 1
-        progress.update(completed)
+def compose_consul(instance, ip, servers, encrypt, path=None, context=None):
+    if context:
+        context.advance(1)
 
     #
     # Open ports
@@ -795,9 +1262,8 @@ def compose_consul(instance, ip, servers, encrypt, path=None, progress=None):
             'to_port': '8500'
         }], 'docker-storm')
 
-    if progress:
-        completed += 1
-        progress.update(completed)
+    if context:
+        context.advance(1)
 
     # Consul doesn't like our Azure hostnames, and docker-machine doesn't even
     # know the actual IP...
@@ -822,20 +1288,22 @@ def compose_consul(instance, ip, servers, encrypt, path=None, progress=None):
         else:
             ports = ""
 
+        if context:
+            context.check()
         container_name = "consul-%s" % index
-        run_on(instance, "gliderlabs/consul-server:0.6", "-d %s" % ports,
+        run_on(instance, CONSUL_IMAGE, "-d %s" % ports,
                "-dc='%s' -encrypt='%s' %s%s -rejoin" % (instance, encrypt, joins, joins_wan),
                name=container_name)
 
         if index < 2:
-            container_ip = docker_on(instance, "inspect --format '{{ .NetworkSettings.IPAddress }}' consul-%d" % index,
-                                     threadName="inspect %s" % container_name,
-                                     capture=True).replace("\n", "")
+            try:
+                container_ip = engine_on(instance).inspect(container_name)["NetworkSettings"]["IPAddress"]
+            except EngineError as e:
+                fabric_api.abort("Error inspecting %s on %s: %s" % (container_name, instance, e))
             joins += "-retry-join='%s' " % container_ip
 
-    if progress:
-        completed += 8
-        progress.update(completed)
+    if context:
+        context.advance(8)
 
 @task
 def deploy_registrator(swarm_master, scale, discovery, path=None):
@@ -849,6 +1317,16 @@ def deploy_registrator(swarm_master, scale, discovery, path=None):
     compose_on(swarm_master, "up -d", discovery, cwd=os.path.join(os.path.dirname(__file__), 'compose', 'registrator'))
     compose_on(swarm_master, "scale registrator=%d" % scale, discovery, cwd=os.path.join(os.path.dirname(__file__), 'compose', 'registrator'))
 
+def deploy_registrator_async(swarm_master, scale, discovery, path=None):
+    """
+    Coroutine for deploy_registrator()
+    """
+    debug.info("Launching %d Registrator containers from %s" % (scale, swarm_master))
+
+    cwd = os.path.join(os.path.dirname(__file__), 'compose', 'registrator')
+    yield compose_on_async(swarm_master, "up -d", discovery, cwd=cwd)
+    yield compose_on_async(swarm_master, "scale registrator=%d" % scale, discovery, cwd=cwd)
+
 @task
 def prepare_haproxy(instances, path=None):
     """
@@ -859,49 +1337,39 @@ def prepare_haproxy(instances, path=None):
     """
     max_workers = len(instances)
 
-    global completed
-    completed = 0
-    progress = ProgressBar(widgets=widgets, max_value=max_workers * 10).start()
+    context = TaskContext("Prepare HAProxy", max_workers * 10).start()
 
-    start = time.time()
-    tick(progress)
+    future_node = dict((prepare_haproxy_instance(instance, path=path, context=context), instance)
+                       for instance in instances)
 
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(prepare_haproxy_instance,
-                                            instance,
-                                            path=path,
-                                            progress=progress), instance)
-                           for instance in instances)
-
-    for future in futures.as_completed(future_node, 300):
+    for future in completed(future_node, 300):
         instance = future_node[future]
         if future.exception() is not None:
             debug.error('%s generated an exception: %r' % (instance, future.exception()))
         if future.result() and "Exception" not in future.result():
             debug.info('Prepared %s: %r' % (instance, future.result()))
 
-    ticker.cancel()
-    progress.finish()
-    log.info("Prepare HAProxy duration: %ss" % (time.time() - start))
+    context.finish()
+    log.info("Prepare HAProxy duration: %ss" % context.elapsed)
 
-def prepare_haproxy_instance(instance, path=None, progress=None):
-    global completed
-    if progress:
-        completed += 1
-        progress.update(completed)
+def prepare_haproxy_instance(instance, path=None, context=None):
+    if context:
+        context.advance(1)
 
     certificate = os.path.join(os.path.expanduser("~"), ".storm", "certificate.pem")
-    ssh_on(instance, "mkdir -p /home/ubuntu/.storm")
 
-    if progress:
-        completed += 4
-        progress.update(completed)
+    def copy(future):
+        if context:
+            context.advance(4)
+        return machine_async("scp %s %s:/home/ubuntu/.storm/" % (certificate, instance), threadName="scp %s" % instance)
 
-    machine("scp %s %s:/home/ubuntu/.storm/" % (certificate, instance), threadName="scp %s" % instance)
+    def done(future):
+        if context:
+            context.advance(5)
+        return future.result()
 
-    if progress:
-        completed += 5
-        progress.update(completed)
+    mkdir = machine_async("ssh %s -- mkdir -p /home/ubuntu/.storm" % instance, threadName="ssh %s" % instance)
+    return then(then(mkdir, copy), done)
 
 @task
 def deploy_haproxy(swarm_master, scale, discovery, path=None):
@@ -913,6 +1381,14 @@ def deploy_haproxy(swarm_master, scale, discovery, path=None):
     compose_on(swarm_master, "up -d", discovery, cwd=os.path.join(os.path.dirname(__file__), 'compose', 'haproxy'))
     compose_on(swarm_master, "scale load-balancer=%d" % scale, discovery, cwd=os.path.join(os.path.dirname(__file__), 'compose', 'haproxy'))
 
+def deploy_haproxy_async(swarm_master, scale, discovery, path=None):
+    """
+    Coroutine for deploy_haproxy()
+    """
+    cwd = os.path.join(os.path.dirname(__file__), 'compose', 'haproxy')
+    yield compose_on_async(swarm_master, "up -d", discovery, cwd=cwd)
+    yield compose_on_async(swarm_master, "scale load-balancer=%d" % scale, discovery, cwd=cwd)
+
 @task
 def stop_machines(machines):
     """
@@ -920,45 +1396,44 @@ def stop_machines(machines):
     """
     max_workers = len(machines)
 
-    global completed
-    completed = 0
-    progress = ProgressBar(widgets=widgets, max_value=max_workers * 10).start()
+    context = TaskContext("Stop", max_workers * 10).start()
 
-    start = time.time()
-    tick(progress)
+    # docker-machine can't stop what it created with the generic driver
+    created = bulk.created(machines)
+    future_node = dict((stop_machine(machine, context=context), machine)
+                       for machine in machines if machine not in created)
+    context.advance(max_workers)
+    if created:
+        bulk.stop(created.keys())
+        for name in created:
+            environments.invalidate(name)
+        context.advance(9 * len(created))
 
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(stop_machine,
-                                            machine,
-                                            progress=progress), machine)
-                           for machine in machines)
-        progress.update(max_workers)
-        completed = max_workers
-
-    for future in futures.as_completed(future_node, 30):
+    for future in completed(future_node, 30):
         instance = future_node[future]
         if future.exception() is not None:
             debug.error("Exception stopping %s: %s" % (instance, future.exception()))
         if future.result() and "Exception" not in future.result():
             debug.info("Stopped: %s" % future.result())
 
-    ticker.cancel()
-    progress.finish()
-    log.info("Stop duration: %ss" % (time.time() - start))
+    context.finish()
+    update_cache(machines)
+    log.info("Stop duration: %ss" % context.elapsed)
 
-def stop_machine(machine, progress=None):
-    machine("stop %s" % machine, threadName="stop %s" % machine)
-    if progress:
-        global completed
-        completed += 9
-        progress.update(completed)
+def stop_machine(instance, context=None):
+    def done(future):
+        environments.invalidate(instance)
+        if context:
+            context.advance(9)
+        return future.result()
+    return then(machine_async("stop %s" % instance, threadName="stop %s" % instance), done)
 
 @task
 def cleanup(containers):
     """
     Generic cleanup routine for containers and images
     """
-    with settings(warn_only=True):
+    with fabric_api.settings(warn_only=True):
         for container in containers:
             docker("stop --time=30 %s" % container)
             docker("rm $(docker ps -q -f status=exited)")
@@ -971,23 +1446,21 @@ def teardown(instances):
     """
     max_workers = len(instances)
 
-    global completed
-    completed = 0
-    progress = ProgressBar(widgets=widgets, max_value=max_workers).start()
-
-    start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(machine,
-                                            "rm -y %s" % instance,
-                                            progress=progress), instance)
-                           for instance in instances)
+    context = TaskContext("Teardown", max_workers).start()
+    future_node = dict((machine_async("rm -y %s" % instance, context=context), instance)
+                       for instance in instances)
 
-    for future in futures.as_completed(future_node, 30):
+    for future in completed(future_node, 30):
         instance = future_node[future]
         if future.exception() is not None:
             debug.error('%s generated an exception: %r' % (instance, future.exception()))
         if future.result():
             debug.info("Teardown: %s" % future.result())
 
-    progress.finish()
-    log.info("Teardown duration: %ss" % (time.time() - start))
+    context.finish()
+    # VMs created in bulk outlive `docker-machine rm`
+    bulk.terminate(instances)
+    for instance in instances:
+        environments.invalidate(instance)
+    update_cache(instances)
+    log.info("Teardown duration: %ss" % context.elapsed)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Run traces
+
+Commands that change machines record a span for every child process they
+start (thread name, command, host, start, first output, exit and return
+code) grouped under the phase it ran in, and write them to
+~/.storm/traces/<command>-<time>.json in the Trace Event Format, which
+Perfetto (ui.perfetto.dev) and chrome://tracing open. Every phase is shown
+as a process with a row per host and a "phase" row spanning all of it, work
+entering a phase of the same name again (like the nodes of a deploy graph)
+joins it. The last STORM_TRACE_KEEP traces (20 by default) are kept, 0
+turns tracing off.
+"""
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+from coroutines import current_task
+
+log = logging.getLogger(__name__)
+
+TRACE_PATH = os.path.join(os.path.expanduser("~"), ".storm", "traces")
+TRACE_KEEP = int(os.environ.get("STORM_TRACE_KEEP", 20))
+
+tracer = None
+
+def command_class(cmd):
+    """
+    Program and subcommand, "docker-machine create" for a whole create command line
+    """
+    words = [word for word in cmd.split() if not word.startswith("-")][:2]
+    return " ".join(words)
+
+class Phase(object):
+    """
+    Named step of a run, a process in the trace with a row per host
+    """
+    def __init__(self, tracer, name, pid):
+        self.tracer = tracer
+        self.name = name
+        self.pid = pid
+        self.start = tracer.now()
+        self.end = None
+        self.tracks = {}
+
+    def track(self, host):
+        with self.tracer.lock:
+            if host not in self.tracks:
+                self.tracks[host] = len(self.tracks) + 1
+                self.tracer.metadata("thread_name", self.pid, self.tracks[host], host)
+                self.tracer.metadata("thread_sort_index", self.pid, self.tracks[host], self.tracks[host])
+            return self.tracks[host]
+
+class Span(object):
+    """
+    Child process, from start to exit
+    """
+    def __init__(self, tracer, phase, cmd, threadName, host):
+        self.tracer = tracer
+        self.phase = phase
+        self.cmd = cmd
+        self.threadName = threadName
+        self.host = host or threadName or "local"
+        self.start = tracer.now()
+        self.first_output = None
+
+    def output(self):
+        if self.first_output is None:
+            self.first_output = self.tracer.now()
+
+    def exit(self, rc):
+        end = self.tracer.now()
+        pid = self.phase.pid if self.phase else 0
+        tid = self.phase.track(self.host) if self.phase else self.tracer.track(self.host)
+        args = {"cmd": self.cmd, "thread": self.threadName, "host": self.host, "rc": rc}
+        if self.phase:
+            args["phase"] = self.phase.name
+        if self.first_output is not None:
+            args["first_output_ms"] = round((self.first_output - self.start) / 1000.0, 3)
+            self.tracer.event({"ph": "i", "s": "t", "name": "first output", "cat": "output",
+                               "ts": self.first_output, "pid": pid, "tid": tid})
+        self.tracer.event({"ph": "X", "name": command_class(self.cmd), "cat": "process" if rc == 0 else "process,error",
+                           "ts": self.start, "dur": end - self.start, "pid": pid, "tid": tid, "args": args})
+
+class Tracer(object):
+    """
+    Trace events of one run, timestamps in microseconds since it started
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.events = []
+        self.phases = itertools.count(1)
+        self.named = {}
+        self.tracks = {}
+        self.phase = None
+        self.metadata("process_name", 0, None, "storm %s" % name)
+
+    def now(self):
+        return int((time.time() - self.started) * 1000000)
+
+    def event(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def metadata(self, name, pid, tid, value):
+        event = {"ph": "M", "name": name, "pid": pid, "args": {"sort_index" if name.endswith("sort_index") else "name": value}}
+        if tid is not None:
+            event["tid"] = tid
+        self.events.append(event)
+
+    def track(self, host):
+        with self.lock:
+            if host not in self.tracks:
+                self.tracks[host] = len(self.tracks) + 1
+                self.metadata("thread_name", 0, self.tracks[host], host)
+            return self.tracks[host]
+
+    def current_phase(self):
+        task = current_task()
+        if task is not None:
+            return task.context.get("phase")
+        return self.phase
+
+    @contextmanager
+    def in_phase(self, name):
+        with self.lock:
+            phase = self.named.get(name)
+            if phase is None:
+                phase = self.named[name] = Phase(self, name, next(self.phases))
+                self.metadata("process_name", phase.pid, None, name)
+                self.metadata("process_sort_index", phase.pid, None, phase.pid)
+                self.metadata("thread_name", phase.pid, 0, "phase")
+        task = current_task()
+        if task is not None:
+            previous, task.context["phase"] = task.context.get("phase"), phase
+        else:
+            previous, self.phase = self.phase, phase
+        try:
+            yield phase
+        finally:
+            if task is not None:
+                task.context["phase"] = previous
+            else:
+                self.phase = previous
+            with self.lock:
+                phase.end = max(phase.end, self.now())
+
+    def save(self, path=TRACE_PATH):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        filename = os.path.join(path, "%s-%s.json" % (self.name, time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))))
+        with self.lock:
+            events = list(self.events)
+            events += [{"ph": "X", "name": phase.name, "cat": "phase", "ts": phase.start, "dur": phase.end - phase.start,
+                        "pid": phase.pid, "tid": 0} for phase in self.named.values() if phase.end is not None]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"command": self.name, "started": self.started}}, f)
+        prune(path)
+        return filename
+
+def prune(path, keep=TRACE_KEEP):
+    traces = [os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json")]
+    traces.sort(key=os.path.getmtime)
+    for filename in traces[:-keep] if keep else traces:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+def start(name):
+    """
+    Start tracing a run of `name`
+    """
+    global tracer
+    if TRACE_KEEP > 0:
+        tracer = Tracer(name)
+
+def finish():
+    """
+    Write the trace of the current run, returns its path
+    """
+    global tracer
+    current, tracer = tracer, None
+    if current is None or len(current.events) <= 1:
+        return None
+    try:
+        filename = current.save()
+    except (IOError, OSError) as e:
+        log.warn("Could not write trace: %s" % e)
+        return None
+    log.info("Trace: %s" % filename)
+    return filename
+
+@contextmanager
+def phase(name):
+    """
+    Group the processes started within the block (or the coroutine and the
+    ones it spawns) under `name`
+    """
+    if tracer is None:
+        yield None
+        return
+    with tracer.in_phase(name) as current:
+        yield current
+
+def process(cmd, threadName=None, env=None):
+    """
+    Span for a child process being started, None when not tracing
+    """
+    if tracer is None:
+        return None
+    host = threadName.split()[-1] if threadName else (env or {}).get("DOCKER_HOST")
+    return Span(tracer, tracer.current_phase(), cmd, threadName, host)